@@ -0,0 +1,581 @@
+"""
+OpenAI / 画像CDN / Twitter の代わりになるローカルサーバに対して投稿パイプラインを動かし、
+スループット・レイテンシ・メモリ・リトライ回数を JSON で出力するベンチマーク（ネットワーク不要）
+
+    python bench_e2e.py --modes sync,batch,async --concurrency 1,4,16 --jobs 32 --output bench.json
+
+--profile に JSON ファイルを渡すと、エンドポイントごとのレイテンシ分布・エラー率・画像サイズを変えられる。
+"images:<モデル名>" のキーを書くと、そのモデルへの画像生成リクエストだけ "images" の代わりにその指定を使う。
+--hedge-quantile を渡すと model_router.ModelRouter を通して生成し、遅いリクエストをヘッジする。
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import base64
+import tempfile
+import argparse
+import threading
+import contextlib
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+# エンドポイントごとの既定の振る舞い
+# latency_ms: {"dist": "fixed" | "uniform" | "lognormal", "median" | "min"/"max", "sigma"}
+# errors: ステータス（"429", "500", "503", "content_policy"）→ 発生確率
+DEFAULT_PROFILE: Dict[str, Dict[str, Any]] = {
+    "images": {
+        "latency_ms": {"dist": "lognormal", "median": 500, "sigma": 0.3},
+        "errors": {"429": 0.03, "500": 0.02, "content_policy": 0.02},
+    },
+    "cdn": {
+        "latency_ms": {"dist": "lognormal", "median": 30, "sigma": 0.5},
+        "payload_bytes": 1_500_000,
+        "bandwidth_mbps": 200,
+        "errors": {"503": 0.01},
+    },
+    "media_upload": {
+        "latency_ms": {"dist": "lognormal", "median": 150, "sigma": 0.4},
+        "errors": {"500": 0.01},
+    },
+    "create_tweet": {
+        "latency_ms": {"dist": "lognormal", "median": 100, "sigma": 0.3},
+        "errors": {"429": 0.01},
+    },
+    # エラー応答に付ける retry-after-ms（リトライ待ちでベンチマークが支配されないよう短くする）
+    "retry_after_ms": 50,
+}
+
+TWITTER_HOSTS = ("https://api.twitter.com", "https://upload.twitter.com")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _merge(base: Dict[str, Any], override: Dict[str, Any]) -> Dict[str, Any]:
+    # エンドポイント単位でキーを上書きする（errors や latency_ms は丸ごと置き換える）
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = {**merged[key], **value}
+        else:
+            merged[key] = value
+    return merged
+
+
+def sample_latency(spec: Optional[Dict[str, Any]], rng: random.Random) -> float:
+    """レイテンシ分布の指定から待ち時間（秒）を1つ取り出す"""
+    if not spec:
+        return 0.0
+    dist = spec.get("dist", "fixed")
+    if dist == "uniform":
+        ms = rng.uniform(spec.get("min", 0), spec.get("max", 0))
+    elif dist == "lognormal":
+        ms = rng.lognormvariate(0, spec.get("sigma", 0.5)) * spec.get("median", 0)
+    else:
+        ms = spec.get("median", spec.get("ms", 0))
+    return max(ms, 0) / 1000
+
+
+# ---------------------------------------------------------------------------
+# スタンドインサーバ（別プロセスで動かし、クライアント側の計測に影響しないようにする）
+# ---------------------------------------------------------------------------
+
+class StandInState:
+    def __init__(self, profile: Dict[str, Any], seed: int):
+        self.profile = profile
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts: Dict[str, Dict[str, int]] = {}
+        self.next_id = 1000
+        size = profile["cdn"].get("payload_bytes", 1_000_000)
+        self.payload = PNG_SIGNATURE + random.Random(seed).randbytes(max(size - len(PNG_SIGNATURE), 0))
+
+    def draw(self, endpoint: str):
+        """(待ち時間, 返すエラー or None) を決める"""
+        spec = self.profile.get(endpoint, {})
+        with self.lock:
+            delay = sample_latency(spec.get("latency_ms"), self.rng)
+            error = None
+            roll = self.rng.random()
+            for status, rate in (spec.get("errors") or {}).items():
+                if roll < rate:
+                    error = status
+                    break
+                roll -= rate
+            return delay, error
+
+    def count(self, endpoint: str, status: Any) -> None:
+        with self.lock:
+            by_status = self.counts.setdefault(endpoint, {})
+            by_status[str(status)] = by_status.get(str(status), 0) + 1
+
+    def new_id(self) -> int:
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: StandInState
+
+    def log_message(self, format, *args):  # noqa: A002 - 標準ライブラリのシグネチャに合わせる
+        pass
+
+    def _send(self, status: int, body: bytes = b"", content_type: str = "application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _json(self, status: int, payload: Any, headers=None) -> None:
+        self._send(status, json.dumps(payload).encode(), headers=headers)
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _error(self, endpoint: str, error: str) -> None:
+        retry_after = {"retry-after-ms": str(self.state.profile.get("retry_after_ms", 50))}
+        if error == "content_policy":
+            self.state.count(endpoint, "content_policy")
+            self._json(400, {"error": {
+                "message": "Your request was rejected as a result of our safety system.",
+                "type": "invalid_request_error",
+                "code": "content_policy_violation",
+            }}, retry_after)
+        else:
+            self.state.count(endpoint, error)
+            self._json(int(error), {"error": {"message": f"stand-in {error}", "type": "server_error"}}, retry_after)
+
+    def _simulate(self, endpoint: str) -> bool:
+        """遅延を入れ、エラーを返した場合は False"""
+        delay, error = self.state.draw(endpoint)
+        time.sleep(delay)
+        if error:
+            self._error(endpoint, error)
+            return False
+        return True
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/__stats":
+            with self.state.lock:
+                self._json(200, self.state.counts)
+            return
+        if path.startswith("/cdn/"):
+            self._serve_image()
+            return
+        self._json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = self._body()
+        if path == "/__reset":
+            with self.state.lock:
+                self.state.counts = {}
+            self._json(200, {})
+        elif path == "/v1/images/generations":
+            self._images(body)
+        elif path == "/1.1/media/upload.json":
+            self._media_upload(body)
+        elif path == "/2/tweets":
+            if self._simulate("create_tweet"):
+                self.state.count("create_tweet", 201)
+                text = json.loads(body or b"{}").get("text", "")
+                self._json(201, {"data": {"id": str(self.state.new_id()), "text": text}})
+        else:
+            self._json(404, {"error": {"message": "not found"}})
+
+    def _images(self, body: bytes) -> None:
+        request = json.loads(body or b"{}")
+        # モデルごとの指定があればそちらを使う（ルーティングとヘッジの確認用）
+        endpoint = f"images:{request.get('model')}"
+        if endpoint not in self.state.profile:
+            endpoint = "images"
+        if not self._simulate(endpoint):
+            return
+        if request.get("response_format") == "b64_json":
+            image = {"b64_json": base64.b64encode(self.state.payload).decode()}
+        else:
+            host = self.headers.get("Host")
+            image = {"url": f"http://{host}/cdn/{self.state.new_id()}.png"}
+        self.state.count(endpoint, 200)
+        self._json(200, {"created": int(time.time()), "data": [image]})
+
+    def _serve_image(self) -> None:
+        if not self._simulate("cdn"):
+            return
+        self.state.count("cdn", 200)
+        payload = self.state.payload
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        # 帯域を指定した場合は少しずつ送る
+        mbps = self.state.profile["cdn"].get("bandwidth_mbps")
+        chunk = 64 * 1024
+        for start in range(0, len(payload), chunk):
+            self.wfile.write(payload[start:start + chunk])
+            if mbps:
+                time.sleep(chunk * 8 / (mbps * 1_000_000))
+
+    def _media_upload(self, body: bytes) -> None:
+        head = body[:4096]
+        if b"command=INIT" in head:
+            if self._simulate("media_upload"):
+                self.state.count("media_upload", "INIT")
+                media_id = self.state.new_id()
+                self._json(202, {"media_id": media_id, "media_id_string": str(media_id), "expires_after_secs": 86400})
+        elif b"APPEND" in head:
+            self.state.count("media_upload", "APPEND")
+            self._send(204)
+        elif b"command=FINALIZE" in head:
+            media_id = head.split(b"media_id=")[1].split(b"&")[0].decode()
+            self.state.count("media_upload", 201)
+            self._json(201, {"media_id": int(media_id), "media_id_string": media_id, "size": 0})
+        elif self._simulate("media_upload"):
+            self.state.count("media_upload", 200)
+            media_id = self.state.new_id()
+            self._json(200, {"media_id": media_id, "media_id_string": str(media_id), "size": len(body)})
+
+
+def serve(profile: Dict[str, Any], seed: int, port_queue) -> None:
+    StandInHandler.state = StandInState(profile, seed)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StandInServer:
+    """スタンドインサーバを別プロセスで起動・停止する"""
+
+    def __init__(self, profile: Optional[Dict[str, Any]] = None, seed: int = 0):
+        self.profile = _merge(DEFAULT_PROFILE, profile or {})
+        self.seed = seed
+        self.url = ""
+        self._process: Optional[multiprocessing.Process] = None
+
+    def __enter__(self) -> "StandInServer":
+        context = multiprocessing.get_context("spawn")
+        port_queue = context.Queue()
+        self._process = context.Process(target=serve, args=(self.profile, self.seed, port_queue), daemon=True)
+        self._process.start()
+        self.url = f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+
+    def _call(self, method: str, path: str) -> Dict[str, Any]:
+        import requests
+
+        response = requests.request(method, self.url + path, timeout=10)
+        response.raise_for_status()
+        return response.json()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return self._call("GET", "/__stats")
+
+    def reset(self) -> None:
+        self._call("POST", "/__reset")
+
+
+# ---------------------------------------------------------------------------
+# クライアント側（パイプラインの接続先をスタンドインに向ける）
+# ---------------------------------------------------------------------------
+
+def _redirect_adapter(base_url: str):
+    from requests.adapters import HTTPAdapter
+
+    class RedirectAdapter(HTTPAdapter):
+        """tweepy が固定で使う https://api.twitter.com などをスタンドインの URL に書き換える"""
+
+        def send(self, request, **kwargs):
+            for host in TWITTER_HOSTS:
+                if request.url.startswith(host):
+                    request.url = base_url + request.url[len(host):]
+                    break
+            return super().send(request, **kwargs)
+
+    return RedirectAdapter()
+
+
+def point_clients_at(base_url: str) -> None:
+    """
+    環境変数と共有クライアントをスタンドインサーバ向けに設定する
+
+    OpenAI は OPENAI_BASE_URL で、Twitter は tweepy のセッションにアダプタを差し込んで接続先を変える。
+    レート制限はサーバ側の 429 で試すため、クライアント側のトークンバケットは実質無効にする。
+    """
+    from clients import close_clients, get_twitter_clients
+    from rate_limit import DEFAULT_LIMITS, reset_limiters
+
+    os.environ["OPENAI_BASE_URL"] = base_url + "/v1"
+    os.environ["OPENAI_API_KEY"] = "bench"
+    for name in ("API_KEY", "API_SECRET", "ACCESS_TOKEN", "ACCESS_TOKEN_SECRET"):
+        os.environ["TWITTER_" + name] = "bench"
+    for endpoint in DEFAULT_LIMITS:
+        os.environ["RATE_LIMIT_" + endpoint.replace(".", "_").upper()] = "1000000/100000"
+    reset_limiters()
+    close_clients()
+
+    adapter = _redirect_adapter(base_url)
+    for client in get_twitter_clients():
+        for host in TWITTER_HOSTS:
+            client.session.mount(host, adapter)
+
+
+class RSSSampler:
+    """実行中のプロセスの RSS を一定間隔で読み、最大値を記録する"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current() -> int:
+        try:
+            with open("/proc/self/statm", "r") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            import resource
+
+            # /proc が無い環境ではプロセス全体の最大値（Linux は KB, macOS はバイト）
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == "darwin" else peak * 1024
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current())
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "RSSSampler":
+        self.peak = self.current()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def _timed(func: Callable, latencies: List[float], lock: threading.Lock) -> Callable:
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with lock:
+                latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+def _atimed(func: Callable, latencies: List[float]) -> Callable:
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+def run_sync(jobs: int, concurrency: int, latencies: List[float], options: Dict[str, Any]) -> List[Any]:
+    """main.generate_and_post_image をスレッドで concurrency 件ずつ並べて実行する"""
+    import main
+
+    post = _timed(main.generate_and_post_image, latencies, threading.Lock())
+
+    def one(i: int):
+        try:
+            return post(f"bench prompt {i}", f"bench tweet {i}", options["response_format"],
+                        stream_upload=options["stream_upload"], router=options.get("router"))
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(one, range(jobs)))
+
+
+def run_async(jobs: int, concurrency: int, latencies: List[float], options: Dict[str, Any]) -> List[Any]:
+    """main.run_generate_and_post_jobs（非同期エンジン）で実行する"""
+    import asyncio
+    import main
+
+    original = main.agenerate_and_post_image
+    main.agenerate_and_post_image = _atimed(original, latencies)
+    try:
+        return asyncio.run(main.run_generate_and_post_jobs(
+            [(f"bench prompt {i}", f"bench tweet {i}") for i in range(jobs)],
+            max_concurrency=concurrency,
+            response_format=options["response_format"],
+            stream_upload=options["stream_upload"],
+            router=options.get("router"),
+        ))
+    finally:
+        main.agenerate_and_post_image = original
+
+
+def run_local_batch(jobs: int, concurrency: int, latencies: List[float], options: Dict[str, Any]) -> List[Any]:
+    """local_test.run_batch（生成して保存するだけのバッチ）で実行する"""
+    import local_test
+
+    original = local_test.generate_and_save_image
+    local_test.generate_and_save_image = _timed(original, latencies, threading.Lock())
+    try:
+        with tempfile.TemporaryDirectory() as output_dir:
+            tasks = ((f"bench{i}", f"bench prompt {i}") for i in range(jobs))
+            return [
+                filename if filename is not None else RuntimeError("failed")
+                for _, filename in local_test.run_batch(
+                    tasks, max_in_flight=concurrency, output_dir=output_dir, router=options.get("router")
+                )
+            ]
+    finally:
+        local_test.generate_and_save_image = original
+
+
+MODES: Dict[str, Callable[[int, int, List[float], Dict[str, Any]], List[Any]]] = {
+    "sync": run_sync,
+    "async": run_async,
+    "batch": run_local_batch,
+}
+
+
+def run_scenario(server: StandInServer, mode: str, jobs: int, concurrency: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    from rate_limit import reset_limiters
+    from model_router import ModelRouter
+
+    server.reset()
+    reset_limiters()
+    # ルーターの統計はシナリオごとに空から始める（ファイルには保存しない）
+    hedge_quantile = options.get("hedge_quantile")
+    if hedge_quantile is not None:
+        options = {**options, "router": ModelRouter(None, hedge_quantile=hedge_quantile)}
+    latencies: List[float] = []
+    with RSSSampler() as rss, open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        results = MODES[mode](jobs, concurrency, latencies, options)
+        elapsed = time.perf_counter() - start
+
+    requests_by_endpoint = server.stats()
+    failures = [r for r in results if isinstance(r, BaseException)]
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "jobs": jobs,
+        "succeeded": jobs - len(failures),
+        "failed": len(failures),
+        "errors": sorted({f"{type(e).__name__}: {e}"[:200] for e in failures}),
+        "elapsed_s": round(elapsed, 3),
+        "jobs_per_sec": round(jobs / elapsed, 3) if elapsed else None,
+        "latency_ms": {
+            name: round(value * 1000, 1) if value is not None else None
+            for name, value in (
+                ("p50", percentile(latencies, 50)),
+                ("p95", percentile(latencies, 95)),
+                ("p99", percentile(latencies, 99)),
+                ("max", max(latencies) if latencies else None),
+            )
+        },
+        "peak_rss_mb": round(rss.peak / 1024 / 1024, 1),
+        "requests": requests_by_endpoint,
+        # エラー応答の数 = クライアント側で再試行または失敗した回数
+        "retries": {
+            endpoint: sum(n for status, n in counts.items() if not status.startswith("2") and status not in ("INIT", "APPEND"))
+            for endpoint, counts in requests_by_endpoint.items()
+        },
+    }
+
+
+def run_benchmark(
+    modes: List[str],
+    concurrency_levels: List[int],
+    jobs: int,
+    profile: Optional[Dict[str, Any]] = None,
+    seed: int = 0,
+    response_format: str = "url",
+    stream_upload: bool = False,
+    hedge_quantile: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    スタンドインサーバを起動し、モード × 同時実行数ごとに計測した結果を返す関数
+    """
+    options = {"response_format": response_format, "stream_upload": stream_upload, "hedge_quantile": hedge_quantile}
+    with StandInServer(profile, seed) as server:
+        point_clients_at(server.url)
+        results = [
+            run_scenario(server, mode, jobs, concurrency, options)
+            for mode in modes
+            for concurrency in concurrency_levels
+        ]
+    return {
+        "python": sys.version.split()[0],
+        "options": options,
+        "profile": server.profile,
+        "seed": seed,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ローカルのスタンドインサーバに対するエンドツーエンドのベンチマーク")
+    parser.add_argument("--modes", default="sync,async,batch", help=f"カンマ区切り（{', '.join(MODES)}）")
+    parser.add_argument("--concurrency", default="1,4,16", help="カンマ区切りの同時実行数")
+    parser.add_argument("--jobs", type=int, default=32, help="シナリオごとのジョブ数")
+    parser.add_argument("--profile", help="DEFAULT_PROFILE を上書きする JSON ファイル")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--response-format", choices=("url", "b64_json"), default="url")
+    parser.add_argument("--stream-upload", action="store_true")
+    parser.add_argument("--hedge-quantile", type=float, help="指定するとこの分位点を超えた生成リクエストをヘッジする")
+    parser.add_argument("--output", help="結果の JSON の保存先（省略時は標準出力）")
+    args = parser.parse_args()
+
+    profile = None
+    if args.profile:
+        with open(args.profile, "r", encoding="utf-8") as f:
+            profile = json.load(f)
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"未知のモードです: {sorted(unknown)}")
+
+    report = run_benchmark(
+        modes,
+        [int(c) for c in args.concurrency.split(",")],
+        args.jobs,
+        profile,
+        args.seed,
+        args.response_format,
+        args.stream_upload,
+        args.hedge_quantile,
+    )
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
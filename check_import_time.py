@@ -0,0 +1,118 @@
+import os
+import re
+import sys
+import shlex
+import argparse
+import subprocess
+from typing import Dict, List, Set, Tuple
+
+# モジュールごとの import 時間の上限（ミリ秒）。CI の遅いマシンでも通る程度に余裕を持たせている
+DEFAULT_BUDGETS_MS: Dict[str, float] = {
+    "main": 200,
+    "generate_prompt": 80,
+    "config": 50,
+    # スクリプトとして起動した場合（__main__ の引数解析まで）。フラグで無効な機能のモジュールは読み込まない
+    "main.py --help": 200,
+}
+
+# 起動時に読み込んではいけない重いモジュール（実際に使う段階で読み込む）
+HEAVY_MODULES: Tuple[str, ...] = ("openai", "pydantic", "tweepy", "httpx", "requests", "numpy", "PIL")
+# プロンプトの組み立てと設定の検証は SDK も YAML パーサも使わずに読み込めること
+FORBIDDEN_IMPORTS: Dict[str, Tuple[str, ...]] = {
+    "main": HEAVY_MODULES,
+    "generate_prompt": HEAVY_MODULES + ("yaml",),
+    "config": HEAVY_MODULES + ("yaml",),
+    "main.py --help": HEAVY_MODULES,
+}
+
+_LINE = re.compile(r"^import time:\s*(\d+) \|\s*(\d+) \| ( *)(\S+)$")
+
+
+def is_script(target: str) -> bool:
+    """"main.py --help" のようにスクリプトと引数で指定されたかどうか"""
+    return target.split()[0].endswith(".py")
+
+
+def _importtime(args: List[str], python: str) -> List[Tuple[int, str, str]]:
+    result = subprocess.run(
+        [python, "-X", "importtime", *args],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True,
+    )
+    lines = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            _, total_us, indent, name = match.groups()
+            lines.append((int(total_us), indent, name))
+    if not lines:
+        raise RuntimeError(f"{' '.join(args)} の import 時間を取得できませんでした:\n{result.stderr}")
+    return lines
+
+
+def measure(target: str, python: str = sys.executable) -> Tuple[float, Set[str]]:
+    """
+    python -X importtime で target を読み込み、(累積 import 時間[ms], 読み込まれたモジュール名) を返す
+
+    target がモジュール名なら -c "import target" の target 自体の累積時間を、
+    "main.py --help" のようなスクリプトなら起動時（site など）以外に読み込んだ最上位モジュールの合計を返す。
+    """
+    if not is_script(target):
+        lines = _importtime(["-c", f"import {target}"], python)
+        cumulative = [total for total, indent, name in lines if name == target and not indent]
+        if not cumulative:
+            raise RuntimeError(f"{target} の import 時間を取得できませんでした")
+        return cumulative[0] / 1000, {name for _, _, name in lines}
+
+    startup = {name for _, _, name in _importtime(["-c", "pass"], python)}
+    lines = _importtime(shlex.split(target), python)
+    total = sum(total for total, indent, name in lines if not indent and name not in startup)
+    return total / 1000, {name for _, _, name in lines}
+
+
+def heavy_imports(module: str, imported: Set[str]) -> List[str]:
+    forbidden = FORBIDDEN_IMPORTS.get(module, HEAVY_MODULES)
+    return sorted(name for name in imported if name.split(".")[0] in forbidden)
+
+
+def check(budgets: Dict[str, float], repeat: int = 5) -> bool:
+    """
+    各モジュールを repeat 回ずつ計測し、最小値が予算内か・重いモジュールを読み込んでいないかを調べる
+    """
+    ok = True
+    print(f"{'module':<20} {'min ms':>8} {'max ms':>8} {'budget':>8}  result")
+    for module, budget in budgets.items():
+        timings = []
+        imported: Set[str] = set()
+        for _ in range(repeat):
+            elapsed, imported = measure(module)
+            timings.append(elapsed)
+        heavy = heavy_imports(module, imported)
+        passed = min(timings) <= budget and not heavy
+        ok = ok and passed
+        print(f"{module:<20} {min(timings):>8.1f} {max(timings):>8.1f} {budget:>8.0f}  {'OK' if passed else 'NG'}")
+        if heavy:
+            print(f"    起動時に読み込まれた重いモジュール: {', '.join(heavy[:10])}")
+    return ok
+
+
+def _parse_budget(value: str) -> Tuple[str, float]:
+    module, _, ms = value.partition("=")
+    if not ms:
+        raise argparse.ArgumentTypeError("module=ミリ秒 の形式で指定してください")
+    return module, float(ms)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="エントリポイントの import 時間が予算内かを調べる")
+    parser.add_argument("--budget", type=_parse_budget, action="append", default=[],
+                        help="module=ミリ秒（複数指定可）。既定: " +
+                        ", ".join(f"{m}={b:.0f}" for m, b in DEFAULT_BUDGETS_MS.items()))
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    budgets = dict(DEFAULT_BUDGETS_MS)
+    budgets.update(args.budget)
+    sys.exit(0 if check(budgets, args.repeat) else 1)
@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import os
+import atexit
+import threading
+from typing import TYPE_CHECKING, Any, Dict, NamedTuple, Optional, Tuple
+
+# httpx / requests / SDK は使う段階になってから import する（起動時間の短縮）
+if TYPE_CHECKING:
+    import httpx
+    import requests
+
+# 接続プールの既定サイズ（ホストごとのキープアライブ接続数）。HTTP_POOL_SIZE で変更できる
+DEFAULT_POOL_SIZE = 10
+# OpenAI SDK 内部のリトライは無効にする。429 / 5xx の再試行は rate_limit.call_with_retry が
+# トークンバケットと Retry-After を見ながら行うので、SDK でも再試行すると試行回数が掛け算になる
+OPENAI_MAX_RETRIES = 0
+
+
+class TwitterCredentials(NamedTuple):
+    """
+    Twitter の認証情報一式（複数アカウント運用時のクライアント共有キーにもなる）
+    """
+    api_key: Optional[str]
+    api_secret: Optional[str]
+    access_token: Optional[str]
+    access_token_secret: Optional[str]
+
+    @classmethod
+    def from_env(cls, prefix: str = "TWITTER_") -> "TwitterCredentials":
+        """
+        環境変数から認証情報を読み込む
+
+        prefix="TWITTER_" なら TWITTER_API_KEY, TWITTER_API_SECRET,
+        TWITTER_ACCESS_TOKEN, TWITTER_ACCESS_TOKEN_SECRET を読む
+        """
+        return cls(
+            os.getenv(f"{prefix}API_KEY"),
+            os.getenv(f"{prefix}API_SECRET"),
+            os.getenv(f"{prefix}ACCESS_TOKEN"),
+            os.getenv(f"{prefix}ACCESS_TOKEN_SECRET"),
+        )
+
+
+class TwitterAccount(NamedTuple):
+    """
+    投稿先のアカウント（プリセットの accounts から作る。認証情報は環境変数から読む）
+    """
+    name: str
+    credentials: TwitterCredentials
+    user_id: Optional[str] = None
+    tweet_text: Optional[str] = None
+
+    @classmethod
+    def from_config(
+        cls,
+        name: str,
+        env_prefix: Optional[str] = None,
+        user_id: Optional[str] = None,
+        tweet_text: Optional[str] = None,
+    ) -> "TwitterAccount":
+        """
+        config.get_preset() の accounts の要素 (name, env_prefix, user_id, tweet_text) から作る
+
+        env_prefix を省略した場合は TWITTER_<NAME>_（silver なら TWITTER_SILVER_API_KEY など）を読む
+        """
+        if env_prefix is None:
+            env_prefix = f"TWITTER_{name.upper().replace('-', '_')}_"
+        return cls(name, TwitterCredentials.from_env(env_prefix), user_id, tweet_text)
+
+    def resolve_user_id(self) -> Optional[str]:
+        """
+        アカウントのユーザーID（media_upload の additional_owners に使う）
+
+        設定に無い場合は、アクセストークンの先頭の "<ユーザーID>-" から取り出す
+        """
+        if self.user_id:
+            return self.user_id
+        token = self.credentials.access_token or ""
+        prefix, _, _ = token.partition("-")
+        return prefix if prefix.isdigit() else None
+
+
+class ClientRegistry:
+    """
+    OpenAI / tweepy / HTTP セッションをプロセス内で使い回すためのレジストリ
+
+    各クライアントは最初に要求されたときに作成し、キープアライブの接続プールを共有する。
+    OpenAI は API キーごと、tweepy は認証情報ごとに1組ずつ保持する。
+    全メソッドはスレッドセーフで、close() で全クライアントの接続を閉じる。
+
+    Parameters:
+    ----------
+    pool_size : int, optional
+        ホストごとの最大接続数。省略時は環境変数 HTTP_POOL_SIZE（なければ DEFAULT_POOL_SIZE）
+    """
+
+    def __init__(self, pool_size: Optional[int] = None):
+        if pool_size is None:
+            pool_size = int(os.getenv("HTTP_POOL_SIZE", DEFAULT_POOL_SIZE))
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._openai: Dict[Optional[str], Any] = {}
+        self._twitter: Dict[TwitterCredentials, Tuple[Any, Any]] = {}
+        self._session: Optional[requests.Session] = None
+
+    def httpx_limits(self) -> httpx.Limits:
+        """httpx クライアント用の接続プール設定（非同期クライアントを作る側でも使う）"""
+        import httpx
+
+        return httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+
+    def _mount_pool(self, session: requests.Session) -> requests.Session:
+        from requests.adapters import HTTPAdapter
+
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def openai(self, api_key: Optional[str] = None):
+        """API キーごとに共有する OpenAI クライアントを返す"""
+        from openai import OpenAI, DefaultHttpxClient
+
+        api_key = api_key or os.getenv("OPENAI_API_KEY")
+        with self._lock:
+            client = self._openai.get(api_key)
+            if client is None:
+                client = OpenAI(
+                    api_key=api_key,
+                    max_retries=OPENAI_MAX_RETRIES,
+                    http_client=DefaultHttpxClient(limits=self.httpx_limits()),
+                )
+                self._openai[api_key] = client
+            return client
+
+    def http_session(self) -> requests.Session:
+        """画像ダウンロードなどに使う共有 requests.Session を返す"""
+        import requests
+
+        with self._lock:
+            if self._session is None:
+                self._session = self._mount_pool(requests.Session())
+            return self._session
+
+    def twitter(self, credentials: Optional[TwitterCredentials] = None) -> Tuple[Any, Any]:
+        """認証情報ごとに共有する (tweepy.API, tweepy.Client) を返す"""
+        import tweepy
+
+        credentials = credentials or TwitterCredentials.from_env()
+        with self._lock:
+            clients = self._twitter.get(credentials)
+            if clients is None:
+                auth = tweepy.OAuth1UserHandler(
+                    credentials.api_key,
+                    credentials.api_secret,
+                    credentials.access_token,
+                    credentials.access_token_secret,
+                )
+                api_v1 = tweepy.API(auth)
+                client_v2 = tweepy.Client(
+                    consumer_key=credentials.api_key,
+                    consumer_secret=credentials.api_secret,
+                    access_token=credentials.access_token,
+                    access_token_secret=credentials.access_token_secret,
+                )
+                # tweepy は内部で requests.Session を持つので、そこに接続プールの設定を入れる
+                self._mount_pool(api_v1.session)
+                self._mount_pool(client_v2.session)
+                clients = (api_v1, client_v2)
+                self._twitter[credentials] = clients
+            return clients
+
+    def close(self) -> None:
+        """保持している全クライアントの接続を閉じる"""
+        with self._lock:
+            for client in self._openai.values():
+                client.close()
+            for api_v1, client_v2 in self._twitter.values():
+                api_v1.session.close()
+                client_v2.session.close()
+            if self._session is not None:
+                self._session.close()
+            self._openai.clear()
+            self._twitter.clear()
+            self._session = None
+
+
+_registry: Optional[ClientRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> ClientRegistry:
+    """
+    プロセス共通の ClientRegistry を返す関数（初回呼び出し時に作成し、終了時に自動で閉じる）
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ClientRegistry()
+            atexit.register(_registry.close)
+        return _registry
+
+
+def get_openai_client(api_key: Optional[str] = None):
+    return get_registry().openai(api_key)
+
+
+def get_http_session() -> requests.Session:
+    return get_registry().http_session()
+
+
+def get_twitter_clients(credentials: Optional[TwitterCredentials] = None) -> Tuple[Any, Any]:
+    return get_registry().twitter(credentials)
+
+
+def close_clients() -> None:
+    """共有クライアントを閉じる（次に要求されたときは作り直される）"""
+    with _registry_lock:
+        if _registry is not None:
+            _registry.close()
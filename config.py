@@ -1,41 +1,302 @@
 import os
-import yaml
-from typing import Optional, Dict, Any
+import threading
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, Mapping, Tuple
 
+DEFAULT_CONFIG_PATH = 'prompt_config.yaml'
+DEFAULT_PRESET = 'default'
 
-def load_config_from_yaml() -> Dict[str, Any]:
+# プリセットに書けるキー（プロンプト属性以外）
+PRESET_KEYS = ('prompt', 'tweet_text', 'extends', 'variations', 'models', 'accounts')
+
+# accounts の要素に書けるキー
+ACCOUNT_KEYS = ('name', 'env_prefix', 'user_id', 'tweet_text')
+
+
+class ConfigError(ValueError):
+    """設定ファイルの内容が不正な場合の例外"""
+
+
+def _config_path(config_path: Optional[str] = None) -> str:
+    # 環境変数から設定ファイルのパスを取得（指定がなければデフォルト）
+    return config_path or os.environ.get('PROMPT_CONFIG_PATH', DEFAULT_CONFIG_PATH)
+
+
+def _parse_yaml(config_path: str) -> Any:
+    # yaml は設定を読むときだけ import する。C 実装のローダーがあればそちらを使う
+    import yaml
+
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(config_path, 'r', encoding='utf-8') as file:
+        try:
+            return yaml.load(file, Loader=loader)
+        except yaml.YAMLError as e:
+            raise ConfigError(f"{config_path}: YAMLの構文エラーです: {e}") from e
+
+
+def _prompt_defaults() -> Dict[str, str]:
+    from generate_prompt import PROMPT_DEFAULTS
+
+    return PROMPT_DEFAULTS
+
+
+def validate_config(raw: Any, source: str = DEFAULT_CONFIG_PATH) -> None:
+    """
+    設定ファイルの構造を検証する関数（不正な場合は ConfigError）
+
+    - トップレベルはプリセット名をキーにした辞書
+    - 各プリセットは prompt（属性名→文字列）, tweet_text（文字列）, extends（継承元のプリセット名）,
+      variations（属性名→候補のリスト。候補は文字列か {value, weight}）,
+      models（画像生成に使ってよいモデルのリスト。要素はモデル名か {model, size, quality}）,
+      accounts（同じ画像を投稿するアカウントのリスト。要素はアカウント名か {name, env_prefix, user_id, tweet_text}）のみ
+    - prompt / variations の属性名は generate_image_prompt の引数名のいずれか
+    """
+    if not isinstance(raw, dict) or not raw:
+        raise ConfigError(f"{source}: プリセットの辞書が必要です")
+    attributes = _prompt_defaults()
+    for name, preset in raw.items():
+        where = f"{source}: プリセット '{name}'"
+        if preset is None:
+            continue
+        if not isinstance(preset, dict):
+            raise ConfigError(f"{where} は辞書である必要があります")
+        unknown = set(preset) - set(PRESET_KEYS)
+        if unknown:
+            raise ConfigError(f"{where} に未知のキーがあります: {sorted(unknown)}")
+        prompt = preset.get('prompt') or {}
+        if not isinstance(prompt, dict):
+            raise ConfigError(f"{where} の prompt は辞書である必要があります")
+        for key, value in prompt.items():
+            if key not in attributes:
+                raise ConfigError(f"{where} の prompt に未知の属性があります: {key}")
+            if not isinstance(value, str):
+                raise ConfigError(f"{where} の prompt.{key} は文字列である必要があります")
+        variations = preset.get('variations') or {}
+        if not isinstance(variations, dict):
+            raise ConfigError(f"{where} の variations は辞書である必要があります")
+        for key, choices in variations.items():
+            if key not in attributes:
+                raise ConfigError(f"{where} の variations に未知の属性があります: {key}")
+            if not isinstance(choices, list) or not choices:
+                raise ConfigError(f"{where} の variations.{key} は空でないリストである必要があります")
+            for choice in choices:
+                if isinstance(choice, str):
+                    continue
+                if (
+                    not isinstance(choice, dict)
+                    or not isinstance(choice.get('value'), str)
+                    or not isinstance(choice.get('weight', 1), (int, float))
+                    or choice.get('weight', 1) <= 0
+                ):
+                    raise ConfigError(
+                        f"{where} の variations.{key} の候補は文字列か {{value: 文字列, weight: 正の数}} です"
+                    )
+        models = preset.get('models')
+        if models is not None:
+            if not isinstance(models, list) or not models:
+                raise ConfigError(f"{where} の models は空でないリストである必要があります")
+            for model in models:
+                if isinstance(model, str):
+                    continue
+                if (
+                    not isinstance(model, dict)
+                    or not isinstance(model.get('model'), str)
+                    or set(model) - {'model', 'size', 'quality'}
+                    or not all(isinstance(model.get(key, ''), str) for key in ('size', 'quality'))
+                ):
+                    raise ConfigError(
+                        f"{where} の models の要素はモデル名か {{model: 文字列, size: 文字列, quality: 文字列}} です"
+                    )
+        accounts = preset.get('accounts')
+        if accounts is not None:
+            if not isinstance(accounts, list) or not accounts:
+                raise ConfigError(f"{where} の accounts は空でないリストである必要があります")
+            names = []
+            for account in accounts:
+                if isinstance(account, dict):
+                    if (
+                        not isinstance(account.get('name'), str)
+                        or set(account) - set(ACCOUNT_KEYS)
+                        or not all(isinstance(value, str) for value in account.values())
+                    ):
+                        raise ConfigError(
+                            f"{where} の accounts の要素はアカウント名か "
+                            f"{{name, env_prefix, user_id, tweet_text}}（いずれも文字列）です"
+                        )
+                    names.append(account['name'])
+                elif isinstance(account, str):
+                    names.append(account)
+                else:
+                    raise ConfigError(f"{where} の accounts の要素はアカウント名か {{name: 文字列, ...}} です")
+            if len(set(names)) != len(names):
+                raise ConfigError(f"{where} の accounts に同じアカウント名が複数あります")
+        if 'tweet_text' in preset and not isinstance(preset['tweet_text'], str):
+            raise ConfigError(f"{where} の tweet_text は文字列である必要があります")
+        parent = preset.get('extends')
+        if parent is not None and parent not in raw:
+            raise ConfigError(f"{where} の継承元 '{parent}' が存在しません")
+
+
+def _resolve(raw: Dict[str, Any], name: str, source: str) -> Dict[str, Any]:
+    # 継承チェーンを default 側から順に重ねる（default ← extends ← ... ← プリセット自身）
+    chain: List[str] = []
+    current: Optional[str] = name
+    while current is not None:
+        if current in chain:
+            raise ConfigError(f"{source}: プリセットの継承が循環しています: {' -> '.join(chain + [current])}")
+        chain.append(current)
+        current = (raw.get(current) or {}).get('extends')
+    if DEFAULT_PRESET in raw and DEFAULT_PRESET not in chain:
+        chain.append(DEFAULT_PRESET)
+
+    prompt = dict(_prompt_defaults())
+    variations: Dict[str, Tuple[Tuple[str, float], ...]] = {}
+    resolved: Dict[str, Any] = {}
+    for preset_name in reversed(chain):
+        preset = raw.get(preset_name) or {}
+        prompt.update(preset.get('prompt') or {})
+        for key, choices in (preset.get('variations') or {}).items():
+            variations[key] = tuple(
+                (choice, 1.0) if isinstance(choice, str) else (choice['value'], float(choice.get('weight', 1)))
+                for choice in choices
+            )
+        if 'tweet_text' in preset:
+            resolved['tweet_text'] = preset['tweet_text']
+        if preset.get('models'):
+            # 継承先で指定した場合はリストごと置き換える
+            resolved['models'] = tuple(
+                (model, None, None) if isinstance(model, str)
+                else (model['model'], model.get('size'), model.get('quality'))
+                for model in preset['models']
+            )
+        if preset.get('accounts'):
+            # models と同じく継承先で指定した場合はリストごと置き換える
+            resolved['accounts'] = tuple(
+                (account, None, None, None) if isinstance(account, str)
+                else tuple(account.get(key) for key in ACCOUNT_KEYS)
+                for account in preset['accounts']
+            )
+
+    if 'tweet_text' not in resolved:
+        raise ConfigError(f"{source}: プリセット '{name}' に tweet_text がありません")
+    resolved['prompt'] = MappingProxyType(prompt)
+    resolved['variations'] = MappingProxyType(variations)
+    return resolved
+
+
+def compile_config(raw: Any, source: str = DEFAULT_CONFIG_PATH) -> Dict[str, Mapping[str, Any]]:
+    """
+    設定を検証し、全プリセットを継承解決済みの読み取り専用辞書にする関数
+
+    名前が '_' で始まるプリセットは継承元専用で、直接は選べない
+    """
+    validate_config(raw, source)
+    return {
+        name: MappingProxyType(_resolve(raw, name, source))
+        for name in raw
+        if not name.startswith('_')
+    }
+
+
+_compiled: Dict[str, Tuple[Tuple[int, int], Dict[str, Mapping[str, Any]]]] = {}
+_compiled_lock = threading.Lock()
+
+
+def get_compiled_config(config_path: Optional[str] = None) -> Dict[str, Mapping[str, Any]]:
+    """
+    コンパイル済みの全プリセットを返す関数
+
+    ファイルの更新時刻とサイズが変わっていなければキャッシュを返し、変わっていれば読み直す
+    （長時間動くプロセスでも設定の変更が反映される）。
+    ファイルが無い場合は generate_image_prompt の既定値だけの default プリセットを返す。
+    """
+    config_path = _config_path(config_path)
+    try:
+        stat = os.stat(config_path)
+    except FileNotFoundError:
+        print(f"Warning: Config file '{config_path}' not found. Using default settings.")
+        return {DEFAULT_PRESET: MappingProxyType({
+            'prompt': MappingProxyType(dict(_prompt_defaults())),
+            'tweet_text': "default tweet texts :)",
+            'variations': MappingProxyType({}),
+        })}
+
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _compiled.get(config_path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with _compiled_lock:
+        cached = _compiled.get(config_path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        compiled = compile_config(_parse_yaml(config_path), config_path)
+        _compiled[config_path] = (version, compiled)
+        return compiled
+
+
+def list_presets(config_path: Optional[str] = None) -> List[str]:
+    return list(get_compiled_config(config_path))
+
+
+def get_preset(preset_name: Optional[str] = None, config_path: Optional[str] = None) -> Mapping[str, Any]:
+    """
+    継承解決済みのプリセット（読み取り専用）を返す関数
+
+    Parameters:
+    ----------
+    preset_name : str, optional
+        プリセット名。省略時は環境変数 PROMPT_PRESET（なければ default）
+    config_path : str, optional
+        設定ファイルのパス。省略時は環境変数 PROMPT_CONFIG_PATH（なければ prompt_config.yaml）
+
+    Returns:
+    -------
+    Mapping[str, Any]
+        prompt（全属性が埋まった辞書）, tweet_text, variations（属性名→(値, 重み) のタプル）と、
+        指定があれば models（(model, size, quality) のタプル）と
+        accounts（(name, env_prefix, user_id, tweet_text) のタプル）を持つプリセット。省略した項目は None
+    """
+    if preset_name is None:
+        preset_name = os.environ.get('PROMPT_PRESET', DEFAULT_PRESET)
+    compiled = get_compiled_config(config_path)
+    try:
+        return compiled[preset_name]
+    except KeyError:
+        raise ConfigError(f"プリセット '{preset_name}' が存在しません（選択可能: {sorted(compiled)}）") from None
+
+
+def load_config_from_yaml(preset_name: Optional[str] = None) -> Dict[str, Any]:
     """
     YAMLファイルから設定を読み込む関数
 
+    Parameters:
+    ----------
+    preset_name : str, optional
+        読み込むプリセット名。省略時は環境変数 PROMPT_PRESET（なければ default）
+
     Returns:
     -------
     Dict[str, Any]
-        読み込んだ設定
+        読み込んだ設定（default と generate_image_prompt の既定値を継承済み）
         yamlの型がまだ今後変わる可能性があるのでいったん Any にしておく
 
-    TODO: 中身の tweet_text や prompt のキーが無かったらエラーにする
+    Raises:
+    ------
+    ConfigError
+        設定ファイルが不正な場合、またはプリセットが存在しない場合
     """
-    # 環境変数から設定ファイルのパスを取得（指定がなければデフォルト）
-    config_path = os.environ.get('PROMPT_CONFIG_PATH', 'prompt_config.yaml')
-    
-    # 設定ファイルが存在するか確認
-    if not os.path.exists(config_path):
-        print(f"Warning: Config file '{config_path}' not found. Using default settings.")
-        return {"default": {}}
-    
-    # YAMLファイルを読み込む
+    preset = get_preset(preset_name)
+    return {'prompt': dict(preset['prompt']), 'tweet_text': preset['tweet_text']}
+
+
+if __name__ == "__main__":
+    # 設定ファイルの検証だけを行う（SDK を読み込まないのですぐ終わる）
+    import sys
+
     try:
-        with open(config_path, 'r', encoding='utf-8') as file:
-            config = yaml.safe_load(file)
-
-        # 環境変数からプリセット名を取得（指定がなければデフォルト）
-        preset_name = os.environ.get('PROMPT_PRESET', 'default')
-        preset_config = config.get(preset_name)
-
-        # 値が存在しないまたは空の場合は空の辞書を使用
-        if not preset_config:
-            raise ValueError("preset_config が空または存在しません")
-        return preset_config
-    except Exception as e:
-        print(f"Error loading config file: {e}")
-        return {"default": {}}
\ No newline at end of file
+        presets = list_presets(sys.argv[1] if len(sys.argv) > 1 else None)
+    except ConfigError as e:
+        print(f"設定エラー: {e}")
+        sys.exit(1)
+    print(f"OK: {', '.join(presets)}")
@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import signal
+import threading
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from metrics import bind_labels, get_metrics, write_from_env
+from policy_retry import CircuitOpenError
+
+# tweet-image.yaml の cron と同じ既定の投稿時刻（UTC）
+DEFAULT_SCHEDULE = "0 */6 * * *"
+DEFAULT_BUFFER_DIR = ".jobs/buffer"
+# プリセットごとに用意しておく画像の数
+DEFAULT_BUFFER_SIZE = 2
+# バッファを補充する生成の最短間隔（秒）。生成を散らしてレート制限に当たらないようにする
+DEFAULT_GENERATE_INTERVAL = 60
+# 補充の生成に失敗したときに同じプリセットを再び試すまでの秒数
+DEFAULT_RETRY_DELAY = 5 * 60
+
+_CRON_FIELDS = (("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 6))
+
+
+def _parse_cron_field(expr: str, low: int, high: int) -> Set[int]:
+    # 曜日は 0-7 を受け付ける（0 と 7 が日曜日）
+    upper = 7 if (low, high) == (0, 6) else high
+    values: Set[int] = set()
+    for part in expr.split(","):
+        body, _, step = part.partition("/")
+        if body == "*":
+            start, end = low, upper
+        elif "-" in body:
+            start, end = (int(v) for v in body.split("-", 1))
+        else:
+            start = int(body)
+            end = upper if step else start
+        if start < low or end > upper or start > end or int(step or 1) < 1:
+            raise ValueError(f"cron の値 {part} が範囲 {low}-{upper} の外です")
+        values.update(range(start, end + 1, int(step or 1)))
+    return {v % 7 for v in values} if upper != high else values
+
+
+class CronSchedule:
+    """
+    cron 形式（分 時 日 月 曜日）の投稿時刻
+
+    *, */n, a-b, a-b/n, カンマ区切りに対応する。GitHub Actions の schedule と同じく既定では UTC で評価する。
+
+    Parameters:
+    ----------
+    expr : str
+        "0 */6 * * *" のような cron 式
+    tz : datetime.tzinfo, optional
+        評価するタイムゾーン（既定は UTC）
+    """
+
+    def __init__(self, expr: str = DEFAULT_SCHEDULE, tz=timezone.utc):
+        parts = expr.split()
+        if len(parts) != len(_CRON_FIELDS):
+            raise ValueError(f"cron 式は5つの項目が必要です: {expr}")
+        self.expr = expr
+        self.tz = tz
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            _parse_cron_field(part, low, high) for part, (_, low, high) in zip(parts, _CRON_FIELDS)
+        )
+        # 日と曜日の両方を指定した場合は、cron と同じくどちらかに一致すればよい
+        self._any_day = parts[2] == "*" or parts[4] == "*"
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day = moment.day in self.days
+        weekday = (moment.isoweekday() % 7) in self.weekdays
+        return (day and weekday) if self._any_day else (day or weekday)
+
+    def next_after(self, moment: datetime) -> datetime:
+        """moment より後で最初の投稿時刻を返す"""
+        moment = moment.astimezone(self.tz).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"cron 式 {self.expr} に一致する時刻がありません")
+
+
+class ReadyImage(NamedTuple):
+    prompt: str
+    tweet_text: str
+    data: bytes
+    created_at: float
+
+
+class ImageBuffer:
+    """
+    プリセットごとの生成済み画像のバッファ（先に入れたものから取り出す）
+
+    directory を指定すると画像をファイルにも保存し、デーモンを再起動しても生成済みの画像を使える。
+    take() で取り出して投稿中の画像も、投稿が終わるまでは1枠として数える。
+
+    Parameters:
+    ----------
+    capacity : int
+        ためておく画像の上限
+    directory : str, optional
+        保存先のディレクトリ
+    """
+
+    def __init__(self, capacity: int = DEFAULT_BUFFER_SIZE, directory: Optional[str] = None):
+        self.capacity = capacity
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._items: List[Tuple[Optional[str], ReadyImage]] = []
+        # take() で取り出して、まだ投稿が終わっていない画像の数
+        self._taken = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            # メタデータ（.json）は画像の後に書くので、.json があるものだけが完全な画像
+            for name in sorted(os.listdir(directory)):
+                if not name.endswith(".json"):
+                    continue
+                stem = os.path.join(directory, name[:-len(".json")])
+                try:
+                    with open(stem + ".json", "r", encoding="utf-8") as f:
+                        meta = json.load(f)
+                    with open(stem + ".png", "rb") as f:
+                        data = f.read()
+                except (OSError, ValueError):
+                    continue
+                self._items.append((stem, ReadyImage(meta["prompt"], meta["tweet_text"], data, meta["created_at"])))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items) + self._taken
+
+    def is_full(self) -> bool:
+        return len(self) >= self.capacity
+
+    def put(self, image: ReadyImage) -> None:
+        stem = None
+        if self.directory:
+            stem = os.path.join(self.directory, f"{time.time_ns()}")
+            with open(stem + ".png", "wb") as f:
+                f.write(image.data)
+            with open(stem + ".json.tmp", "w", encoding="utf-8") as f:
+                json.dump({"prompt": image.prompt, "tweet_text": image.tweet_text, "created_at": image.created_at}, f)
+            os.replace(stem + ".json.tmp", stem + ".json")
+        with self._lock:
+            self._items.append((stem, image))
+
+    @contextmanager
+    def take(self) -> Iterator[Optional[ReadyImage]]:
+        """
+        最も古い画像を取り出す（空なら None）
+
+        with ブロックが正常に終わったら画像のファイルを削除し、例外で終わった場合は
+        画像をバッファの先頭に戻す（投稿に失敗しても生成済みの画像を失わない）。
+        with ブロックの間も画像の枠は空けないので、戻したときに容量を超えることはない。
+        """
+        with self._lock:
+            entry = self._items.pop(0) if self._items else None
+            if entry is not None:
+                self._taken += 1
+        if entry is None:
+            yield None
+            return
+        stem, image = entry
+        try:
+            yield image
+        except BaseException:
+            with self._lock:
+                self._taken -= 1
+                self._items.insert(0, entry)
+            raise
+        with self._lock:
+            self._taken -= 1
+        if stem:
+            for suffix in (".json", ".png"):
+                try:
+                    os.remove(stem + suffix)
+                except FileNotFoundError:
+                    pass
+
+
+class PostingDaemon:
+    """
+    画像を先に生成してバッファにため、決まった時刻にバッファから投稿する常駐プロセス
+
+    補充スレッドは最もバッファの少ないプリセットから1枚ずつ生成し、生成の間隔を
+    generate_interval 秒以上空ける。全プリセットのバッファが満杯のときは、投稿で空きが
+    できるまで生成しない（バックプレッシャー）。投稿時刻にはバッファの画像をアップロード
+    するだけなので、投稿の遅れが画像生成の待ち時間に左右されない。バッファが空のときは
+    その場で生成して投稿する。
+    stop() か SIGTERM / SIGINT で、実行中の生成と投稿が終わるのを待ってから止まる。
+
+    Parameters:
+    ----------
+    presets : List[str]
+        投稿するプリセット
+    build_job : Callable[[str], Tuple[str, str]]
+        プリセット名から (prompt, tweet_text) を作る関数
+    generate : Callable[[str, str], bytes]
+        (prompt, preset) から画像データを生成する関数
+    post : Callable[..., str]
+        post(prompt, tweet_text, preset=..., image_bytes=...) で投稿しツイートIDを返す関数。
+        image_bytes が None の場合は画像の生成から行う
+    schedule : CronSchedule
+        投稿時刻
+    buffer_size : int
+        プリセットごとにためておく画像の数
+    buffer_dir : str, optional
+        バッファの保存先（プリセットごとのサブディレクトリを作る）。None の場合はメモリのみ
+    generate_interval : float
+        補充の生成の最短間隔（秒）
+    retry_delay : float
+        補充の生成に失敗したプリセットを再び補充するまでの秒数
+    is_paused : Callable[[str], bool], optional
+        True を返すプリセットは補充しない（サーキットブレーカーが開いている場合など）
+    """
+
+    def __init__(
+        self,
+        presets: List[str],
+        build_job: Callable[[str], Tuple[str, str]],
+        generate: Callable[[str, str], bytes],
+        post: Callable[..., str],
+        schedule: Optional[CronSchedule] = None,
+        buffer_size: int = DEFAULT_BUFFER_SIZE,
+        buffer_dir: Optional[str] = DEFAULT_BUFFER_DIR,
+        generate_interval: float = DEFAULT_GENERATE_INTERVAL,
+        retry_delay: float = DEFAULT_RETRY_DELAY,
+        is_paused: Optional[Callable[[str], bool]] = None,
+    ):
+        if not presets:
+            raise ValueError("プリセットを1つ以上指定してください。")
+        self.presets = presets
+        self.build_job = build_job
+        self.generate = generate
+        self.post = post
+        self.schedule = schedule or CronSchedule()
+        self.generate_interval = generate_interval
+        self.retry_delay = retry_delay
+        self.is_paused = is_paused or (lambda preset: False)
+        self.buffers: Dict[str, ImageBuffer] = {
+            preset: ImageBuffer(buffer_size, os.path.join(buffer_dir, preset) if buffer_dir else None)
+            for preset in presets
+        }
+        self._stop = threading.Event()
+        self._changed = threading.Condition()
+        self._not_before: Dict[str, float] = {}
+        self._refiller: Optional[threading.Thread] = None
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop.is_set()
+
+    def stop(self, *_) -> None:
+        """停止を指示する（シグナルハンドラとしても使える）"""
+        if not self._stop.is_set():
+            print("停止します。実行中の生成と投稿が終わるのを待っています...")
+        self._stop.set()
+        with self._changed:
+            self._changed.notify_all()
+
+    def _next_preset(self) -> Optional[str]:
+        # 空きがあり、止めていないプリセットのうち最もバッファの少ないもの
+        now = time.time()
+        candidates = [
+            preset for preset in self.presets
+            if not self.buffers[preset].is_full()
+            and self._not_before.get(preset, 0) <= now
+            and not self.is_paused(preset)
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda preset: len(self.buffers[preset]))
+
+    def refill_once(self, preset: str) -> bool:
+        """preset の画像を1枚生成してバッファに入れる（失敗したら retry_delay 秒はそのプリセットを補充しない）"""
+        with bind_labels(preset=preset):
+            try:
+                prompt, tweet_text = self.build_job(preset)
+                with get_metrics().stage("buffer_generate"):
+                    data = self.generate(prompt, preset)
+            except Exception as e:
+                print(f"[{preset}] バッファの補充に失敗しました: {e}")
+                self._not_before[preset] = time.time() + self.retry_delay
+                return False
+            self.buffers[preset].put(ReadyImage(prompt, tweet_text, data, time.time()))
+            get_metrics().inc("buffer_refills_total")
+        print(f"[{preset}] バッファに画像を追加しました（{len(self.buffers[preset])}/{self.buffers[preset].capacity}）")
+        return True
+
+    def _refill_loop(self) -> None:
+        while not self._stop.is_set():
+            preset = self._next_preset()
+            if preset is None:
+                # 満杯なら投稿で空きができるまで、失敗待ちなら再試行の時刻まで待つ
+                with self._changed:
+                    self._changed.wait(timeout=min(self.retry_delay, 60))
+                continue
+            started = time.monotonic()
+            self.refill_once(preset)
+            self._stop.wait(max(0.0, self.generate_interval - (time.monotonic() - started)))
+
+    def post_one(self, preset: str) -> Optional[str]:
+        """
+        バッファの画像（空ならその場で生成した画像）を投稿する
+
+        投稿に失敗したバッファの画像は削除せずにバッファの先頭に戻し、次の投稿時刻に再び使う。
+        """
+        with bind_labels(preset=preset):
+            try:
+                with self.buffers[preset].take() as image:
+                    with self._changed:
+                        self._changed.notify_all()
+                    get_metrics().inc("buffer_hits_total" if image is not None else "buffer_misses_total")
+                    if image is not None:
+                        age = time.time() - image.created_at
+                        print(f"[{preset}] バッファの画像を投稿します（{age / 60:.0f} 分前に生成）")
+                        tweet_id = self.post(image.prompt, image.tweet_text, preset=preset, image_bytes=image.data)
+                    else:
+                        print(f"[{preset}] バッファが空のため、画像を生成して投稿します。")
+                        prompt, tweet_text = self.build_job(preset)
+                        tweet_id = self.post(prompt, tweet_text, preset=preset, image_bytes=None)
+            except CircuitOpenError as e:
+                print(f"[{preset}] 投稿を見送りました: {e}")
+                return None
+            except Exception as e:
+                print(f"[{preset}] 投稿失敗: {e}")
+                return None
+        print(f"[{preset}] 投稿成功。ツイートID: {tweet_id}")
+        return tweet_id
+
+    def post_all(self) -> Dict[str, Optional[str]]:
+        """全プリセットを並行して投稿する"""
+        with ThreadPoolExecutor(max_workers=len(self.presets), thread_name_prefix="post") as executor:
+            return dict(zip(self.presets, executor.map(self.post_one, self.presets)))
+
+    def run(self, install_signal_handlers: bool = True) -> None:
+        """stop() が呼ばれるまで補充と投稿を続ける"""
+        if install_signal_handlers and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        self._refiller = threading.Thread(target=self._refill_loop, name="buffer-refill")
+        self._refiller.start()
+        try:
+            while not self._stop.is_set():
+                next_time = self.schedule.next_after(datetime.now(timezone.utc))
+                print(f"次の投稿予定: {next_time.isoformat()}")
+                while not self._stop.is_set():
+                    remaining = (next_time - datetime.now(timezone.utc)).total_seconds()
+                    if remaining <= 0:
+                        break
+                    # シグナルに素早く反応できるよう、長い待ちは区切る
+                    self._stop.wait(min(remaining, 60))
+                if self._stop.is_set():
+                    break
+                self.post_all()
+                # 常駐中も textfile collector が最新の値を読めるよう、投稿のたびに書き出す
+                write_from_env()
+        finally:
+            self.stop()
+            self._refiller.join()
+            print("デーモンを停止しました。")
@@ -1,8 +1,45 @@
-from config import load_config_from_yaml
-from typing import Optional, Dict, Any
-import yaml
+from typing import Optional, Dict, Callable, Mapping
+import inspect
+import string
 import os
 
+# プロンプトテンプレート
+PROMPT_TEMPLATE = """Please generate an image with the following characteristics.
+Art style: {art_style}
+Gender: {gender}
+Age group: {age}
+Eye color: {eye}
+Hair style/color: {hair}
+Person's pose: {pose}
+Expression: {expression}
+Gaze: {gaze}
+Clothing/decoration: {clothing}
+Composition: {composition}
+Scene or situation: {scene}
+soft, faint lines and a light color palette to create a dreamlike and fragile appearance.
+Realistic images that look like real life photos are prohibited.
+"""
+
+
+def compile_prompt_template(template: str = PROMPT_TEMPLATE) -> Callable[[Mapping[str, str]], str]:
+    """
+    テンプレートを一度だけ解析し、属性の辞書からプロンプトを作る関数を返す関数
+
+    大量のバリエーションを作るときに毎回 str.format でテンプレートを解析し直さないためのもの。
+    出力は同じ属性で generate_image_prompt を呼んだ場合と同じになる。
+    """
+    parts = []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        parts.append((literal, field))
+
+    def render(attributes: Mapping[str, str]) -> str:
+        return "".join(
+            literal if field is None else literal + str(attributes[field])
+            for literal, field in parts
+        )
+
+    return render
+
 
 def generate_image_prompt(
     art_style: Optional[str] = "The illustration is done in a anime cel-shaded style",
@@ -53,24 +90,7 @@ def generate_image_prompt(
     str
         生成されたプロンプト文章
     """
-    # プロンプトテンプレート
-    prompt_template = """Please generate an image with the following characteristics.
-Art style: {art_style}
-Gender: {gender}
-Age group: {age}
-Eye color: {eye}
-Hair style/color: {hair}
-Person's pose: {pose}
-Expression: {expression}
-Gaze: {gaze}
-Clothing/decoration: {clothing}
-Composition: {composition}
-Scene or situation: {scene}
-soft, faint lines and a light color palette to create a dreamlike and fragile appearance.
-Realistic images that look like real life photos are prohibited.
-"""
-
-    return prompt_template.format(
+    return PROMPT_TEMPLATE.format(
         art_style=art_style,
         gender=gender,
         age=age,
@@ -85,8 +105,18 @@ Realistic images that look like real life photos are prohibited.
     )
 
 
+# 各属性の既定値（設定ファイルのプリセットはこれを継承する）
+PROMPT_DEFAULTS: Dict[str, str] = {
+    name: parameter.default
+    for name, parameter in inspect.signature(generate_image_prompt).parameters.items()
+    if parameter.default is not inspect.Parameter.empty
+}
+
+
 # 使用例
 if __name__ == "__main__":
+    import yaml
+
     # サンプル設定ファイルの作成
     sample_config = {
         "default": {
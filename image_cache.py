@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+# キャッシュの利用方針
+# reuse_unposted : まだ投稿に使っていない画像だけ再利用する（投稿失敗後の再実行向け）
+# fresh          : 常に新しく生成する（結果はキャッシュに書き込む）
+# reuse          : 投稿済みかどうかに関係なく再利用する（ローカルでの動作確認向け）
+POLICY_REUSE_UNPOSTED = "reuse_unposted"
+POLICY_FRESH = "fresh"
+POLICY_REUSE = "reuse"
+CACHE_POLICIES = (POLICY_REUSE_UNPOSTED, POLICY_FRESH, POLICY_REUSE)
+
+DEFAULT_CACHE_DIR = ".image_cache"
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+
+_IMAGE_SUFFIX = ".png"
+_POSTED_SUFFIX = ".posted"
+
+
+def image_cache_key(prompt: str, model: str, size: str, quality: str) -> str:
+    """
+    プロンプトと生成パラメータから画像キャッシュのキー（SHA-256）を作る関数
+    """
+    payload = json.dumps([prompt, model, size, quality], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    """
+    生成画像をディスクに保存するコンテンツアドレス型のキャッシュ
+
+    キーは image_cache_key() で作るハッシュで、1キー1ファイルで保存する。
+    書き込みは一時ファイルからの rename で行うので、途中で落ちても壊れたファイルは残らない。
+    読み出し時に mtime を更新し、容量超過時は mtime の古い順（LRU）に、
+    max_age を過ぎたものは読み出し・書き込みのタイミングで削除する。
+
+    Parameters:
+    ----------
+    cache_dir : str
+        キャッシュディレクトリ
+    max_bytes : int
+        キャッシュ全体の上限サイズ（バイト）
+    max_age : float
+        エントリの有効期間（秒）
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        max_age: float = DEFAULT_MAX_AGE,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> "ImageCache":
+        """環境変数 IMAGE_CACHE_DIR / IMAGE_CACHE_MAX_MB / IMAGE_CACHE_MAX_AGE_HOURS から作成する"""
+        return cls(
+            cache_dir=os.getenv("IMAGE_CACHE_DIR", DEFAULT_CACHE_DIR),
+            max_bytes=int(float(os.getenv("IMAGE_CACHE_MAX_MB", DEFAULT_MAX_BYTES / 1024 / 1024)) * 1024 * 1024),
+            max_age=float(os.getenv("IMAGE_CACHE_MAX_AGE_HOURS", DEFAULT_MAX_AGE / 3600)) * 3600,
+        )
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + _IMAGE_SUFFIX)
+
+    def _posted_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + _POSTED_SUFFIX)
+
+    def is_posted(self, key: str) -> bool:
+        return os.path.exists(self._posted_path(key))
+
+    def get(self, key: str, policy: str = POLICY_REUSE_UNPOSTED) -> Optional[bytes]:
+        """
+        方針に従ってキャッシュ済みの画像を返す関数
+
+        Returns:
+        -------
+        Optional[bytes]
+            画像データ。使えるキャッシュが無い場合は None
+        """
+        if policy not in CACHE_POLICIES:
+            raise ValueError(f"未知のキャッシュ方針です: {policy}")
+        if policy == POLICY_FRESH:
+            return None
+        if policy == POLICY_REUSE_UNPOSTED and self.is_posted(key):
+            return None
+
+        path = self.path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                self._remove(key)
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            # LRU のために最終利用時刻を更新する
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def get_any(self, keys: Iterable[str], policy: str = POLICY_REUSE_UNPOSTED) -> Tuple[Optional[str], Optional[bytes]]:
+        """
+        keys の順に探し、最初に見つかったキャッシュ済みの画像を (キー, 画像データ) で返す関数
+
+        プリセットで複数のモデルを許可している場合に、そのどれかで生成済みの画像を探すのに使う。
+        使えるキャッシュが無い場合は (None, None)
+        """
+        for key in keys:
+            data = self.get(key, policy)
+            if data is not None:
+                return key, data
+        return None, None
+
+    def put(self, key: str, data: bytes) -> str:
+        """
+        画像をキャッシュに書き込み、保存先のパスを返す関数
+
+        同じキーの画像が投稿済みになっていた場合、その印は消して未投稿として扱う
+        """
+        path = self.path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if os.path.exists(self._posted_path(key)):
+            os.remove(self._posted_path(key))
+        self.evict()
+        return path
+
+    @contextmanager
+    def writer(self, key: str) -> Iterator[BinaryIO]:
+        """
+        画像を少しずつ書き込むためのファイルを返すコンテキストマネージャ
+
+        ブロックを正常に抜けたときだけキャッシュに登録し、例外のときは書きかけのファイルを捨てる
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield f
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if os.path.exists(self._posted_path(key)):
+            os.remove(self._posted_path(key))
+        self.evict()
+
+    def mark_posted(self, key: str) -> None:
+        """投稿に使った画像として印を付ける（reuse_unposted では再利用されなくなる）"""
+        with open(self._posted_path(key), "w", encoding="utf-8") as f:
+            f.write(str(time.time()))
+
+    def _remove(self, key: str) -> None:
+        for path in (self.path(key), self._posted_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(_IMAGE_SUFFIX) and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.name[:-len(_IMAGE_SUFFIX)]))
+        return entries
+
+    def evict(self) -> None:
+        """有効期限切れのエントリと、容量超過分の古いエントリを削除する"""
+        with self._lock:
+            now = time.time()
+            entries = []
+            for mtime, size, key in self._entries():
+                if now - mtime > self.max_age:
+                    self._remove(key)
+                else:
+                    entries.append((mtime, size, key))
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self._remove(key)
+                total -= size
@@ -0,0 +1,264 @@
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List, NamedTuple, Optional
+
+# ジョブの段階（この順に進む）。各ジョブには最後に完了した段階を記録する
+STAGE_PENDING = "pending"          # 登録済み・画像未取得
+STAGE_DOWNLOADED = "downloaded"    # 画像を生成・取得してディスクに保存済み
+STAGE_UPLOADED = "uploaded"        # media_upload 済み（media_id あり）
+STAGE_POSTED = "posted"            # ツイート済み（完了）
+STAGE_ABANDONED = "abandoned"      # 手動で打ち切ったジョブ
+STAGES = (STAGE_PENDING, STAGE_DOWNLOADED, STAGE_UPLOADED, STAGE_POSTED)
+
+DEFAULT_JOURNAL_PATH = ".jobs/journal.sqlite3"
+
+# Twitter の media_id はアップロードから24時間で失効するので、余裕を見て再アップロードする
+MEDIA_ID_TTL = 23 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    preset TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    tweet_text TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    image_path TEXT,
+    media_id TEXT,
+    uploaded_at REAL,
+    tweet_id TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+-- 同じプリセット・プロンプトの未完了ジョブは1件だけにする（再実行時はそれを再開する）
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_active
+    ON jobs (preset, prompt_hash) WHERE stage NOT IN ('posted', 'abandoned');
+"""
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class Job(NamedTuple):
+    id: int
+    preset: str
+    prompt_hash: str
+    prompt: str
+    tweet_text: str
+    stage: str
+    image_path: Optional[str]
+    media_id: Optional[str]
+    uploaded_at: Optional[float]
+    tweet_id: Optional[str]
+    attempts: int
+    error: Optional[str]
+    created_at: float
+    updated_at: float
+
+
+class JobJournal:
+    """
+    投稿ジョブの進捗を SQLite に記録するジャーナル
+
+    generate → download → media_upload → create_tweet の各段階が終わるたびに記録するので、
+    途中でプロセスが落ちても次回の実行で最後に完了した段階から再開できる。
+    生成した画像は image_dir に保存し、そのパスをジョブに記録する。
+    接続は操作ごとに開くため、スレッドや別プロセスから同時に使ってもよい。
+
+    Parameters:
+    ----------
+    path : str
+        SQLite データベースのパス
+    image_dir : str, optional
+        画像の保存先。省略時はデータベースと同じ場所の images ディレクトリ
+    """
+
+    def __init__(self, path: str = DEFAULT_JOURNAL_PATH, image_dir: Optional[str] = None):
+        self.path = path
+        self.image_dir = image_dir or os.path.join(os.path.dirname(path) or ".", "images")
+        self._lock = threading.Lock()
+        os.makedirs(self.image_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    @classmethod
+    def from_env(cls) -> "JobJournal":
+        """環境変数 JOB_JOURNAL_PATH から作成する"""
+        return cls(os.getenv("JOB_JOURNAL_PATH", DEFAULT_JOURNAL_PATH))
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _update(self, job_id: int, **fields) -> Job:
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(**dict(row))
+
+    def open_job(self, preset: str, prompt: str, tweet_text: str) -> Job:
+        """
+        同じプリセット・プロンプトの未完了ジョブがあればそれを、なければ新規ジョブを返す関数
+        """
+        digest = prompt_hash(prompt)
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO jobs (preset, prompt_hash, prompt, tweet_text, stage, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (preset, digest, prompt, tweet_text, STAGE_PENDING, now, now),
+            )
+            conn.execute(
+                "UPDATE jobs SET attempts = attempts + 1, tweet_text = ?, updated_at = ?"
+                " WHERE preset = ? AND prompt_hash = ? AND stage NOT IN (?, ?)",
+                (tweet_text, now, preset, digest, STAGE_POSTED, STAGE_ABANDONED),
+            )
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE preset = ? AND prompt_hash = ? AND stage NOT IN (?, ?)",
+                (preset, digest, STAGE_POSTED, STAGE_ABANDONED),
+            ).fetchone()
+        return Job(**dict(row))
+
+    def get(self, job_id: int) -> Optional[Job]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(**dict(row)) if row else None
+
+    def list_jobs(self, include_finished: bool = False) -> List[Job]:
+        """ジョブの一覧を返す（既定では未完了のものだけ）"""
+        query = "SELECT * FROM jobs"
+        params = ()
+        if not include_finished:
+            query += " WHERE stage NOT IN (?, ?)"
+            params = (STAGE_POSTED, STAGE_ABANDONED)
+        with self._connect() as conn:
+            rows = conn.execute(query + " ORDER BY id", params).fetchall()
+        return [Job(**dict(row)) for row in rows]
+
+    def record_image(self, job: Job, data: bytes) -> Job:
+        """画像を保存して downloaded 段階に進める"""
+        path = os.path.join(self.image_dir, f"job_{job.id}.png")
+        fd, tmp_path = tempfile.mkstemp(dir=self.image_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return self._update(job.id, stage=STAGE_DOWNLOADED, image_path=path, error=None)
+
+    def load_image(self, job: Job) -> Optional[bytes]:
+        """記録済みの画像を読み込む（まだ無い、またはファイルが消えている場合は None）"""
+        if job.image_path is None or job.stage not in (STAGE_DOWNLOADED, STAGE_UPLOADED):
+            return None
+        try:
+            with open(job.image_path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def record_upload(self, job: Job, media_id) -> Job:
+        return self._update(
+            job.id, stage=STAGE_UPLOADED, media_id=str(media_id), uploaded_at=time.time(), error=None
+        )
+
+    def reusable_media_id(self, job: Job) -> Optional[str]:
+        """アップロード済みで、まだ失効していない media_id を返す"""
+        if job.stage != STAGE_UPLOADED or job.media_id is None or job.uploaded_at is None:
+            return None
+        if time.time() - job.uploaded_at > MEDIA_ID_TTL:
+            return None
+        return job.media_id
+
+    def record_posted(self, job: Job, tweet_id) -> Job:
+        """ツイート完了を記録し、不要になった画像ファイルを削除する"""
+        if job.image_path and os.path.exists(job.image_path):
+            os.remove(job.image_path)
+        return self._update(job.id, stage=STAGE_POSTED, tweet_id=str(tweet_id), error=None)
+
+    def record_error(self, job: Job, error: BaseException) -> Job:
+        """失敗を記録する（段階はそのままなので、次回は同じ段階から再開する）"""
+        return self._update(job.id, error=f"{type(error).__name__}: {error}")
+
+    def abandon(self, job_id: int) -> Optional[Job]:
+        """ジョブを打ち切る（再開対象から外す）"""
+        job = self.get(job_id)
+        if job is None or job.stage in (STAGE_POSTED, STAGE_ABANDONED):
+            return job
+        return self._update(job_id, stage=STAGE_ABANDONED)
+
+
+def _print_jobs(jobs: List[Job]) -> None:
+    if not jobs:
+        print("該当するジョブはありません。")
+        return
+    for job in jobs:
+        updated = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job.updated_at))
+        print(
+            f"#{job.id} preset={job.preset} stage={job.stage} attempts={job.attempts} "
+            f"media_id={job.media_id or '-'} tweet_id={job.tweet_id or '-'} updated={updated}"
+        )
+        if job.error:
+            print(f"    error: {job.error}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="投稿ジョブのジャーナルを表示・再実行する")
+    parser.add_argument("--journal", default=os.getenv("JOB_JOURNAL_PATH", DEFAULT_JOURNAL_PATH))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subparsers.add_parser("list", help="未完了のジョブを表示する")
+    list_parser.add_argument("--all", action="store_true", help="完了・打ち切り済みのジョブも表示する")
+
+    retry_parser = subparsers.add_parser("retry", help="未完了のジョブを最後に完了した段階から再実行する")
+    retry_parser.add_argument("job_ids", nargs="*", type=int, help="省略時は未完了のジョブすべて")
+
+    abandon_parser = subparsers.add_parser("abandon", help="ジョブを打ち切る")
+    abandon_parser.add_argument("job_ids", nargs="+", type=int)
+
+    args = parser.parse_args(argv)
+    journal = JobJournal(args.journal)
+
+    if args.command == "list":
+        _print_jobs(journal.list_jobs(include_finished=args.all))
+        return 0
+
+    if args.command == "abandon":
+        for job_id in args.job_ids:
+            job = journal.abandon(job_id)
+            print(f"#{job_id}: {'打ち切りました' if job else '見つかりません'}")
+        return 0
+
+    # retry は投稿処理が必要なときだけ main を読み込む
+    from main import resume_job
+
+    job_ids = args.job_ids or [job.id for job in journal.list_jobs()]
+    failed = 0
+    for job_id in job_ids:
+        try:
+            tweet_id = resume_job(journal, job_id)
+            print(f"#{job_id}: 投稿成功。ツイートID: {tweet_id}")
+        except Exception as e:
+            failed += 1
+            print(f"#{job_id}: 再実行に失敗しました: {e}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
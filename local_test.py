@@ -1,59 +1,241 @@
 import os
+import hashlib
 from openai import OpenAI
-import requests
-from datetime import datetime
 from generate_prompt import generate_image_prompt
-from config import load_config_from_yaml
-from multiprocessing import Pool, cpu_count
+from config import load_config_from_yaml, get_preset
+from prompt_variations import VariationSpace, UsedPromptLog, iter_prompts
+from clients import get_openai_client, get_http_session
+from rate_limit import call_with_retry, is_rate_limited_error, is_retryable_http_error
+from image_cache import ImageCache, image_cache_key, POLICY_FRESH
+from transcode import Transcoder
+from metrics import get_metrics, bind_labels, configure_from_env, write_from_env
+from model_router import DEFAULT_BACKEND, Backend, ModelRouter
+from output_store import OutputStore, DEFAULT_OUTPUT_DIR
+from streaming_upload import DEFAULT_TIMEOUT, READ_SIZE
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Iterable, Iterator, List, Optional, Tuple, Dict
 import time
-import random
-
-def generate_and_save_image(prompt: str, output_dir="generated_images"):
-    # OpenAI clientの初期化
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    
-    # 出力ディレクトリの作成
-    os.makedirs(output_dir, exist_ok=True)
-    
+
+def download_image(image_url: str, path: str, cache: Optional[ImageCache] = None, cache_key: str = "") -> str:
+    """
+    画像を少しずつ読みながら path に保存し、内容の SHA-256 を返す関数（画像全体をメモリに持たない）
+
+    cache を渡すと同じチャンクをキャッシュにも書き込む。途中で失敗した場合（Ctrl-C を含む）はどちらにも残らない
+    """
+    digest = hashlib.sha256()
+    part_path = path + ".part"
+    try:
+        with get_http_session().get(image_url, stream=True, timeout=DEFAULT_TIMEOUT) as image_response:
+            image_response.raise_for_status()
+            with ExitStack() as stack:
+                sinks = [stack.enter_context(open(part_path, "wb")).write, digest.update]
+                if cache is not None:
+                    sinks.append(stack.enter_context(cache.writer(cache_key)).write)
+                downloaded = 0
+                for chunk in image_response.iter_content(chunk_size=READ_SIZE):
+                    for sink in sinks:
+                        sink(chunk)
+                    downloaded += len(chunk)
+        os.replace(part_path, path)
+    except BaseException:
+        # 書きかけのファイルを出力先に残さない
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    get_metrics().inc("bytes_downloaded_total", downloaded)
+    return digest.hexdigest()
+
+
+def generate_and_save_image(
+    prompt: str,
+    output_dir=DEFAULT_OUTPUT_DIR,
+    client: Optional[OpenAI] = None,
+    cache: Optional[ImageCache] = None,
+    cache_policy: str = POLICY_FRESH,
+    transcoder: Optional[Transcoder] = None,
+    router: Optional[ModelRouter] = None,
+    backends: Optional[List[Backend]] = None,
+    preset: str = "default",
+    store: Optional[OutputStore] = None,
+    job_key: Optional[str] = None,
+):
+    """
+    画像を生成して出力ストアに保存し、保存先のパスを返す関数（失敗した場合は例外を送出する）
+
+    保存先は画像の内容のハッシュで決まるのでファイル名が衝突せず、
+    manifest にプリセット・プロンプト・モデル・所要時間を記録する（output_store.py を参照）。
+    store を省略した場合は output_dir のストアを使う。
+    job_key を渡すと、同じ job_key で保存済みの場合は生成せずにその保存先を返す（work_queue のワーカー用）。
+    """
+    metrics = get_metrics()
+    # OpenAI clientの取得（プロセス内で共有される接続プール付きクライアント）
+    if client is None:
+        client = get_openai_client()
+    if store is None:
+        store = OutputStore(output_dir)
+
+    tmp_path = None
+    try:
+        # キューの同じジョブを別のワーカーが保存済みなら何もしない
+        delivered = store.find_job(job_key) if job_key is not None else None
+        if delivered is not None:
+            print(f"保存済みのジョブです: {delivered.path}")
+            return delivered.path
+
+        # 同じプロンプトを許可されたモデルのどれかで生成済みなら生成をスキップする
+        # （キャッシュはモデル・サイズ・品質ごとに分かれるので、manifest にはその画像のモデルを記録する）
+        candidates = (backends or [DEFAULT_BACKEND]) if router is not None else [DEFAULT_BACKEND]
+        cache_keys = {image_cache_key(prompt, *backend): backend for backend in candidates}
+        cache_key, image_bytes = cache.get_any(cache_keys, cache_policy) if cache is not None else (None, None)
+        backend = cache_keys.get(cache_key, DEFAULT_BACKEND)
+        timings: Dict[str, float] = {}
+
+        if image_bytes is None:
+            # 画像生成リクエスト（プロセス共通のレート制限を通し、429 はサーバ指定の時間待って再試行）
+            answered: List[Backend] = []
+
+            def request(backend: Backend):
+                response = call_with_retry(
+                    "images.generate",
+                    client.images.generate,
+                    is_retryable=is_rate_limited_error,
+                    model=backend.model,
+                    prompt=prompt,
+                    size=backend.size,
+                    quality=backend.quality,
+                    n=1,
+                    timeout=1000
+                )
+                answered.append(backend)
+                return response
+
+            # router を渡した場合はプリセットで許可されたモデルから速く安定したものを選ぶ
+            start = time.perf_counter()
+            with metrics.stage("generate"):
+                if router is None:
+                    response = request(DEFAULT_BACKEND)
+                else:
+                    response = router.call(candidates, request)
+            timings["generate_seconds"] = time.perf_counter() - start
+            # ヘッジした場合は先に返った方。キャッシュには実際に生成したバックエンドのキーで保存する
+            backend = answered[0]
+            cache_key = image_cache_key(prompt, *backend)
+
+            # 画像URLの取得
+            image_url = response.data[0].url
+
+            # 画像のダウンロード（ストアの一時ファイルとキャッシュに直接書き込み、ハッシュも同時に計算する）
+            tmp_path = store.temp_path()
+            start = time.perf_counter()
+            with metrics.stage("download"):
+                sha256 = call_with_retry(
+                    "image_download", download_image, image_url, tmp_path, cache, cache_key,
+                    is_retryable=is_retryable_http_error,
+                )
+            timings["download_seconds"] = time.perf_counter() - start
+            source = "generated"
+        else:
+            print("キャッシュ済みの画像を再利用します。")
+            source = "cache"
+        record = dict(model=backend.model, size=backend.size, quality=backend.quality, **timings)
+
+        # アップロード時と同じ変換をかけて保存する（変換後のサイズと画質の確認用）
+        if transcoder is not None:
+            if image_bytes is None:
+                with open(tmp_path, "rb") as f:
+                    image_bytes = f.read()
+            start = time.perf_counter()
+            with metrics.stage("transcode"):
+                transcoded = transcoder(image_bytes)
+            record["transcode_seconds"] = time.perf_counter() - start
+            suffix = os.path.splitext(transcoded.filename)[1]
+            output = store.put(transcoded.data, preset, prompt, suffix, source, job_key, **record)
+        elif image_bytes is not None:
+            output = store.put(image_bytes, preset, prompt, source=source, job_key=job_key, **record)
+        else:
+            output = store.add_file(tmp_path, preset, prompt, sha256, source=source, job_key=job_key, **record)
+            tmp_path = None
+
+        print(f"画像を保存しました: {output.path}")
+        return output.path
+
+    finally:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def run_batch(
+    tasks: Iterable[Tuple[str, str]],
+    max_in_flight: int = 4,
+    output_dir: str = DEFAULT_OUTPUT_DIR,
+    cache: Optional[ImageCache] = None,
+    cache_policy: str = POLICY_FRESH,
+    transcoder: Optional[Transcoder] = None,
+    router: Optional[ModelRouter] = None,
+    store: Optional[OutputStore] = None,
+) -> Iterator[Tuple[str, Optional[str]]]:
+    """
+    (preset, prompt) のタスク群をスレッドプールで並列に画像生成する関数
+
+    画像生成はネットワーク待ちが大半なので CPU コア数ではなく max_in_flight で同時実行数を制限する。
+    tasks は遅延評価され、実行中のタスクが max_in_flight 件に満たないときだけ次を取り出す。
+    完了した順に (preset, 保存先ファイル名 or None) を yield する。
+    Ctrl-C（KeyboardInterrupt）で未着手のタスクをキャンセルして終了する。
+    計測を有効にしている場合は main.py と同じメトリクスにプリセットのラベル付きで記録する。
+    画像は store（省略時は output_dir のストア）に保存し、manifest にプリセットとプロンプトを記録する。
+    """
+    client = get_openai_client()
+    if store is None:
+        store = OutputStore(output_dir)
+    task_iter = iter(tasks)
+    in_flight: Dict[Future, str] = {}
+    executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="imagegen")
+
+    def run_one(preset: str, prompt: str) -> Optional[str]:
+        # ワーカースレッドには呼び出し元のラベルが引き継がれないので、ここでプリセットを付ける
+        with bind_labels(preset=preset), get_metrics().span("job"):
+            backends = router.backends_for(preset, DEFAULT_BACKEND) if router is not None else None
+            try:
+                return generate_and_save_image(
+                    prompt, output_dir, client, cache, cache_policy, transcoder, router, backends, preset, store
+                )
+            except Exception as e:
+                print(f"エラーが発生しました: {str(e)}")
+                get_metrics().inc("job_failures_total")
+                return None
+
+    def submit_next() -> bool:
+        try:
+            preset, prompt = next(task_iter)
+        except StopIteration:
+            return False
+        future = executor.submit(run_one, preset, prompt)
+        in_flight[future] = preset
+        return True
+
     try:
-        # 画像生成リクエスト
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            size="1024x1024",
-            quality="standard",
-            n=1,
-            timeout=1000
-        )
-        
-        # 画像URLの取得
-        image_url = response.data[0].url
-        
-        # 画像のダウンロード
-        image_response = requests.get(image_url)
-        
-        # ファイル名の生成（タイムスタンプ付き）
-        wait_time_ms = random.randint(0, 1000)  # 0から1000の整数を生成
-        time.sleep(wait_time_ms / 1000)  # ミリ秒を秒に変換
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
-        filename = f"{output_dir}/image_{timestamp}.png"
-        
-        # 画像の保存
-        with open(filename, "wb") as f:
-            f.write(image_response.content)
-            
-        print(f"画像を保存しました: {filename}")
-        return filename
-        
-    except Exception as e:
-        print(f"エラーが発生しました: {str(e)}")
-        return None
+        while len(in_flight) < max_in_flight and submit_next():
+            pass
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                preset = in_flight.pop(future)
+                yield preset, future.result()
+                submit_next()
+    except KeyboardInterrupt:
+        print("中断されました。未着手のタスクをキャンセルします。")
+        raise
+    finally:
+        # 実行中の生成リクエストは途中で止められないため待たずに戻る
+        executor.shutdown(wait=False, cancel_futures=True)
+
 
 if __name__ == "__main__":
     # API keyの設定
     # os.environ["OPENAI_API_KEY"] = ""
     # os.environ["PROMPT_PRESET"] = ""
-    
+
     # 画像生成 直でパラメータいじりたい時用
     # prompt = generate_image_prompt(
     #     art_style="The illustration is done in a anime cel-shaded style",
@@ -66,28 +248,60 @@ if __name__ == "__main__":
     #     scene="Cherry blossom petals are falling like a blizzard under spring sunshine"
     # )
 
-    # config読み込みと画像生成
-    config = load_config_from_yaml()
-    prompt = generate_image_prompt(**config.get("prompt"))
-    print(prompt)
-
-    num_processes: int = 4
+    # 同時実行数（CPUコア数ではなくAPIへの同時リクエスト数で制限する）
+    max_in_flight: int = int(os.getenv("MAX_IN_FLIGHT", "4"))
     num_iterations: int = 4
-    # 利用可能なCPUコア数を取得
-    available_cores = cpu_count()
-    # 要求されたプロセス数が利用可能なコア数を超えないようにする
-    num_processes = min(num_processes, available_cores)
-
-    # 並列処理で実行したい処理のリスト（例：画像生成のパラメータ）
-    tasks = [prompt] * num_iterations
-
-    # プロセスプールを作成
-    with Pool(processes=num_processes) as pool:
-        # 非同期で実行
-        results = pool.map_async(generate_and_save_image, tasks)
-        
-        # すべての処理が完了するまで待機
-        results.wait()
-        
-        # 結果を取得
-        completed_results = results.get()
+
+    # config読み込みとプロンプト生成（PROMPT_PRESETS でカンマ区切りの複数プリセットも指定可）
+    presets = [p.strip() for p in os.getenv("PROMPT_PRESETS", "").split(",") if p.strip()]
+    if not presets:
+        presets = [os.getenv("PROMPT_PRESET", "default")]
+    prompts = {}
+    for preset in presets:
+        config = load_config_from_yaml(preset)
+        prompts[preset] = generate_image_prompt(**config.get("prompt"))
+        print(f"[{preset}]\n{prompts[preset]}")
+
+    # 並列処理で実行したいタスク（プリセットとプロンプトの組）
+    tasks = ((preset, prompts[preset]) for preset in presets for _ in range(num_iterations))
+
+    # PROMPT_VARIATION_MODE（cartesian / random / lhs）を指定した場合は、プリセットの variations から
+    # 使用済みでないバリエーションを各プリセット num_iterations 件ずつ遅延生成して流す
+    variation_mode = os.getenv("PROMPT_VARIATION_MODE")
+    if variation_mode:
+        used_prompts = UsedPromptLog(os.getenv("USED_PROMPTS_PATH", "generated_images/used_prompts.txt"))
+
+        def variation_tasks():
+            for preset in presets:
+                space = VariationSpace.from_preset(get_preset(preset))
+                for variant in iter_prompts(space, variation_mode, num_iterations, used=used_prompts):
+                    used_prompts.add(variant.digest)
+                    yield preset, variant.prompt
+
+        tasks = variation_tasks()
+
+    # 生成画像のキャッシュ。同じプロンプトを num_iterations 回サンプリングするので既定は毎回生成し、
+    # IMAGE_CACHE_POLICY=reuse を指定した場合だけ同じプロンプトの画像を再利用する
+    cache = ImageCache.from_env()
+    cache_policy = os.getenv("IMAGE_CACHE_POLICY", POLICY_FRESH)
+    # IMAGE_UPLOAD_FORMAT（jpeg / webp / png）を指定した場合はアップロード用の変換後の画像を保存する
+    transcoder = Transcoder.from_env() if os.getenv("IMAGE_UPLOAD_FORMAT") else None
+    # METRICS_OUTPUT を指定すると段階ごとの所要時間とカウンタを書き出す（main.py と同じ形式）
+    configure_from_env()
+    # プリセットの models で許可されたモデルから直近で速く安定したものを選ぶ（main.py と統計を共有する）
+    router = ModelRouter.from_env()
+    # 画像は OUTPUT_DIR（既定は generated_images）にハッシュで分けて保存し、manifest に記録する
+    # （検索・書き出しは python output_store.py list / export）
+    store = OutputStore.from_env()
+
+    try:
+        completed_results = []
+        for preset, filename in run_batch(
+            tasks, max_in_flight=max_in_flight, cache=cache, cache_policy=cache_policy, transcoder=transcoder,
+            router=router, store=store,
+        ):
+            completed_results.append((preset, filename))
+    except KeyboardInterrupt:
+        print("バッチ処理を中断しました。")
+    finally:
+        write_from_env()
@@ -1,120 +1,1176 @@
-import tweepy
+from __future__ import annotations
+
 import os
-from openai import OpenAI, APIError, BadRequestError
-import requests
-from datetime import datetime
+import io
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from generate_prompt import generate_image_prompt
-from config import load_config_from_yaml
-from typing import Optional, Dict, Any
+from config import load_config_from_yaml, get_preset
+from clients import (
+    OPENAI_MAX_RETRIES,
+    TwitterAccount,
+    TwitterCredentials,
+    get_registry,
+    get_openai_client,
+    get_http_session,
+    get_twitter_clients,
+)
+from rate_limit import (
+    Backoff,
+    get_limiter,
+    retry_wait,
+    call_with_retry,
+    acall_with_retry,
+    is_retryable_http_error,
+    is_retryable_twitter_error,
+    is_rate_limited_error,
+)
+from metrics import get_metrics, bind_labels, track_job, configure_from_env, write_from_env
+from image_cache import ImageCache, image_cache_key, POLICY_REUSE_UNPOSTED
+from job_journal import Job, JobJournal, STAGE_PENDING, STAGE_POSTED
+from phash_index import DuplicateImageError, KIND_GENERATED, KIND_POSTED
+from policy_retry import PolicyRetry, PolicyRetrySession
+from model_router import DEFAULT_BACKEND, Backend, ModelRouter
+from streaming_upload import stream_image_upload
+from typing import TYPE_CHECKING, Optional, Dict, Any, Iterable, List, Tuple
 import time
-import random
+import base64
 
-def setup_twitter_clients():
-    auth = tweepy.OAuthHandler(
-        os.getenv("TWITTER_API_KEY"),
-        os.getenv("TWITTER_API_SECRET")
-    )
-    auth.set_access_token(
-        os.getenv("TWITTER_ACCESS_TOKEN"),
-        os.getenv("TWITTER_ACCESS_TOKEN_SECRET")
-    )
-    api_v1 = tweepy.API(auth)
-    client_v2 = tweepy.Client(
-        consumer_key=os.getenv("TWITTER_API_KEY"),
-        consumer_secret=os.getenv("TWITTER_API_SECRET"),
-        access_token=os.getenv("TWITTER_ACCESS_TOKEN"),
-        access_token_secret=os.getenv("TWITTER_ACCESS_TOKEN_SECRET")
-    )
-    return api_v1, client_v2
+if TYPE_CHECKING:
+    import httpx
+    import requests
+    from openai import AsyncOpenAI
+    from phash_index import PerceptualHashIndex
+    from transcode import Transcoder
+
+# 重い SDK（openai は pydantic / httpx も読み込む）や NumPy / Pillow は、その段階を実行するときに読み込む。
+# 名前 → (モジュール, 属性)。属性が None のものはモジュール自体
+_LAZY_IMPORTS = {
+    "asyncio": ("asyncio", None),
+    "AsyncOpenAI": ("openai", "AsyncOpenAI"),
+    "APIError": ("openai", "APIError"),
+    "BadRequestError": ("openai", "BadRequestError"),
+    "httpx": ("httpx", None),
+    "requests": ("requests", None),
+    "PerceptualHashIndex": ("phash_index", "PerceptualHashIndex"),
+    "Transcoder": ("transcode", "Transcoder"),
+}
+
+
+def __getattr__(name: str):
+    # PEP 562: main.AsyncOpenAI のような外部からの参照でも遅延 import する
+    try:
+        module_name, attribute = _LAZY_IMPORTS[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    module = importlib.import_module(module_name)
+    value = module if attribute is None else getattr(module, attribute)
+    globals()[name] = value
+    return value
+
+
+def _lazy(*names: str) -> Any:
+    """
+    遅延 import する名前を読み込んで返す（1つなら値、複数ならタプル）
+
+    グローバル名の参照ではモジュールの __getattr__ が呼ばれないため、呼び出し側でローカル名に束縛して使う。
+    すでにある名前（テストで差し替えたものなど）はそのまま使う。
+    """
+    values = tuple(globals()[name] if name in globals() else __getattr__(name) for name in names)
+    return values[0] if len(values) == 1 else values
+
+# b64_json で受け取った画像をメモリから渡すときのファイル名（tweepy が MIME 判定に使う）
+UPLOAD_FILENAME = "image.png"
+
+# 投稿済みの画像と類似していた場合に画像を生成し直す回数
+MAX_DUPLICATE_RETRIES = 2
+
+def setup_twitter_clients(credentials: Optional[TwitterCredentials] = None):
+    """
+    Twitter の (v1 API, v2 Client) を返す関数
+
+    クライアントはプロセス内で認証情報ごとに共有され、接続が使い回される。
+    credentials を省略した場合は環境変数 TWITTER_* の認証情報を使う。
+    """
+    return get_twitter_clients(credentials)
+
+
+def is_retryable_generation_error(e: Exception) -> bool:
+    """
+    画像生成のエラーがリトライ対象かどうかを判定する関数
+
+    BadRequestError はコンテンツポリシー違反の場合のみ、その他の APIError は常にリトライ対象
+    """
+    APIError, BadRequestError = _lazy("APIError", "BadRequestError")
+    if isinstance(e, BadRequestError):
+        # .code属性が存在し、かつそれがコンテンツポリシー違反の場合のみリトライ対象
+        return is_policy_violation(e)
+    # APIErrorはリトライ対象
+    return isinstance(e, APIError)
+
+
+def is_policy_violation(e: Exception) -> bool:
+    """
+    画像生成のエラーがコンテンツポリシー違反かどうかを判定する関数
+    """
+    BadRequestError = _lazy("BadRequestError")
+    return isinstance(e, BadRequestError) and getattr(e, 'code', None) == 'content_policy_violation'
+
+
+def is_retryable_stream_error(e: Exception) -> bool:
+    """
+    ストリーミングアップロード（ダウンロードとアップロードを同時に行う）の例外がリトライ対象かどうか
+    """
+    return is_retryable_http_error(e) or is_retryable_twitter_error(e)
+
+
+def download_image(image_url: str, timeout: float = 5) -> requests.Response:
+    """
+    画像URLから画像を取得する関数（HTTPエラーは例外にする）
+    """
+    image_response = get_http_session().get(image_url, timeout=timeout)
+    image_response.raise_for_status()
+    return image_response
+
+
+def decode_b64_image(image_response_data) -> io.BytesIO:
+    """
+    response_format="b64_json" の生成結果から画像をメモリ上のバッファに展開する関数
+    """
+    return io.BytesIO(base64.b64decode(image_response_data.data[0].b64_json))
+
+
+def find_duplicate(dedup_index: PerceptualHashIndex, image_bytes: bytes) -> Tuple[int, bool]:
+    """
+    画像の知覚ハッシュを計算し、投稿済みの類似画像があるかどうかを返す関数
+
+    Returns:
+    -------
+    Tuple[int, bool]
+        (知覚ハッシュ, 類似画像があれば True)
+    """
+    image_hash = dedup_index.hash_image(image_bytes)
+    matches = dedup_index.find_similar(image_hash)
+    if matches:
+        match = matches[0]
+        print(f"投稿済みの画像（{match.label or '-'}）と類似しています（ハミング距離 {match.distance}）。")
+    return image_hash, bool(matches)
+
+
+class DuplicateGate:
+    """
+    アップロード前に投稿済みの画像と比べ、類似していれば生成し直させる判定（同期版・非同期版・ファンアウトで共通）
+
+    check() が False を返したら呼び出し側で画像を生成し直して再び check() を呼ぶ。
+    MAX_DUPLICATE_RETRIES 回生成し直しても類似している場合は DuplicateImageError を送出する。
+    生成した画像は投稿しなくても KIND_GENERATED として記録し（他のプリセットとの比較や分析に使う）、
+    投稿後に record_posted() で KIND_POSTED として記録する。
+    """
+
+    def __init__(self, dedup_index: PerceptualHashIndex, preset: str):
+        self.dedup_index = dedup_index
+        self.preset = preset
+        self.image_hash: Optional[int] = None
+        self.retries = 0
+
+    def check(self, image_bytes: bytes, generated: bool) -> bool:
+        """画像を投稿してよければ True（生成し直す場合は False）"""
+        with get_metrics().stage("dedup"):
+            self.image_hash, duplicated = find_duplicate(self.dedup_index, image_bytes)
+        if generated:
+            self.dedup_index.add(self.image_hash, KIND_GENERATED, label=self.preset)
+        if not duplicated:
+            return True
+        if self.retries == MAX_DUPLICATE_RETRIES:
+            raise DuplicateImageError(f"{MAX_DUPLICATE_RETRIES} 回生成し直しても投稿済みの画像と類似していました。")
+        self.retries += 1
+        print(f"画像を生成し直します。({self.retries}/{MAX_DUPLICATE_RETRIES})")
+        return False
+
+    def record_posted(self, tweet_id: str) -> None:
+        self.dedup_index.add(self.image_hash, KIND_POSTED, label=f"{self.preset}:{tweet_id}")
+
+
+def resume_from_journal(
+    journal: Optional[JobJournal],
+    preset: str,
+    prompt: str,
+    tweet_text: str,
+    image_bytes: Optional[bytes] = None,
+) -> Tuple[Optional[Job], Optional[bytes], Optional[str]]:
+    """
+    ジャーナルのジョブを開き、(ジョブ, 投稿する画像, 再利用する media_id) を返す関数
+
+    同じジョブの画像が残っていればそれを、アップロード済みの有効な media_id があればそれを使う
+    （media_id を再利用できる場合は画像が無くても生成し直さない）。
+    image_bytes を渡した場合（デーモンのバッファなど）はそれを優先し、ジャーナルの別の画像や media_id は使わない。
+    """
+    if journal is None:
+        return None, image_bytes, None
+    job = journal.open_job(preset, prompt, tweet_text)
+    media_id = journal.reusable_media_id(job)
+    resumed_bytes = journal.load_image(job)
+    if image_bytes is not None and resumed_bytes != image_bytes:
+        media_id = resumed_bytes = None
+        job = journal.record_image(job, image_bytes)
+    if resumed_bytes is not None:
+        image_bytes = resumed_bytes
+        print(f"ジョブ #{job.id} を段階 {job.stage} から再開します。")
+    elif media_id is not None:
+        print(f"ジョブ #{job.id} をアップロード済みの media_id から再開します。")
+    return job, image_bytes, media_id
+
+
+def find_cached_image(
+    cache: Optional[ImageCache], cache_policy: str, prompt: str, preset: str, router: Optional[ModelRouter]
+) -> Tuple[Optional[str], Optional[bytes]]:
+    """キャッシュ済みの画像を探し、(ヒットしたキー, 画像) を返す関数（無ければ (None, None)）"""
+    if cache is None:
+        return None, None
+    cache_key, image_bytes = cache.get_any(backend_cache_keys(prompt, preset, router), cache_policy)
+    if image_bytes is not None:
+        print("キャッシュ済みの画像を再利用します。")
+    return cache_key, image_bytes
+
+
+def store_image(
+    cache: Optional[ImageCache],
+    cache_key: Optional[str],
+    journal: Optional[JobJournal],
+    job: Optional[Job],
+    image_bytes: Optional[bytes],
+    generated: bool,
+) -> Optional[Job]:
+    """
+    投稿する画像をキャッシュとジャーナルに保存し、更新したジョブを返す関数
+
+    キャッシュには新しく生成した画像だけを保存する。ジャーナルには新しく生成した画像と、
+    まだ画像を記録していないジョブの画像（キャッシュから再利用したものなど）を記録する。
+    """
+    if image_bytes is None:
+        return job
+    if generated and cache is not None:
+        cache.put(cache_key, image_bytes)
+    if job is not None and (generated or job.stage == STAGE_PENDING):
+        job = journal.record_image(job, image_bytes)
+    return job
+
+
+def record_posted(
+    tweet_id: str,
+    cache: Optional[ImageCache] = None,
+    cache_key: Optional[str] = None,
+    journal: Optional[JobJournal] = None,
+    job: Optional[Job] = None,
+    gate: Optional[DuplicateGate] = None,
+) -> None:
+    """投稿できた画像をキャッシュ・ジャーナル・類似画像のインデックスに投稿済みとして記録する関数"""
+    if cache is not None and cache_key is not None:
+        cache.mark_posted(cache_key)
+    if job is not None:
+        journal.record_posted(job, tweet_id)
+    if gate is not None and gate.image_hash is not None:
+        gate.record_posted(tweet_id)
 
 
-def generate_and_post_image(prompt, tweet_text):
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    temp_image = "temp_image.png"
+def candidate_backends(preset: str, router: Optional[ModelRouter]) -> List[Backend]:
+    """プリセットで生成に使ってよいバックエンド（router が無ければ既定のモデルのみ）"""
+    return router.backends_for(preset, DEFAULT_BACKEND) if router is not None else [DEFAULT_BACKEND]
+
+
+def backend_cache_keys(prompt: str, preset: str, router: Optional[ModelRouter]) -> List[str]:
+    """
+    画像キャッシュを探すキーの一覧（許可されたバックエンドごとに、モデル・サイズ・品質で分かれる）
+
+    生成した画像は実際に生成したバックエンドのキーで保存するので、別のモデルやサイズの画像は再利用しない。
+    """
+    return [image_cache_key(prompt, *backend) for backend in candidate_backends(preset, router)]
+
+
+def _rewrite_after_violation(session: Optional[PolicyRetrySession], e: Exception) -> Optional[str]:
+    # 同じプロンプトを送り直しても同じ理由で拒否されるので、書き換えられる場合は待たずに送り直す
+    if session is None or not is_policy_violation(e):
+        return None
+    return session.on_violation()
+
+
+def generate_image(
+    prompt: str,
+    response_format: str = "url",
+    policy: Optional[PolicyRetry] = None,
+    preset: str = "default",
+    router: Optional[ModelRouter] = None,
+):
+    """
+    画像生成APIをリトライ付きで呼び出し、(生成結果のレスポンス, 生成したバックエンド) を返す関数
+
+    content_policy_violation の BadRequestError とその他の APIError はリトライし、
+    それ以外の BadRequestError は即座に送出する。
+    policy を渡すと content_policy_violation のたびにプロンプトの属性を書き換えて待たずに再試行し、
+    ポリシー違反が続いたプリセットは API を呼ばずに CircuitOpenError にする。
+    router を渡すとプリセットの models で許可されたモデルのうち、直近で速く失敗の少ないものを使う。
+    ポリシー違反以外で失敗したモデルは、他に候補があれば次の試行で避ける。
+    """
+    APIError, BadRequestError = _lazy("APIError", "BadRequestError")
+    client = get_openai_client()
+    metrics = get_metrics()
+    backends = candidate_backends(preset, router)
+    attempted: List[Backend] = []
+    failed: List[Backend] = []
+
+    def request(backend: Backend):
+        attempted.append(backend)
+        get_limiter("images.generate").acquire()
+        with metrics.span("attempt", endpoint="images.generate", backend=backend.name):
+            # ヘッジした場合にどちらが返ったか分かるよう、バックエンドと組にして返す
+            return client.images.generate(
+                model=backend.model,
+                prompt=prompt,
+                size=backend.size,
+                quality=backend.quality,
+                n=1,
+                response_format=response_format,
+            ), backend
+
     max_retries = 3
-    retry_delay = 5
+    backoff = Backoff()
     image_response_data = None
+    session = policy.start(preset, prompt) if policy is not None else None
+    if session is not None:
+        prompt = session.prompt
 
     for attempt in range(max_retries):
         try:
             print(f"画像生成を試行中... ({attempt + 1}/{max_retries})")
-            response = client.images.generate(
-                model="dall-e-3",
-                prompt=prompt,
-                size="1024x1024",
-                quality="standard",
-                n=1,
-            )
-            image_response_data = response
+            attempted.clear()
+            if router is None:
+                image_response_data, served = request(DEFAULT_BACKEND)
+            else:
+                image_response_data, served = router.call(
+                    backends, request, exclude=failed, is_backend_error=lambda e: not is_policy_violation(e)
+                )
             print("画像生成に成功しました。")
+            if session is not None:
+                session.on_success()
             break
 
         except (APIError, BadRequestError) as e:
-            is_retryable_error = False
-            if isinstance(e, BadRequestError):
-                # .code属性が存在し、かつそれがコンテンツポリシー違反の場合のみリトライ対象
-                if hasattr(e, 'code') and e.code == 'content_policy_violation':
-                    is_retryable_error = True
-            elif isinstance(e, APIError):
-                # APIErrorはリトライ対象
-                is_retryable_error = True
-
-            if not is_retryable_error:
+            if is_policy_violation(e):
+                metrics.inc("policy_violations_total")
+            else:
+                failed.extend(attempted)
+            if not is_retryable_generation_error(e):
                 print(f"エラー: 修正不能なリクエストエラーのため処理を中止します。詳細: {e}")
                 raise
 
-            print(f"エラーが発生しました (リトライ対象): {e}")
             if attempt < max_retries - 1:
-                wait_time = retry_delay + random.uniform(0, 1)
-                print(f"{wait_time:.2f}秒待機してリトライします...")
-                time.sleep(wait_time)
-                retry_delay *= 2
+                rewritten = _rewrite_after_violation(session, e)
+                if rewritten is not None:
+                    prompt = rewritten
+                else:
+                    time.sleep(retry_wait("images.generate", attempt, e, backoff))
             else:
+                print(f"エラーが発生しました (リトライ対象): {e}")
                 print("リトライ回数の上限に達しました。")
+                if session is not None and is_policy_violation(e):
+                    session.on_failure()
                 raise
-                
+
         except Exception as e:
             print(f"予期せぬエラーが発生しました: {e}")
             raise
 
     if not image_response_data:
         raise RuntimeError("画像生成に失敗しました。")
+    return image_response_data, served
 
-    try:
+
+def fetch_image_bytes(image_response_data, response_format: str = "url") -> bytes:
+    """
+    生成結果から画像データを取り出す関数（url の場合はリトライ付きでダウンロードする）
+    """
+    metrics = get_metrics()
+    if response_format == "b64_json":
+        image_bytes = decode_b64_image(image_response_data).getvalue()
+    else:
         image_url = image_response_data.data[0].url
-        image_response = requests.get(image_url, timeout=5)
-        image_response.raise_for_status()
-        with open(temp_image, "wb") as f:
-            f.write(image_response.content)
+        with metrics.stage("download"):
+            image_bytes = call_with_retry(
+                "image_download", download_image, image_url, is_retryable=is_retryable_http_error
+            ).content
+    metrics.inc("bytes_downloaded_total", len(image_bytes))
+    return image_bytes
+
+
+def generate_image_bytes(
+    prompt: str,
+    response_format: str = "url",
+    policy: Optional[PolicyRetry] = None,
+    preset: str = "default",
+    router: Optional[ModelRouter] = None,
+) -> bytes:
+    """
+    画像を生成して画像データを返す関数（投稿はしない。デーモンのバッファ補充などに使う）
+    """
+    with get_metrics().stage("generate"):
+        image_response_data, _ = generate_image(prompt, response_format, policy, preset, router)
+    return fetch_image_bytes(image_response_data, response_format)
+
+
+@track_job
+def generate_and_post_image(
+    prompt,
+    tweet_text,
+    response_format: str = "url",
+    cache: Optional[ImageCache] = None,
+    cache_policy: str = POLICY_REUSE_UNPOSTED,
+    journal: Optional[JobJournal] = None,
+    preset: str = "default",
+    dedup_index: Optional[PerceptualHashIndex] = None,
+    transcoder: Optional[Transcoder] = None,
+    stream_upload: bool = False,
+    policy: Optional[PolicyRetry] = None,
+    image_bytes: Optional[bytes] = None,
+    router: Optional[ModelRouter] = None,
+):
+    """
+    画像を生成してツイートする関数
+
+    response_format="b64_json" の場合は生成レスポンスに含まれる画像をそのままメモリから
+    アップロードするので、画像URLへの再ダウンロードと一時ファイルが不要になる。
+    cache を渡すと生成した画像を保存し、cache_policy に従って同じプロンプトの再実行時に再利用する。
+    journal を渡すと各段階の完了を記録し、同じプリセット・プロンプトの未完了ジョブがあれば
+    最後に完了した段階から再開する（画像の再生成や再アップロードをしない）。
+    dedup_index を渡すと media_upload の前に投稿済みの画像と比べ、類似していれば
+    MAX_DUPLICATE_RETRIES 回まで生成し直す（それでも類似していれば DuplicateImageError）。
+    transcoder を渡すとアップロード前に JPEG などへ変換して小さくする（キャッシュとジャーナルには元の画像を保存する）。
+    stream_upload=True の場合、response_format="url" で新しく生成した画像はダウンロードしながら
+    チャンクアップロードに流し込み、画像全体をメモリに持たない。画像全体が必要な dedup_index /
+    transcoder と同時には使えないため、それらを渡した場合は従来どおり全体を取得してからアップロードする。
+    policy を渡すとコンテンツポリシー違反の再試行でプロンプトを書き換える（generate_image を参照）。
+    image_bytes を渡すと画像を生成せずにそれを投稿する（デーモンが先に生成しておいた画像など）。
+    ジャーナルに同じジョブの別の画像が残っている場合も、渡された画像を投稿する。
+    router を渡すとプリセットで許可されたモデルから速く安定したものを選ぶ（generate_image を参照）。
+    """
+    requests = _lazy("requests")
+    metrics = get_metrics()
+    # 同時に実行される他のジョブと一時ファイルが衝突しないよう、スレッドごとに名前を分ける
+    temp_image = f"temp_image_{threading.get_ident()}.png"
+    # キャッシュのキーはヒットしたキー、または生成したバックエンドのキー（どちらも無ければ None）
+    cache_key = None
+
+    job, image_bytes, media_id = resume_from_journal(journal, preset, prompt, tweet_text, image_bytes)
+    if image_bytes is None and media_id is None:
+        cache_key, image_bytes = find_cached_image(cache, cache_policy, prompt, preset, router)
+
+    try:
+        image_response_data = None
+        if image_bytes is None and media_id is None:
+            with metrics.stage("generate"):
+                image_response_data, backend = generate_image(prompt, response_format, policy, preset, router)
+            cache_key = image_cache_key(prompt, *backend)
+    except Exception as e:
+        if job is not None:
+            journal.record_error(job, e)
+        raise
+
+    try:
+        generated = image_response_data is not None
+        streaming = (
+            stream_upload and generated and response_format != "b64_json"
+            and dedup_index is None and transcoder is None
+        )
+        if generated and not streaming:
+            image_bytes = fetch_image_bytes(image_response_data, response_format)
+
+        # アップロード済みの media_id を再利用する場合は、投稿済み画像との比較は済んでいる
+        gate = DuplicateGate(dedup_index, preset) if dedup_index is not None and media_id is None else None
+        while gate is not None and not gate.check(image_bytes, generated):
+            with metrics.stage("generate"):
+                image_response_data, backend = generate_image(prompt, response_format, policy, preset, router)
+            cache_key = image_cache_key(prompt, *backend)
+            image_bytes = fetch_image_bytes(image_response_data, response_format)
+            generated = True
+        job = store_image(cache, cache_key, journal, job, image_bytes, generated)
+
+        image_file = None
+        upload_filename = UPLOAD_FILENAME
+        if media_id is not None:
+            pass  # アップロード済みなので画像を用意しない
+        elif streaming:
+            image_url = image_response_data.data[0].url
+        elif transcoder is not None:
+            with metrics.stage("transcode"):
+                transcoded = transcoder(image_bytes)
+            image_file = io.BytesIO(transcoded.data)
+            upload_filename = transcoded.filename
+        elif generated and response_format != "b64_json":
+            with open(temp_image, "wb") as f:
+                f.write(image_bytes)
+        else:
+            image_file = io.BytesIO(image_bytes)
 
         # Twitter APIクライアント取得
         api_v1, client_v2 = setup_twitter_clients()
 
-        # 画像アップロード（v1 API）
-        media = api_v1.media_upload(temp_image)
+        # 画像アップロード（v1 API）。ジャーナルに有効な media_id があれば再利用する
+        def upload():
+            if streaming:
+                # ダウンロードしたチャンクはそのままキャッシュにも書き込む（失敗したら捨てる）
+                if cache is None:
+                    return stream_image_upload(api_v1, image_url)
+                with cache.writer(cache_key) as f:
+                    return stream_image_upload(api_v1, image_url, sink=f.write)
+            if image_file is not None:
+                # リトライ時に先頭から読み直せるように巻き戻す
+                image_file.seek(0)
+                return api_v1.media_upload(upload_filename, file=image_file)
+            return api_v1.media_upload(temp_image)
 
-        # ツイート投稿（v2 API）
-        tweet = client_v2.create_tweet(text=tweet_text, media_ids=[media.media_id])
+        if media_id is None:
+            is_retryable = is_retryable_stream_error if streaming else is_retryable_twitter_error
+            with metrics.stage("upload"):
+                media = call_with_retry("media_upload", upload, is_retryable=is_retryable)
+            if not streaming:
+                # ストリーミング時は streaming_upload 側で送信したバイト数を記録する
+                metrics.inc("bytes_uploaded_total", len(transcoded.data) if transcoder is not None else len(image_bytes))
+            media_id = media.media_id
+            if job is not None:
+                job = journal.record_upload(job, media_id)
+
+        # ツイート投稿（v2 API）。二重投稿を避けるため 429 のときだけリトライする
+        with metrics.stage("tweet"):
+            tweet = call_with_retry(
+                "create_tweet",
+                client_v2.create_tweet,
+                text=tweet_text,
+                media_ids=[media_id],
+                is_retryable=is_rate_limited_error,
+            )
+        record_posted(tweet.data['id'], cache, cache_key, journal, job, gate)
 
         print("ツイートを投稿しました")
         return tweet.data['id']
     except requests.exceptions.RequestException as e:
         print(f"画像ダウンロード中にエラーが発生しました: {e}")
+        if job is not None:
+            journal.record_error(job, e)
         raise
     except Exception as e:
         print(f"画像ダウンロード後またはツイート投稿処理中にエラーが発生しました: {str(e)}")
+        if job is not None:
+            journal.record_error(job, e)
         raise
     finally:
         if os.path.exists(temp_image):
             os.remove(temp_image)
 
 
-if __name__ == "__main__":
+def resume_job(journal: JobJournal, job_id: int, response_format: str = "b64_json"):
+    """
+    ジャーナルに記録された未完了ジョブを、最後に完了した段階から再実行する関数
+
+    Returns:
+    -------
+    str
+        投稿したツイートID（完了済みのジョブならそのツイートID）
+    """
+    job = journal.get(job_id)
+    if job is None:
+        raise ValueError(f"ジョブ #{job_id} が見つかりません。")
+    if job.stage == STAGE_POSTED:
+        return job.tweet_id
+    return generate_and_post_image(
+        job.prompt, job.tweet_text, response_format, journal=journal, preset=job.preset
+    )
+
+
+def accounts_for(preset: str) -> List[TwitterAccount]:
+    """
+    プリセットの accounts から投稿先のアカウントを作る関数（指定が無ければ空のリスト）
+    """
+    return [TwitterAccount.from_config(*entry) for entry in get_preset(preset).get("accounts") or ()]
+
+
+def _owner_id(account: TwitterAccount, client_v2) -> str:
+    # 設定にもアクセストークンにもユーザーIDが無い場合だけ API で問い合わせる
+    user_id = account.resolve_user_id()
+    if user_id is None:
+        user_id = str(client_v2.get_me().data.id)
+    return user_id
+
+
+@track_job
+def fan_out_post_image(
+    prompt: str,
+    tweet_text: str,
+    accounts: List[TwitterAccount],
+    response_format: str = "b64_json",
+    cache: Optional[ImageCache] = None,
+    cache_policy: str = POLICY_REUSE_UNPOSTED,
+    preset: str = "default",
+    transcoder: Optional[Transcoder] = None,
+    policy: Optional[PolicyRetry] = None,
+    router: Optional[ModelRouter] = None,
+    image_bytes: Optional[bytes] = None,
+    dedup_index: Optional[PerceptualHashIndex] = None,
+) -> Dict[str, Any]:
+    """
+    1枚の画像を複数のアカウントに投稿する関数（ファンアウト）
+
+    画像の生成と media_upload は1回だけ行い、先頭のアカウントでアップロードするときに
+    残りのアカウントを additional_owners に指定してメディアを共有する。
+    create_tweet は全アカウント分を同時に呼び、失敗はアカウントごとに切り分ける
+    （1アカウントの失敗で他のアカウントの投稿は止めない）。
+    画像の生成やアップロードに失敗した場合は、どのアカウントにも投稿できないので例外を送出する。
+    dedup_index を渡すと、generate_and_post_image と同じくアップロードの前に投稿済みの画像と比べ、
+    類似していれば MAX_DUPLICATE_RETRIES 回まで生成し直す。
+
+    Returns:
+    -------
+    Dict[str, Any]
+        アカウント名 → ツイートID、または失敗時の例外
+    """
+    if not accounts:
+        raise ValueError("投稿先のアカウントがありません。")
+    metrics = get_metrics()
+    cache_key = None
+    if image_bytes is None:
+        cache_key, image_bytes = find_cached_image(cache, cache_policy, prompt, preset, router)
+
+    def generate() -> Tuple[bytes, str]:
+        with metrics.stage("generate"):
+            image_response_data, backend = generate_image(prompt, response_format, policy, preset, router)
+        return fetch_image_bytes(image_response_data, response_format), image_cache_key(prompt, *backend)
+
+    generated = image_bytes is None
+    if generated:
+        image_bytes, cache_key = generate()
+
+    # silver / gold / red をまとめて投稿するので、他のプリセットで投稿済みの画像と似ていないか確かめる
+    gate = DuplicateGate(dedup_index, preset) if dedup_index is not None else None
+    while gate is not None and not gate.check(image_bytes, generated):
+        image_bytes, cache_key = generate()
+        generated = True
+    store_image(cache, cache_key, None, None, image_bytes, generated)
+
+    upload_bytes, upload_filename = image_bytes, UPLOAD_FILENAME
+    if transcoder is not None:
+        with metrics.stage("transcode"):
+            transcoded = transcoder(image_bytes)
+        upload_bytes, upload_filename = transcoded.data, transcoded.filename
+
+    clients = {account.name: setup_twitter_clients(account.credentials) for account in accounts}
+    owner, *others = accounts
+    additional_owners = [_owner_id(account, clients[account.name][1]) for account in others]
+
+    def upload():
+        # リトライのたびに先頭から読めるよう、毎回新しいバッファを渡す
+        return clients[owner.name][0].media_upload(
+            upload_filename, file=io.BytesIO(upload_bytes), additional_owners=additional_owners or None
+        )
+
+    with metrics.stage("upload"):
+        media = call_with_retry("media_upload", upload, is_retryable=is_retryable_twitter_error)
+    metrics.inc("bytes_uploaded_total", len(upload_bytes))
+    media_id = media.media_id
+
+    def post(account: TwitterAccount) -> Any:
+        # ワーカースレッドには呼び出し元のラベルが引き継がれないので、ここでプリセットを付ける
+        with bind_labels(preset=preset):
+            try:
+                with metrics.stage("tweet", account=account.name):
+                    tweet = call_with_retry(
+                        "create_tweet",
+                        clients[account.name][1].create_tweet,
+                        text=account.tweet_text or tweet_text,
+                        media_ids=[media_id],
+                        is_retryable=is_rate_limited_error,
+                    )
+            except Exception as e:
+                metrics.inc("tweet_failures_total", account=account.name)
+                print(f"[{account.name}] ツイート投稿に失敗しました: {e}")
+                return e
+        print(f"[{account.name}] ツイートを投稿しました")
+        return tweet.data['id']
+
+    with ThreadPoolExecutor(max_workers=len(accounts), thread_name_prefix="fanout") as executor:
+        results = dict(zip((account.name for account in accounts), executor.map(post, accounts)))
+    for tweet_id in (result for result in results.values() if not isinstance(result, Exception)):
+        record_posted(tweet_id, cache, cache_key, gate=gate)
+    return results
+
+
+def run_fan_out(
+    presets: List[str],
+    response_format: str = "b64_json",
+    cache: Optional[ImageCache] = None,
+    cache_policy: str = POLICY_REUSE_UNPOSTED,
+    transcoder: Optional[Transcoder] = None,
+    policy: Optional[PolicyRetry] = None,
+    router: Optional[ModelRouter] = None,
+    dedup_index: Optional[PerceptualHashIndex] = None,
+) -> Dict[str, Any]:
+    """
+    複数のプリセットを1プロセスで同時にファンアウト投稿する関数
+
+    各プリセットの画像をそれぞれの accounts に投稿する。1プリセットの失敗で他のプリセットは止めない。
+
+    Returns:
+    -------
+    Dict[str, Any]
+        プリセット名 → fan_out_post_image の戻り値、または失敗時の例外
+    """
+    def run_one(preset: str) -> Any:
+        try:
+            accounts = accounts_for(preset)
+            if not accounts:
+                raise ValueError(f"プリセット {preset} に accounts がありません。")
+            prompt, tweet_text = build_job(preset)
+            return fan_out_post_image(
+                prompt, tweet_text, accounts, response_format, cache, cache_policy, preset, transcoder, policy, router,
+                dedup_index=dedup_index,
+            )
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(len(presets), 1), thread_name_prefix="preset") as executor:
+        return dict(zip(presets, executor.map(run_one, presets)))
+
+
+async def agenerate_image(
+    client: AsyncOpenAI,
+    prompt: str,
+    response_format: str = "url",
+    policy: Optional[PolicyRetry] = None,
+    preset: str = "default",
+    router: Optional[ModelRouter] = None,
+):
+    """
+    generate_image の asyncio 版（待機は asyncio.sleep で行う。ヘッジで負けたリクエストはキャンセルする）
+
+    (生成結果のレスポンス, 生成したバックエンド) を返す。
+    """
+    asyncio, APIError, BadRequestError = _lazy("asyncio", "APIError", "BadRequestError")
+    max_retries = 3
+    backoff = Backoff()
+    metrics = get_metrics()
+    backends = candidate_backends(preset, router)
+    attempted: List[Backend] = []
+    failed: List[Backend] = []
+
+    async def request(backend: Backend):
+        attempted.append(backend)
+        await get_limiter("images.generate").aacquire()
+        with metrics.span("attempt", endpoint="images.generate", backend=backend.name):
+            return await client.images.generate(
+                model=backend.model,
+                prompt=prompt,
+                size=backend.size,
+                quality=backend.quality,
+                n=1,
+                response_format=response_format,
+            ), backend
+
+    session = policy.start(preset, prompt) if policy is not None else None
+    if session is not None:
+        prompt = session.prompt
+
+    for attempt in range(max_retries):
+        try:
+            print(f"画像生成を試行中... ({attempt + 1}/{max_retries})")
+            attempted.clear()
+            if router is None:
+                image_response_data, served = await request(DEFAULT_BACKEND)
+            else:
+                image_response_data, served = await router.acall(
+                    backends, request, exclude=failed, is_backend_error=lambda e: not is_policy_violation(e)
+                )
+            print("画像生成に成功しました。")
+            if session is not None:
+                session.on_success()
+            return image_response_data, served
+
+        except (APIError, BadRequestError) as e:
+            if is_policy_violation(e):
+                metrics.inc("policy_violations_total")
+            else:
+                failed.extend(attempted)
+            if not is_retryable_generation_error(e):
+                print(f"エラー: 修正不能なリクエストエラーのため処理を中止します。詳細: {e}")
+                raise
+
+            if attempt < max_retries - 1:
+                rewritten = _rewrite_after_violation(session, e)
+                if rewritten is not None:
+                    prompt = rewritten
+                else:
+                    await asyncio.sleep(retry_wait("images.generate", attempt, e, backoff))
+            else:
+                print(f"エラーが発生しました (リトライ対象): {e}")
+                print("リトライ回数の上限に達しました。")
+                if session is not None and is_policy_violation(e):
+                    session.on_failure()
+                raise
+
+    raise RuntimeError("画像生成に失敗しました。")
+
+
+@track_job
+async def agenerate_and_post_image(
+    prompt: str,
+    tweet_text: str,
+    *,
+    client: Optional[AsyncOpenAI] = None,
+    http_client: Optional[httpx.AsyncClient] = None,
+    twitter_clients: Optional[Tuple[Any, Any]] = None,
+    response_format: str = "url",
+    cache: Optional[ImageCache] = None,
+    cache_policy: str = POLICY_REUSE_UNPOSTED,
+    journal: Optional[JobJournal] = None,
+    preset: str = "default",
+    dedup_index: Optional[PerceptualHashIndex] = None,
+    transcoder: Optional[Transcoder] = None,
+    stream_upload: bool = False,
+    policy: Optional[PolicyRetry] = None,
+    image_bytes: Optional[bytes] = None,
+    router: Optional[ModelRouter] = None,
+) -> str:
+    """
+    generate_and_post_image の asyncio 版
+
+    画像生成とダウンロードはイベントループ上で非同期に待ち、ブロッキングな tweepy の呼び出しは
+    スレッドに逃がすので、複数ジョブを同時に走らせると生成待ちとアップロードが重なる。
+    リトライの扱いは同期版と同じ（content_policy_violation のみリトライ、その他の BadRequestError は中止）。
+
+    Parameters:
+    ----------
+    prompt : str
+        画像生成プロンプト
+    tweet_text : str
+        ツイート本文
+    client : AsyncOpenAI, optional
+        共有する OpenAI クライアント。省略時はこの呼び出し用に作成する
+    http_client : httpx.AsyncClient, optional
+        画像ダウンロードに使う HTTP クライアント。省略時はこの呼び出し用に作成する
+    twitter_clients : tuple, optional
+        setup_twitter_clients() の戻り値。省略時はこの呼び出し用に作成する
+    response_format : str, optional
+        "b64_json" の場合は画像URLへの再ダウンロードをせずレスポンスから直接デコードする
+    cache : ImageCache, optional
+        生成画像のキャッシュ。同期版と同じく cache_policy に従って再利用する
+    cache_policy : str, optional
+        キャッシュの利用方針（image_cache.CACHE_POLICIES のいずれか）
+    journal : JobJournal, optional
+        段階ごとの進捗を記録するジャーナル。未完了ジョブがあれば続きから再開する
+    preset : str, optional
+        ジャーナルに記録するプリセット名
+    dedup_index : PerceptualHashIndex, optional
+        投稿済み画像の知覚ハッシュ。類似画像しか得られない場合は DuplicateImageError
+    transcoder : Transcoder, optional
+        アップロード前の変換。共有スレッドプールで実行するので他のジョブの通信と重なる
+    stream_upload : bool, optional
+        同期版と同じく、url 形式で生成した画像をダウンロードしながらチャンクアップロードする
+    policy : PolicyRetry, optional
+        コンテンツポリシー違反の再試行でのプロンプトの書き換えと、プリセットごとのサーキットブレーカー
+    image_bytes : bytes, optional
+        生成済みの画像。渡した場合は画像を生成せず、ジャーナルに別の画像が残っていてもこの画像を投稿する
+    router : ModelRouter, optional
+        プリセットで許可されたモデルのうち速く安定したものを選び、遅い場合はヘッジする
+
+    Returns:
+    -------
+    str
+        投稿したツイートID
+    """
+    asyncio, AsyncOpenAI, httpx = _lazy("asyncio", "AsyncOpenAI", "httpx")
+    metrics = get_metrics()
+    own_client = client is None
+    own_http_client = http_client is None
+    if own_client:
+        client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=OPENAI_MAX_RETRIES)
+    if own_http_client:
+        http_client = httpx.AsyncClient(timeout=30)
+
+    # キャッシュのキーはヒットしたキー、または生成したバックエンドのキー（どちらも無ければ None）
+    cache_key = None
+    job, image_bytes, media_id = await asyncio.to_thread(
+        resume_from_journal, journal, preset, prompt, tweet_text, image_bytes
+    )
+    if image_bytes is None and media_id is None:
+        cache_key, image_bytes = find_cached_image(cache, cache_policy, prompt, preset, router)
+
+    async def agenerate_image_bytes() -> bytes:
+        nonlocal cache_key
+        with metrics.stage("generate"):
+            image_response_data, backend = await agenerate_image(client, prompt, response_format, policy, preset, router)
+        cache_key = image_cache_key(prompt, *backend)
+        if response_format == "b64_json":
+            image_bytes = decode_b64_image(image_response_data).getvalue()
+            metrics.inc("bytes_downloaded_total", len(image_bytes))
+            return image_bytes
+        try:
+            image_url = image_response_data.data[0].url
+
+            async def download() -> httpx.Response:
+                response = await http_client.get(image_url)
+                response.raise_for_status()
+                return response
+
+            with metrics.stage("download"):
+                image_response = await acall_with_retry(
+                    "image_download", download, is_retryable=is_retryable_http_error
+                )
+            metrics.inc("bytes_downloaded_total", len(image_response.content))
+            return image_response.content
+        except httpx.HTTPError as e:
+            print(f"画像ダウンロード中にエラーが発生しました: {e}")
+            raise
+
     try:
-        config = load_config_from_yaml()
-        prompt = generate_image_prompt(**config.get("prompt"))
-        tweet_text = config.get("tweet_text", "default tweet texts :)")
-        tweet_id = generate_and_post_image(prompt, tweet_text)
-        print(f"投稿成功。ツイートID: {tweet_id}")
+        generated = image_bytes is None and media_id is None
+        streaming = (
+            stream_upload and generated and response_format != "b64_json"
+            and dedup_index is None and transcoder is None
+        )
+        if streaming:
+            with metrics.stage("generate"):
+                image_response_data, backend = await agenerate_image(client, prompt, response_format, policy, preset, router)
+            image_url = image_response_data.data[0].url
+            cache_key = image_cache_key(prompt, *backend)
+        elif generated:
+            image_bytes = await agenerate_image_bytes()
+
+        # ハッシュ計算（画像のデコード）は CPU を使うのでスレッドで行う
+        gate = DuplicateGate(dedup_index, preset) if dedup_index is not None and media_id is None else None
+        while gate is not None and not await asyncio.to_thread(gate.check, image_bytes, generated):
+            image_bytes = await agenerate_image_bytes()
+            generated = True
+        job = await asyncio.to_thread(store_image, cache, cache_key, journal, job, image_bytes, generated)
+        upload_filename = UPLOAD_FILENAME
+        if transcoder is not None and media_id is None:
+            with metrics.stage("transcode"):
+                transcoded = await transcoder.arun(image_bytes)
+            image_bytes, upload_filename = transcoded.data, transcoded.filename
+        image_file = io.BytesIO(image_bytes) if image_bytes is not None else None
+
+        if twitter_clients is None:
+            twitter_clients = setup_twitter_clients()
+        api_v1, client_v2 = twitter_clients
+
+        def upload():
+            if streaming:
+                # ダウンロードもアップロードと同じスレッドで少しずつ行う
+                if cache is None:
+                    return stream_image_upload(api_v1, image_url)
+                with cache.writer(cache_key) as f:
+                    return stream_image_upload(api_v1, image_url, sink=f.write)
+            image_file.seek(0)
+            return api_v1.media_upload(upload_filename, file=image_file)
+
+        # tweepy は同期APIなのでスレッドで実行し、イベントループを塞がない
+        if media_id is None:
+            is_retryable = is_retryable_stream_error if streaming else is_retryable_twitter_error
+            with metrics.stage("upload"):
+                media = await acall_with_retry(
+                    "media_upload", asyncio.to_thread, upload, is_retryable=is_retryable
+                )
+            if not streaming:
+                metrics.inc("bytes_uploaded_total", len(image_bytes))
+            media_id = media.media_id
+            if job is not None:
+                job = await asyncio.to_thread(journal.record_upload, job, media_id)
+        with metrics.stage("tweet"):
+            tweet = await acall_with_retry(
+                "create_tweet",
+                asyncio.to_thread,
+                client_v2.create_tweet,
+                text=tweet_text,
+                media_ids=[media_id],
+                is_retryable=is_rate_limited_error,
+            )
+        await asyncio.to_thread(record_posted, tweet.data['id'], cache, cache_key, journal, job, gate)
+
+        print("ツイートを投稿しました")
+        return tweet.data['id']
     except Exception as e:
-        print(f"\nスクリプトの実行中に致命的なエラーが発生しました。処理を終了します。")
+        if job is not None:
+            await asyncio.to_thread(journal.record_error, job, e)
+        raise
+    finally:
+        if own_http_client:
+            await http_client.aclose()
+        if own_client:
+            await client.close()
+
+
+async def run_generate_and_post_jobs(
+    jobs: Iterable[Tuple[str, ...]],
+    max_concurrency: int = 4,
+    response_format: str = "url",
+    cache: Optional[ImageCache] = None,
+    cache_policy: str = POLICY_REUSE_UNPOSTED,
+    journal: Optional[JobJournal] = None,
+    dedup_index: Optional[PerceptualHashIndex] = None,
+    transcoder: Optional[Transcoder] = None,
+    stream_upload: bool = False,
+    policy: Optional[PolicyRetry] = None,
+    router: Optional[ModelRouter] = None,
+) -> List[Any]:
+    """
+    (prompt, tweet_text) または (prompt, tweet_text, preset) のジョブ群を
+    最大 max_concurrency 件同時に実行する関数
+
+    OpenAI / HTTP / Twitter のクライアントは全ジョブで共有する。
+    1件の失敗で他のジョブは止めず、結果リストの該当位置に例外オブジェクトを入れて返す。
+
+    Returns:
+    -------
+    List[Any]
+        ジョブ順に並んだツイートID、または失敗時の例外
+    """
+    asyncio, AsyncOpenAI, httpx = _lazy("asyncio", "AsyncOpenAI", "httpx")
+    semaphore = asyncio.Semaphore(max_concurrency)
+    twitter_clients = setup_twitter_clients()
+
+    # 非同期クライアントはイベントループに紐づくため、この実行の間だけ共有する
+    limits = get_registry().httpx_limits()
+    async with AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=OPENAI_MAX_RETRIES) as client, \
+            httpx.AsyncClient(timeout=30, limits=limits) as http_client:
+
+        async def run_one(prompt: str, tweet_text: str, preset: str = "default") -> str:
+            async with semaphore:
+                return await agenerate_and_post_image(
+                    prompt,
+                    tweet_text,
+                    client=client,
+                    http_client=http_client,
+                    twitter_clients=twitter_clients,
+                    response_format=response_format,
+                    cache=cache,
+                    cache_policy=cache_policy,
+                    journal=journal,
+                    preset=preset,
+                    dedup_index=dedup_index,
+                    transcoder=transcoder,
+                    stream_upload=stream_upload,
+                    policy=policy,
+                    router=router,
+                )
+
+        return await asyncio.gather(
+            *(run_one(*job) for job in jobs),
+            return_exceptions=True,
+        )
+
+
+def build_job(preset_name: Optional[str] = None) -> Tuple[str, str]:
+    """
+    プリセットの設定から (prompt, tweet_text) を作る関数
+    """
+    config = load_config_from_yaml(preset_name)
+    prompt = generate_image_prompt(**config.get("prompt", {}))
+    tweet_text = config.get("tweet_text", "default tweet texts :)")
+    return prompt, tweet_text
+
+
+if __name__ == "__main__":
+    import argparse
+    import functools
+
+    parser = argparse.ArgumentParser(description="画像を生成して投稿する")
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="常駐して画像を先に生成しておき、DAEMON_SCHEDULE（cron 式, UTC）の時刻に投稿する",
+    )
+    parser.add_argument(
+        "--fan-out", action="store_true",
+        help="プリセットの accounts 全てに同じ画像を投稿する（media_upload は1回、create_tweet は同時に実行）",
+    )
+    args = parser.parse_args()
+
+    # METRICS_OUTPUT を指定すると段階ごとの所要時間とカウンタを JSON / Prometheus 形式で書き出す
+    configure_from_env()
+    # IMAGE_RESPONSE_FORMAT=b64_json で画像の再ダウンロードと一時ファイルを省く（既定は url で従来の動作）
+    response_format = os.getenv("IMAGE_RESPONSE_FORMAT", "url")
+    # 投稿に失敗した画像は次回の実行で再利用する（IMAGE_CACHE_POLICY=fresh で毎回生成）
+    cache = ImageCache.from_env()
+    cache_policy = os.getenv("IMAGE_CACHE_POLICY", POLICY_REUSE_UNPOSTED)
+    # 途中で失敗したジョブは次回の実行で最後に完了した段階から再開する
+    journal = JobJournal.from_env()
+    # IMAGE_STREAM_UPLOAD=1 かつ url 形式なら、類似判定・変換をせずにダウンロードしながらアップロードする
+    stream_upload = os.getenv("IMAGE_STREAM_UPLOAD") == "1"
+    dedup_index = transcoder = None
+    # 類似判定と変換は Pillow / numpy を使うので、使う場合だけ読み込む（--help やストリーミング時の起動を軽くする）
+    if not stream_upload:
+        # IMAGE_DEDUP=1 で、色違いのプリセットなどで投稿済みと似た画像になった場合は生成し直す
+        if os.getenv("IMAGE_DEDUP") == "1":
+            dedup_index = _lazy("PerceptualHashIndex").from_env()
+        # IMAGE_UPLOAD_FORMAT=jpeg / webp / png でアップロード前に変換して小さくする（既定は無変換）
+        if os.getenv("IMAGE_UPLOAD_FORMAT", "original") != "original":
+            transcoder = _lazy("Transcoder").from_env()
+    # ポリシー違反ではプロンプトを書き換えて再試行し、違反が続くプリセットはしばらく止める
+    policy = PolicyRetry.from_env()
+    # プリセットの models で許可されたモデルから直近で速く安定したものを選ぶ（IMAGE_HEDGE_QUANTILE でヘッジ）
+    router = ModelRouter.from_env()
+
+    # PROMPT_PRESETS にカンマ区切りで複数指定した場合は非同期エンジンでまとめて実行する
+    presets = [p.strip() for p in os.getenv("PROMPT_PRESETS", "").split(",") if p.strip()]
+    if args.daemon:
+        from daemon import CronSchedule, PostingDaemon, DEFAULT_BUFFER_DIR, DEFAULT_BUFFER_SIZE, \
+            DEFAULT_GENERATE_INTERVAL, DEFAULT_SCHEDULE
+
+        # 投稿時はバッファの画像をアップロードするだけなので、ストリーミングアップロードは使わない
+        PostingDaemon(
+            presets or [os.getenv("PROMPT_PRESET", "default")],
+            build_job=build_job,
+            generate=lambda prompt, preset: generate_image_bytes(prompt, response_format, policy, preset, router),
+            post=functools.partial(
+                generate_and_post_image, response_format=response_format, cache=cache, cache_policy=cache_policy,
+                journal=journal, dedup_index=dedup_index, transcoder=transcoder, policy=policy,
+                router=router,
+            ),
+            schedule=CronSchedule(os.getenv("DAEMON_SCHEDULE", DEFAULT_SCHEDULE)),
+            buffer_size=int(os.getenv("DAEMON_BUFFER_SIZE", DEFAULT_BUFFER_SIZE)),
+            buffer_dir=os.getenv("DAEMON_BUFFER_DIR", DEFAULT_BUFFER_DIR),
+            generate_interval=float(os.getenv("DAEMON_GENERATE_INTERVAL", DEFAULT_GENERATE_INTERVAL)),
+            is_paused=policy.is_open,
+        ).run()
+    elif args.fan_out:
+        presets = presets or [os.getenv("PROMPT_PRESET", "default")]
+        for preset, result in run_fan_out(
+            presets, response_format, cache, cache_policy, transcoder, policy, router, dedup_index
+        ).items():
+            if isinstance(result, Exception):
+                print(f"[{preset}] 投稿失敗: {result}")
+                continue
+            for account, tweet_id in result.items():
+                if isinstance(tweet_id, Exception):
+                    print(f"[{preset}/{account}] 投稿失敗: {tweet_id}")
+                else:
+                    print(f"[{preset}/{account}] 投稿成功。ツイートID: {tweet_id}")
+    elif presets:
+        jobs = [(*build_job(preset), preset) for preset in presets]
+        max_concurrency = int(os.getenv("MAX_CONCURRENCY", "4"))
+        results = _lazy("asyncio").run(run_generate_and_post_jobs(
+            jobs, max_concurrency, response_format, cache, cache_policy, journal, dedup_index, transcoder, stream_upload,
+            policy, router,
+        ))
+        for preset, result in zip(presets, results):
+            if isinstance(result, Exception):
+                print(f"[{preset}] 投稿失敗: {result}")
+            else:
+                print(f"[{preset}] 投稿成功。ツイートID: {result}")
+    else:
+        try:
+            preset = os.getenv("PROMPT_PRESET", "default")
+            prompt, tweet_text = build_job(preset)
+            tweet_id = generate_and_post_image(
+                prompt, tweet_text, response_format, cache, cache_policy, journal, preset, dedup_index, transcoder, stream_upload,
+                policy, router=router,
+            )
+            print(f"投稿成功。ツイートID: {tweet_id}")
+        except Exception as e:
+            print(f"\nスクリプトの実行中に致命的なエラーが発生しました。処理を終了します。")
+    write_from_env()
@@ -0,0 +1,300 @@
+import os
+import json
+import time
+import inspect
+import tempfile
+import functools
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+# メトリクス名の接頭辞（Prometheus の名前空間）
+PREFIX = "echo"
+
+# レイテンシのヒストグラムの境界（秒）。DALL-E の生成は数秒〜数十秒かかるので上側を厚くする
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+# JSON の分位点計算のために保持する観測値の上限（系列ごと）
+MAX_SAMPLES = 10000
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# bind_labels() で設定した、以降の計測すべてに付けるラベル（preset など）
+_bound_labels: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar("metrics_labels", default={})
+
+
+def _escape(value: str) -> str:
+    # Prometheus のラベル値では \ " 改行をエスケープする
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.samples: Deque[float] = deque(maxlen=MAX_SAMPLES)
+
+    def observe(self, value: float) -> None:
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+        self.samples.append(value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+class _Span:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics: "Metrics", name: str, labels: Dict[str, str]):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        elapsed = time.perf_counter() - self.start
+        self.labels["outcome"] = "ok" if exc_type is None else "error"
+        self.metrics.observe(f"{self.name}_seconds", elapsed, **self.labels)
+
+
+class Metrics:
+    """
+    段階ごとの所要時間（ヒストグラム）とカウンタを集計するレジストリ
+
+    ラベルは呼び出し時の引数と bind_labels() で設定したもの（preset など）を合わせて使う。
+    スレッドと asyncio タスクから同時に使ってよい。
+
+    Parameters:
+    ----------
+    buckets : Tuple[float, ...]
+        ヒストグラムの境界（秒）
+    """
+
+    enabled = True
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], _Histogram] = {}
+
+    @staticmethod
+    def _labels(labels: Dict[str, Any]) -> Labels:
+        merged = {**_bound_labels.get(), **labels}
+        return tuple(sorted((key, str(value)) for key, value in merged.items() if value is not None))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """カウンタ name を value 増やす"""
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """ヒストグラム name に値を1つ記録する"""
+        key = (name, self._labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.buckets)
+            histogram.observe(value)
+
+    def span(self, name: str, **labels):
+        """
+        with ブロックの所要時間を {name}_seconds に記録するコンテキストマネージャ
+
+        例外で抜けた場合は outcome="error"、それ以外は outcome="ok" のラベルを付ける
+        """
+        return _Span(self, name, labels)
+
+    def stage(self, stage: str, **labels):
+        """パイプラインの段階（generate / download / upload / tweet など）の所要時間を記録する"""
+        return _Span(self, "stage", {"stage": stage, **labels})
+
+    def snapshot(self) -> Dict[str, Any]:
+        """JSON にできる形の集計結果を返す"""
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": h.count,
+                    "sum": round(h.sum, 6),
+                    "mean": round(h.sum / h.count, 6) if h.count else None,
+                    "p50": h.quantile(0.5),
+                    "p95": h.quantile(0.95),
+                    "p99": h.quantile(0.99),
+                    "max": max(h.samples) if h.samples else None,
+                }
+                for (name, labels), h in sorted(self._histograms.items())
+            ]
+        return {"generated_at": time.time(), "counters": counters, "histograms": histograms}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+
+    def to_prometheus(self) -> str:
+        """Prometheus のテキスト形式（node_exporter の textfile collector 向け）で返す"""
+
+        def render(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+        lines: List[str] = []
+        with self._lock:
+            declared = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = f"{PREFIX}_{name}"
+                if metric not in declared:
+                    lines.append(f"# TYPE {metric} counter")
+                    declared.add(metric)
+                lines.append(f"{metric}{render(labels)} {value:g}")
+            for (name, labels), h in sorted(self._histograms.items()):
+                metric = f"{PREFIX}_{name}"
+                if metric not in declared:
+                    lines.append(f"# TYPE {metric} histogram")
+                    declared.add(metric)
+                cumulative = 0
+                for bound, count in zip(self.buckets, h.counts):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{render(labels, (('le', f'{bound:g}'),))} {cumulative}")
+                lines.append(f"{metric}_bucket{render(labels, (('le', '+Inf'),))} {h.count}")
+                lines.append(f"{metric}_sum{render(labels)} {h.sum:.6f}")
+                lines.append(f"{metric}_count{render(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        集計結果をファイルに書き出す（拡張子 .prom なら Prometheus 形式、それ以外は JSON）
+
+        textfile collector が書きかけのファイルを読まないよう、一時ファイルからの rename で置き換える
+        """
+        text = self.to_prometheus() if path.endswith(".prom") else self.to_json()
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        return None
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullMetrics(Metrics):
+    """何も記録しない Metrics（計測を無効にしたときの既定。呼び出しのコストはほぼゼロ）"""
+
+    enabled = False
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        pass
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        pass
+
+    def span(self, name: str, **labels):
+        return _NULL_SPAN
+
+    def stage(self, stage: str, **labels):
+        return _NULL_SPAN
+
+
+_metrics: Metrics = NullMetrics()
+
+
+def get_metrics() -> Metrics:
+    return _metrics
+
+
+def set_metrics(metrics: Metrics) -> Metrics:
+    """プロセス全体で使う Metrics を差し替え、以前のものを返す"""
+    global _metrics
+    previous, _metrics = _metrics, metrics
+    return previous
+
+
+def configure_from_env() -> Metrics:
+    """
+    環境変数 METRICS_OUTPUT（書き出し先。.prom なら Prometheus 形式）が設定されていれば計測を有効にする
+    """
+    if os.getenv("METRICS_OUTPUT"):
+        set_metrics(Metrics())
+    return get_metrics()
+
+
+def write_from_env() -> None:
+    """METRICS_OUTPUT が設定されていれば集計結果を書き出す"""
+    path = os.getenv("METRICS_OUTPUT")
+    if path and _metrics.enabled:
+        _metrics.write(path)
+        print(f"メトリクスを書き出しました: {path}")
+
+
+@contextmanager
+def bind_labels(**labels) -> Iterator[None]:
+    """
+    with ブロックの中の計測すべてに labels を付ける
+
+    contextvars で保持するので、asyncio のタスクや asyncio.to_thread 先にも引き継がれる
+    """
+    token = _bound_labels.set({**_bound_labels.get(), **{k: str(v) for k, v in labels.items()}})
+    try:
+        yield
+    finally:
+        _bound_labels.reset(token)
+
+
+def track_job(func: Callable) -> Callable:
+    """
+    投稿ジョブ全体を job_seconds に記録し、引数 preset をラベルとして中の計測に付けるデコレータ
+    """
+    signature = inspect.signature(func)
+    default_preset = signature.parameters["preset"].default
+
+    def preset_of(args, kwargs) -> str:
+        return signature.bind_partial(*args, **kwargs).arguments.get("preset", default_preset)
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with bind_labels(preset=preset_of(args, kwargs)), _metrics.span("job"):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with bind_labels(preset=preset_of(args, kwargs)), _metrics.span("job"):
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import atexit
+import tempfile
+import contextvars
+import threading
+from collections import deque
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, NamedTuple, Optional, Tuple, TypeVar
+
+from metrics import get_metrics
+
+T = TypeVar("T")
+
+DEFAULT_STATS_PATH = ".jobs/model_stats.json"
+# 直近何回分の結果で統計を取るか
+DEFAULT_WINDOW = 50
+# 統計を信用するのに必要な成功回数（これ未満のバックエンドは速さが分からないので先に試す）
+DEFAULT_MIN_SAMPLES = 5
+# 直近の失敗率がこれを超えたら不調とみなす
+DEFAULT_MAX_ERROR_RATE = 0.5
+# 連続してこの回数失敗したら cooldown 秒のあいだ不調とみなす
+DEFAULT_MAX_CONSECUTIVE_ERRORS = 3
+DEFAULT_COOLDOWN = 60
+# ヘッジ（2本目のリクエスト）を送ってよい割合の上限。追加の費用をこの割合までに抑える
+DEFAULT_HEDGE_BUDGET = 0.1
+# 同期版で負けた後もまだ実行中のリクエスト数の上限。これに達している間はヘッジしない
+DEFAULT_MAX_ABANDONED = 2
+# 統計ファイルを書き直す間隔の下限（秒）。残りは次の記録時か終了時に書き出す
+DEFAULT_SAVE_INTERVAL = 10
+
+
+class Backend(NamedTuple):
+    model: str
+    size: str
+    quality: str
+
+    @property
+    def name(self) -> str:
+        return f"{self.model}:{self.size}:{self.quality}"
+
+
+# 画像生成の既定のパラメータ（main.py / local_test.py もこれを使うので、キャッシュのキーとルーターの既定がずれない）
+IMAGE_MODEL = "dall-e-3"
+IMAGE_SIZE = "1024x1024"
+IMAGE_QUALITY = "standard"
+# ルーターを使わない場合、またはプリセットに models が無い場合のバックエンド
+DEFAULT_BACKEND = Backend(IMAGE_MODEL, IMAGE_SIZE, IMAGE_QUALITY)
+
+
+def backends_from_config(entries: Iterable[Tuple[str, Optional[str], Optional[str]]], default: Backend = DEFAULT_BACKEND) -> List[Backend]:
+    """
+    プリセットの models（config.py で (model, size, quality) のタプルに正規化したもの）を Backend にする
+
+    size / quality を省略したものは default の値を使う
+    """
+    return [Backend(model, size or default.size, quality or default.quality) for model, size, quality in entries]
+
+
+class _Stats:
+    def __init__(self, window: int):
+        self.results: Deque[Tuple[float, bool]] = deque(maxlen=window)
+        self.consecutive_errors = 0
+        self.unhealthy_until = 0.0
+
+    def latencies(self) -> List[float]:
+        return sorted(latency for latency, ok in self.results if ok)
+
+    def error_rate(self) -> float:
+        return sum(1 for _, ok in self.results if not ok) / len(self.results) if self.results else 0.0
+
+
+class ModelRouter:
+    """
+    画像生成のバックエンド（モデル・サイズ・品質の組）を直近の速さと失敗率で選ぶルーター
+
+    プリセットで許可されたバックエンドのうち、不調でないものを直近の成功時レイテンシの中央値が
+    短い順に試す（まだ統計の無いバックエンドは先に試して速さを測る）。
+    hedge_quantile を指定すると、1本目が直近レイテンシのその分位点を超えても返らない場合に
+    次のバックエンド（1つしか無ければ同じもの）へ2本目を送り、先に成功した方を使う。
+    ヘッジは hedge_budget の割合までしか送らない。同期版では負けたリクエストを止められないので、
+    負けた後も実行中のリクエストが max_abandoned 件ある間はヘッジしない。
+    統計は path に保存するので、cron で毎回起動する場合も前回までの結果を使える。
+    保存は save_interval 秒に1回までにまとめ、残りは終了時（または flush()）に書き出す。
+
+    Parameters:
+    ----------
+    path : str, optional
+        統計の保存先（JSON）。None の場合は保存しない
+    hedge_quantile : float, optional
+        ヘッジを送るまでの待ち時間に使う分位点（0.95 など）。None の場合はヘッジしない
+    hedge_budget : float
+        ヘッジを送ってよいリクエストの割合
+    max_abandoned : int
+        同期版で負けた後も実行中のリクエスト数の上限
+    save_interval : float
+        統計ファイルを書き直す間隔の下限（秒）
+    window, min_samples, max_error_rate, max_consecutive_errors, cooldown :
+        統計と不調判定のパラメータ（モジュール先頭の定数を参照）
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = DEFAULT_STATS_PATH,
+        hedge_quantile: Optional[float] = None,
+        hedge_budget: float = DEFAULT_HEDGE_BUDGET,
+        max_abandoned: int = DEFAULT_MAX_ABANDONED,
+        window: int = DEFAULT_WINDOW,
+        min_samples: int = DEFAULT_MIN_SAMPLES,
+        max_error_rate: float = DEFAULT_MAX_ERROR_RATE,
+        max_consecutive_errors: int = DEFAULT_MAX_CONSECUTIVE_ERRORS,
+        cooldown: float = DEFAULT_COOLDOWN,
+        save_interval: float = DEFAULT_SAVE_INTERVAL,
+    ):
+        self.path = path
+        self.hedge_quantile = hedge_quantile
+        self.hedge_budget = hedge_budget
+        self.max_abandoned = max_abandoned
+        self.window = window
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.max_consecutive_errors = max_consecutive_errors
+        self.cooldown = cooldown
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._stats: Dict[str, _Stats] = {}
+        self._requests = 0
+        self._hedges = 0
+        self._abandoned = 0
+        self._saved_at = 0.0
+        self._dirty = False
+        self._flush_registered = False
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for name, results in json.load(f).get("backends", {}).items():
+                    stats = self._stats.setdefault(name, _Stats(window))
+                    stats.results.extend((float(latency), bool(ok)) for latency, ok in results)
+
+    @classmethod
+    def from_env(cls) -> "ModelRouter":
+        """環境変数 MODEL_STATS_PATH / IMAGE_HEDGE_QUANTILE / IMAGE_HEDGE_BUDGET / IMAGE_HEDGE_MAX_ABANDONED から作成する"""
+        quantile = os.getenv("IMAGE_HEDGE_QUANTILE")
+        return cls(
+            os.getenv("MODEL_STATS_PATH", DEFAULT_STATS_PATH),
+            hedge_quantile=float(quantile) if quantile else None,
+            hedge_budget=float(os.getenv("IMAGE_HEDGE_BUDGET", DEFAULT_HEDGE_BUDGET)),
+            max_abandoned=int(os.getenv("IMAGE_HEDGE_MAX_ABANDONED", DEFAULT_MAX_ABANDONED)),
+        )
+
+    def backends_for(self, preset: str, default: Backend = DEFAULT_BACKEND) -> List[Backend]:
+        """プリセットの models で許可されたバックエンド（指定が無い・プリセットが無い場合は default のみ）"""
+        from config import ConfigError, get_preset
+
+        try:
+            entries = get_preset(preset).get("models")
+        except ConfigError:
+            entries = None
+        return backends_from_config(entries, default) if entries else [default]
+
+    def _snapshot(self) -> Dict[str, Any]:
+        # 呼び出し側で self._lock を保持していること
+        self._saved_at = time.monotonic()
+        self._dirty = False
+        return {"backends": {name: list(s.results) for name, s in self._stats.items()}}
+
+    def _write(self, snapshot: Dict[str, Any]) -> None:
+        # ファイルの書き込みは統計のロックの外で行い、書き込み同士だけを直列にする
+        with self._save_lock:
+            directory = os.path.dirname(self.path) or "."
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.path)
+
+    def flush(self) -> None:
+        """まだ保存していない統計を書き出す"""
+        with self._lock:
+            snapshot = self._snapshot() if self.path and self._dirty else None
+        if snapshot is not None:
+            self._write(snapshot)
+
+    def record(self, backend: Backend, latency: float, ok: bool) -> None:
+        """1回分の結果を記録する（統計ファイルへの保存は save_interval 秒に1回まで）"""
+        snapshot = None
+        with self._lock:
+            stats = self._stats.setdefault(backend.name, _Stats(self.window))
+            stats.results.append((round(latency, 3), ok))
+            if ok:
+                stats.consecutive_errors = 0
+            else:
+                stats.consecutive_errors += 1
+                if stats.consecutive_errors >= self.max_consecutive_errors:
+                    stats.unhealthy_until = time.time() + self.cooldown
+            if self.path:
+                self._dirty = True
+                if not self._flush_registered:
+                    self._flush_registered = True
+                    atexit.register(self.flush)
+                if time.monotonic() - self._saved_at >= self.save_interval:
+                    snapshot = self._snapshot()
+        if snapshot is not None:
+            self._write(snapshot)
+
+    def is_healthy(self, backend: Backend) -> bool:
+        with self._lock:
+            stats = self._stats.get(backend.name)
+            if stats is None:
+                return True
+            if stats.unhealthy_until > time.time():
+                return False
+            return len(stats.results) < self.min_samples or stats.error_rate() <= self.max_error_rate
+
+    def latency_quantile(self, backend: Backend, q: float) -> Optional[float]:
+        """成功したリクエストのレイテンシの分位点（成功が min_samples 回未満なら None）"""
+        with self._lock:
+            stats = self._stats.get(backend.name)
+            latencies = stats.latencies() if stats else []
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+    def rank(self, backends: List[Backend], exclude: Iterable[Backend] = ()) -> List[Backend]:
+        """試す順に並べたバックエンド（exclude と不調のものは後ろ。全部除外される場合は元の順）"""
+        excluded = set(exclude)
+
+        def key(item: Tuple[int, Backend]):
+            index, backend = item
+            median = self.latency_quantile(backend, 0.5)
+            return (backend in excluded, not self.is_healthy(backend), median or 0.0, index)
+
+        return [backend for _, backend in sorted(enumerate(backends), key=key)]
+
+    def _hedge_delay(self, backend: Backend) -> Optional[float]:
+        if self.hedge_quantile is None:
+            return None
+        with self._lock:
+            self._requests += 1
+            if self._hedges >= self.hedge_budget * self._requests or self._abandoned >= self.max_abandoned:
+                return None
+        return self.latency_quantile(backend, self.hedge_quantile)
+
+    def _reserve_hedge(self, backend: Backend) -> bool:
+        # 同時に遅くなったリクエストがまとめて予算を超えないよう、確認と計上を同じロックの中で行う
+        with self._lock:
+            if self._hedges >= self.hedge_budget * self._requests or self._abandoned >= self.max_abandoned:
+                return False
+            self._hedges += 1
+        get_metrics().inc("hedged_requests_total", backend=backend.name)
+        print(f"生成が遅いため {backend.name} にもリクエストを送ります。")
+        return True
+
+    def _abandon(self, future) -> None:
+        # 負けたリクエストは終わるまで実行中として数える
+        with self._lock:
+            self._abandoned += 1
+
+        def finished(_) -> None:
+            with self._lock:
+                self._abandoned -= 1
+
+        future.add_done_callback(finished)
+
+    def _start(self, backend: Backend, *args) -> Future:
+        # 共有のスレッドプールを使うと、その大きさで呼び出し側の同時実行数が頭打ちになり、
+        # プールの空き待ちの時間もヘッジまでの待ち時間に含まれてしまう。1リクエストに1スレッドを使う
+        future: Future = Future()
+        # ラベル（bind_labels）などの contextvars を引き継ぐ
+        context = contextvars.copy_context()
+
+        def run() -> None:
+            try:
+                future.set_result(context.run(self._timed, backend, *args))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name=f"router-{backend.name}").start()
+        return future
+
+    def _timed(self, backend: Backend, func: Callable[[Backend], T], is_backend_error: Callable[[BaseException], bool]) -> T:
+        start = time.monotonic()
+        try:
+            result = func(backend)
+        except Exception as e:
+            if is_backend_error(e):
+                self.record(backend, time.monotonic() - start, False)
+            raise
+        self.record(backend, time.monotonic() - start, True)
+        return result
+
+    def call(
+        self,
+        backends: List[Backend],
+        func: Callable[[Backend], T],
+        exclude: Iterable[Backend] = (),
+        is_backend_error: Callable[[BaseException], bool] = lambda e: True,
+    ) -> T:
+        """
+        選んだバックエンドで func(backend) を呼び、結果を記録する
+
+        is_backend_error が False を返す例外（コンテンツポリシー違反など）はバックエンドの失敗として数えない。
+        同期版のヘッジでは負けた方のリクエストを止められないため、結果を捨てる。
+        """
+        order = self.rank(backends, exclude)
+        primary = order[0]
+        delay = self._hedge_delay(primary)
+        if delay is None:
+            return self._timed(primary, func, is_backend_error)
+
+        first = self._start(primary, func, is_backend_error)
+        done, _ = wait([first], timeout=delay)
+        secondary = order[1] if len(order) > 1 else primary
+        if done or not self._reserve_hedge(secondary):
+            return first.result()
+        pending = {first, self._start(secondary, func, is_backend_error)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        self._abandon(loser)
+                    return future.result()
+        # 両方失敗した場合は1本目の例外を送出する
+        return first.result()
+
+    async def acall(
+        self,
+        backends: List[Backend],
+        func: Callable[[Backend], Awaitable[T]],
+        exclude: Iterable[Backend] = (),
+        is_backend_error: Callable[[BaseException], bool] = lambda e: True,
+    ) -> T:
+        """call の asyncio 版（func はコルーチン関数）。ヘッジで負けた方のリクエストはキャンセルする"""
+        import asyncio
+
+        async def timed(backend: Backend) -> Any:
+            start = time.monotonic()
+            try:
+                result = await func(backend)
+            except Exception as e:
+                if is_backend_error(e):
+                    self.record(backend, time.monotonic() - start, False)
+                raise
+            self.record(backend, time.monotonic() - start, True)
+            return result
+
+        order = self.rank(backends, exclude)
+        primary = order[0]
+        delay = self._hedge_delay(primary)
+        if delay is None:
+            return await timed(primary)
+
+        first = asyncio.ensure_future(timed(primary))
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+            secondary = order[1] if len(order) > 1 else primary
+            if not self._reserve_hedge(secondary):
+                return await first
+            pending.add(asyncio.ensure_future(timed(secondary)))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
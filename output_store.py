@@ -0,0 +1,358 @@
+import os
+import csv
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import IO, Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from job_journal import prompt_hash as _prompt_hash
+
+DEFAULT_OUTPUT_DIR = "generated_images"
+MANIFEST_NAME = "manifest.sqlite3"
+# ハッシュの先頭何文字でディレクトリを分けるか（256 ディレクトリ。数十万ファイルでも1ディレクトリ数千件に収まる）
+SHARD_WIDTH = 2
+EXPORT_FORMATS = ("jsonl", "csv")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sha256 TEXT NOT NULL,
+    path TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    preset TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    model TEXT,
+    size TEXT,
+    quality TEXT,
+    source TEXT NOT NULL,
+    generate_seconds REAL,
+    download_seconds REAL,
+    transcode_seconds REAL,
+    created_at REAL NOT NULL,
+    job_key TEXT
+);
+CREATE INDEX IF NOT EXISTS outputs_preset ON outputs (preset, created_at);
+CREATE INDEX IF NOT EXISTS outputs_prompt_hash ON outputs (prompt_hash);
+CREATE INDEX IF NOT EXISTS outputs_sha256 ON outputs (sha256);
+CREATE INDEX IF NOT EXISTS outputs_created_at ON outputs (created_at);
+"""
+
+# job_key 列の無い manifest にも後から作れるよう、列の追加後に別で作る
+_JOB_KEY_INDEX = """
+CREATE UNIQUE INDEX IF NOT EXISTS outputs_job_key ON outputs (job_key) WHERE job_key IS NOT NULL;
+"""
+
+# manifest に記録できる項目（record / put / add_file のキーワード引数）
+_FIELDS = ("model", "size", "quality", "generate_seconds", "download_seconds", "transcode_seconds")
+
+
+class Output(NamedTuple):
+    id: int
+    sha256: str
+    path: str
+    bytes: int
+    preset: str
+    prompt_hash: str
+    prompt: str
+    model: Optional[str]
+    size: Optional[str]
+    quality: Optional[str]
+    source: str
+    generate_seconds: Optional[float]
+    download_seconds: Optional[float]
+    transcode_seconds: Optional[float]
+    created_at: float
+    job_key: Optional[str] = None
+
+
+class OutputStore:
+    """
+    バッチ生成した画像を保存するコンテンツアドレス型のストアと、その manifest（SQLite）
+
+    画像は内容の SHA-256 をファイル名にして、先頭 SHARD_WIDTH 文字のディレクトリに分けて保存する
+    （root/ab/abcdef....png）。同じ内容の画像は1ファイルだけ保存する。
+    manifest には保存のたびに1行追記し、プリセット・プロンプトのハッシュ・モデル・所要時間と
+    保存先を記録するので、ディレクトリを走査せずにプリセットや期間で検索・書き出しができる。
+    接続は操作ごとに開くため、スレッドや別プロセスから同時に使ってもよい。
+    job_key を付けて保存すると、同じ job_key の2回目以降の保存は何もせず最初の行を返す
+    （キューのワーカーがリース切れで同じジョブを処理した場合も1回だけ記録される）。
+
+    Parameters:
+    ----------
+    root : str
+        画像の保存先ディレクトリ
+    manifest_path : str, optional
+        manifest のパス。省略時は root の manifest.sqlite3
+    """
+
+    def __init__(self, root: str = DEFAULT_OUTPUT_DIR, manifest_path: Optional[str] = None):
+        self.root = root
+        self.manifest_path = manifest_path or os.path.join(root, MANIFEST_NAME)
+        self._tmp_dir = os.path.join(root, ".tmp")
+        self._lock = threading.Lock()
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(outputs)")}
+            if "job_key" not in columns:
+                conn.execute("ALTER TABLE outputs ADD COLUMN job_key TEXT")
+            conn.executescript(_JOB_KEY_INDEX)
+
+    @classmethod
+    def from_env(cls) -> "OutputStore":
+        """環境変数 OUTPUT_DIR / OUTPUT_MANIFEST_PATH から作成する"""
+        return cls(os.getenv("OUTPUT_DIR", DEFAULT_OUTPUT_DIR), os.getenv("OUTPUT_MANIFEST_PATH"))
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.manifest_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def path_for(self, sha256: str, suffix: str = ".png") -> str:
+        return os.path.join(self.root, sha256[:SHARD_WIDTH], sha256 + suffix)
+
+    def temp_path(self, suffix: str = ".part") -> str:
+        """add_file に渡すファイルを書くための一時ファイルのパス（保存先と同じファイルシステム上）"""
+        fd, path = tempfile.mkstemp(dir=self._tmp_dir, suffix=suffix)
+        os.close(fd)
+        return path
+
+    def _place(self, tmp_path: str, sha256: str, suffix: str) -> str:
+        path = self.path_for(sha256, suffix)
+        if os.path.exists(path):
+            # 同じ内容の画像は保存済み
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        return path
+
+    def find_job(self, job_key: str) -> Optional[Output]:
+        """job_key を付けて保存した行（まだ無ければ None）"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM outputs WHERE job_key = ?", (job_key,)).fetchone()
+        return Output(**dict(row)) if row else None
+
+    def _record(
+        self,
+        sha256: str,
+        path: str,
+        size: int,
+        preset: str,
+        prompt: str,
+        source: str,
+        fields: Dict[str, Any],
+        job_key: Optional[str] = None,
+    ) -> Output:
+        unknown = set(fields) - set(_FIELDS)
+        if unknown:
+            raise TypeError(f"manifest に無い項目です: {sorted(unknown)}")
+        row = {
+            "sha256": sha256,
+            "path": path,
+            "bytes": size,
+            "preset": preset,
+            "prompt_hash": _prompt_hash(prompt),
+            "prompt": prompt,
+            **{name: fields.get(name) for name in _FIELDS},
+            "source": source,
+            "created_at": time.time(),
+            "job_key": job_key,
+        }
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                f"INSERT OR IGNORE INTO outputs ({', '.join(row)}) VALUES ({', '.join('?' for _ in row)})",
+                tuple(row.values()),
+            )
+            if cursor.rowcount:
+                result = conn.execute("SELECT * FROM outputs WHERE id = ?", (cursor.lastrowid,)).fetchone()
+            else:
+                # 別のプロセスが同じ job_key を先に記録していた
+                result = conn.execute("SELECT * FROM outputs WHERE job_key = ?", (job_key,)).fetchone()
+        return Output(**dict(result))
+
+    def put(
+        self,
+        data: bytes,
+        preset: str,
+        prompt: str,
+        suffix: str = ".png",
+        source: str = "generated",
+        job_key: Optional[str] = None,
+        **fields,
+    ) -> Output:
+        """画像データを保存して manifest に記録する"""
+        existing = self.find_job(job_key) if job_key is not None else None
+        if existing is not None:
+            return existing
+        sha256 = hashlib.sha256(data).hexdigest()
+        tmp_path = self.temp_path()
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            path = self._place(tmp_path, sha256, suffix)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return self._record(sha256, path, len(data), preset, prompt, source, fields, job_key)
+
+    def add_file(
+        self,
+        tmp_path: str,
+        preset: str,
+        prompt: str,
+        sha256: Optional[str] = None,
+        suffix: str = ".png",
+        source: str = "generated",
+        job_key: Optional[str] = None,
+        **fields,
+    ) -> Output:
+        """
+        temp_path() に書いたファイルを保存先へ移して manifest に記録する
+
+        sha256 を省略した場合はファイルを読んで計算する（書きながら計算しておけば読み直さずに済む）
+        """
+        existing = self.find_job(job_key) if job_key is not None else None
+        if existing is not None:
+            os.remove(tmp_path)
+            return existing
+        if sha256 is None:
+            digest = hashlib.sha256()
+            with open(tmp_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            sha256 = digest.hexdigest()
+        size = os.path.getsize(tmp_path)
+        path = self._place(tmp_path, sha256, suffix)
+        return self._record(sha256, path, size, preset, prompt, source, fields, job_key)
+
+    def find(
+        self,
+        preset: Optional[str] = None,
+        prompt: Optional[str] = None,
+        prompt_hash: Optional[str] = None,
+        sha256: Optional[str] = None,
+        model: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: Optional[int] = None,
+    ) -> List[Output]:
+        """
+        条件に合う manifest の行を新しい順に返す（条件はすべて AND）
+
+        Parameters:
+        ----------
+        prompt / prompt_hash :
+            プロンプト本文、またはそのハッシュ（job_journal.prompt_hash() の値）
+        since / until : float, optional
+            保存時刻（UNIX 時間）の範囲
+        """
+        where, params = self._where(preset, prompt, prompt_hash, sha256, model, since, until)
+        query = f"SELECT * FROM outputs{where} ORDER BY created_at DESC, id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params += (limit,)
+        with self._connect() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return [Output(**dict(row)) for row in rows]
+
+    @staticmethod
+    def _where(preset, prompt, prompt_hash, sha256, model, since, until) -> Tuple[str, Tuple]:
+        if prompt is not None:
+            prompt_hash = _prompt_hash(prompt)
+        conditions = []
+        params: Tuple = ()
+        for column, value in (("preset", preset), ("prompt_hash", prompt_hash), ("sha256", sha256), ("model", model)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params += (value,)
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params += (since,)
+        if until is not None:
+            conditions.append("created_at < ?")
+            params += (until,)
+        return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+    def export(self, out: IO[str], fmt: str = "jsonl", **filters) -> int:
+        """
+        find() と同じ条件で manifest を JSON Lines か CSV で書き出し、書き出した行数を返す
+        """
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"未知の書き出し形式です: {fmt}")
+        outputs = self.find(**filters)
+        if fmt == "csv":
+            writer = csv.writer(out)
+            writer.writerow(Output._fields)
+            writer.writerows(outputs)
+        else:
+            for output in outputs:
+                out.write(json.dumps(output._asdict(), ensure_ascii=False) + "\n")
+        return len(outputs)
+
+
+def _parse_time(value: str) -> float:
+    # "2026-10-17" / "2026-10-17T12:00:00" などのローカル時刻
+    from datetime import datetime
+
+    return datetime.fromisoformat(value).timestamp()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="生成画像の manifest を検索・書き出しする")
+    parser.add_argument("--root", default=os.getenv("OUTPUT_DIR", DEFAULT_OUTPUT_DIR))
+    parser.add_argument("--manifest", default=os.getenv("OUTPUT_MANIFEST_PATH"))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("list", "条件に合う画像を表示する"), ("export", "条件に合う行を書き出す")):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument("--preset")
+        sub.add_argument("--prompt-hash")
+        sub.add_argument("--model")
+        sub.add_argument("--since", type=_parse_time, help="この日時以降（ISO 形式）")
+        sub.add_argument("--until", type=_parse_time, help="この日時より前（ISO 形式）")
+        sub.add_argument("--limit", type=int)
+        if name == "export":
+            sub.add_argument("--format", choices=EXPORT_FORMATS, default="jsonl")
+            sub.add_argument("--output", help="保存先（省略時は標準出力）")
+
+    args = parser.parse_args(argv)
+    store = OutputStore(args.root, args.manifest)
+    filters = dict(
+        preset=args.preset, prompt_hash=args.prompt_hash, model=args.model,
+        since=args.since, until=args.until, limit=args.limit,
+    )
+
+    if args.command == "list":
+        outputs = store.find(**filters)
+        if not outputs:
+            print("該当する画像はありません。")
+        for output in outputs:
+            created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(output.created_at))
+            print(f"{created} preset={output.preset} model={output.model or '-'} {output.path}")
+        return 0
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8", newline="") as f:
+            count = store.export(f, args.format, **filters)
+        print(f"{count} 件を {args.output} に書き出しました。")
+    else:
+        store.export(sys.stdout, args.format, **filters)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import io
+import os
+import json
+import time
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# NumPy / Pillow はハッシュを計算するときに読み込む（インデックスの読み込みや検索だけなら不要）
+if TYPE_CHECKING:
+    import numpy as np
+
+DEFAULT_INDEX_PATH = ".jobs/phash_index.jsonl"
+# 64ビットハッシュでのハミング距離のしきい値（これ以下なら類似画像とみなす）
+DEFAULT_THRESHOLD = 6
+
+KIND_GENERATED = "generated"
+KIND_POSTED = "posted"
+
+
+class DuplicateImageError(Exception):
+    """投稿済みの画像と類似した画像しか生成できなかった場合の例外"""
+
+
+def _grayscale(data: bytes, size: Tuple[int, int]) -> np.ndarray:
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        resized = image.convert("L").resize(size, Image.Resampling.LANCZOS)
+    return np.asarray(resized, dtype=np.float64)
+
+
+def _to_int(bits: np.ndarray) -> int:
+    import numpy as np
+
+    return int.from_bytes(np.packbits(bits.astype(np.uint8).ravel()).tobytes(), "big")
+
+
+def dhash(data: bytes, hash_size: int = 8) -> int:
+    """
+    差分ハッシュ（dHash）を計算する関数
+
+    (hash_size + 1) x hash_size のグレースケールに縮小し、横に隣り合う画素の大小をビットにする
+    """
+    pixels = _grayscale(data, (hash_size + 1, hash_size))
+    return _to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+_DCT_CACHE: Dict[int, np.ndarray] = {}
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    import numpy as np
+
+    matrix = _DCT_CACHE.get(n)
+    if matrix is None:
+        k = np.arange(n)[:, None]
+        i = np.arange(n)[None, :]
+        matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+        matrix[0, :] = np.sqrt(1.0 / n)
+        _DCT_CACHE[n] = matrix
+    return matrix
+
+
+def phash(data: bytes, hash_size: int = 8, highfreq_factor: int = 4) -> int:
+    """
+    知覚ハッシュ（pHash）を計算する関数
+
+    縮小したグレースケール画像に2次元DCTをかけ、低周波成分（左上 hash_size x hash_size）を
+    直流成分を除いた中央値と比べてビットにする。色違い・軽い構図の違いでは距離が小さくなる。
+    """
+    import numpy as np
+
+    n = hash_size * highfreq_factor
+    pixels = _grayscale(data, (n, n))
+    dct = _dct_matrix(n)
+    low = (dct @ pixels @ dct.T)[:hash_size, :hash_size]
+    median = np.median(low.ravel()[1:])
+    return _to_int(low > median)
+
+
+HASH_FUNCTIONS: Dict[str, Callable[[bytes], int]] = {"dhash": dhash, "phash": phash}
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class Match(NamedTuple):
+    distance: int
+    image_hash: int
+    label: str
+    kind: str
+
+
+class BKTree:
+    """
+    ハミング距離の BK 木
+
+    各ノードの子を「親との距離」ごとに持ち、三角不等式で探索範囲を絞るので、
+    しきい値が小さい検索では全件と比較せずに済む。
+    """
+
+    def __init__(self):
+        # ノードは [ハッシュ, 値のリスト, {距離: 子ノード}]
+        self._root: Optional[list] = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, image_hash: int, value) -> None:
+        self._size += 1
+        if self._root is None:
+            self._root = [image_hash, [value], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(image_hash, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [image_hash, [value], {}]
+                return
+            node = child
+
+    def search(self, image_hash: int, threshold: int) -> List[Tuple[int, int, object]]:
+        """距離が threshold 以下の (距離, ハッシュ, 値) を距離の近い順に返す"""
+        results = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(image_hash, node[0])
+            if distance <= threshold:
+                results.extend((distance, node[0], value) for value in node[1])
+            low, high = distance - threshold, distance + threshold
+            stack.extend(child for d, child in node[2].items() if low <= d <= high)
+        results.sort(key=lambda item: item[0])
+        return results
+
+
+class PerceptualHashIndex:
+    """
+    生成・投稿した画像の知覚ハッシュを永続化し、類似画像を検索するインデックス
+
+    ハッシュは JSON Lines に追記し、起動時に読み込んで BK 木を作る。
+    find_duplicate() は既定では投稿済みの画像だけを対象にするので、キャッシュから
+    再利用する未投稿の画像が自分自身にマッチすることはない。
+
+    Parameters:
+    ----------
+    path : str
+        インデックスファイル（JSON Lines）のパス
+    threshold : int
+        類似とみなすハミング距離の上限
+    algorithm : str
+        "phash" または "dhash"
+    """
+
+    def __init__(self, path: str = DEFAULT_INDEX_PATH, threshold: int = DEFAULT_THRESHOLD, algorithm: str = "phash"):
+        if algorithm not in HASH_FUNCTIONS:
+            raise ValueError(f"未知のハッシュ方式です: {algorithm}")
+        self.path = path
+        self.threshold = threshold
+        self.algorithm = algorithm
+        self._hash = HASH_FUNCTIONS[algorithm]
+        self._tree = BKTree()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if record.get("algorithm", "phash") == algorithm:
+                        self._tree.add(int(record["hash"], 16), (record.get("label", ""), record["kind"]))
+
+    @classmethod
+    def from_env(cls) -> "PerceptualHashIndex":
+        """環境変数 PHASH_INDEX_PATH / PHASH_THRESHOLD から作成する"""
+        return cls(
+            os.getenv("PHASH_INDEX_PATH", DEFAULT_INDEX_PATH),
+            int(os.getenv("PHASH_THRESHOLD", DEFAULT_THRESHOLD)),
+        )
+
+    def __len__(self) -> int:
+        return len(self._tree)
+
+    def hash_image(self, data: bytes) -> int:
+        return self._hash(data)
+
+    def find_similar(self, image_hash: int, kinds: Tuple[str, ...] = (KIND_POSTED,)) -> List[Match]:
+        with self._lock:
+            found = self._tree.search(image_hash, self.threshold)
+        return [
+            Match(distance, other, label, kind)
+            for distance, other, (label, kind) in found
+            if kind in kinds
+        ]
+
+    def find_duplicate(self, data: bytes) -> Optional[Match]:
+        """投稿済みの画像のうち最も近い類似画像を返す（無ければ None）"""
+        matches = self.find_similar(self.hash_image(data))
+        return matches[0] if matches else None
+
+    def add(self, image_hash: int, kind: str = KIND_POSTED, label: str = "") -> None:
+        record = {
+            "hash": format(image_hash, "016x"),
+            "algorithm": self.algorithm,
+            "kind": kind,
+            "label": label,
+            "ts": time.time(),
+        }
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+            self._tree.add(image_hash, (label, kind))
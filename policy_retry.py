@@ -0,0 +1,322 @@
+import os
+import re
+import json
+import time
+import string
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows では複数プロセス間のロックをしない
+    fcntl = None
+
+from generate_prompt import PROMPT_TEMPLATE
+from metrics import get_metrics
+
+DEFAULT_STATE_PATH = ".jobs/policy_state.json"
+# 連続してポリシー違反で失敗したら、そのプリセットをしばらく止める回数と秒数
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_COOLDOWN = 30 * 60
+
+# ポリシー違反になったときに書き換える属性（この順に1つずつ無難な値へ置き換える）
+MUTATION_ORDER: Tuple[str, ...] = ("clothing", "pose", "scene", "expression", "composition", "gaze")
+
+# 書き換え後の値（フィルタに引っかかりにくい、具体的すぎない描写）
+SAFE_ATTRIBUTE_VALUES: Dict[str, str] = {
+    "clothing": "A modest, everyday casual outfit",
+    "pose": "Standing naturally",
+    "scene": "A peaceful park on a sunny afternoon",
+    "expression": "A gentle smile",
+    "composition": "An upper-body portrait in a soft anime illustration style",
+    "gaze": "Looking toward the viewer",
+}
+
+
+class CircuitOpenError(RuntimeError):
+    """ポリシー違反が続いたプリセットを一時的に止めている場合の例外"""
+
+
+def _template_pattern(template: str = PROMPT_TEMPLATE) -> "re.Pattern":
+    # テンプレートの各行 "Clothing/decoration: {clothing}" の値部分を取り出す正規表現を作る
+    pattern = ""
+    for literal, field, _, _ in string.Formatter().parse(template):
+        pattern += re.escape(literal)
+        if field:
+            pattern += f"(?P<{field}>[^\\n]*)"
+    return re.compile(pattern + r"\Z", flags=re.DOTALL)
+
+
+_PATTERN = _template_pattern()
+
+
+def extract_attributes(prompt: str) -> Optional[Dict[str, str]]:
+    """
+    generate_image_prompt で作ったプロンプトから属性の値を取り出す関数
+
+    テンプレートに沿っていないプロンプト（直接書いたものなど）の場合は None を返す
+    """
+    match = _PATTERN.match(prompt)
+    return match.groupdict() if match else None
+
+
+def replace_attributes(prompt: str, replacements: Dict[str, str]) -> str:
+    """プロンプト中の属性の値を replacements で置き換える（テンプレート外のプロンプトはそのまま返す）"""
+    match = _PATTERN.match(prompt)
+    if match is None or not replacements:
+        return prompt
+    pieces = []
+    position = 0
+    for name in sorted(replacements, key=match.start):
+        pieces.append(prompt[position:match.start(name)])
+        pieces.append(replacements[name])
+        position = match.end(name)
+    pieces.append(prompt[position:])
+    return "".join(pieces)
+
+
+class PolicyRetry:
+    """
+    content_policy_violation の再試行でプロンプトを書き換える方針と、その学習結果の保存先
+
+    同じプロンプトを送り直しても同じ理由で拒否されるだけなので、再試行のたびに
+    MUTATION_ORDER の属性を1つずつ無難な値に置き換える。書き換えて成功した場合は
+    最後に置き換えた属性の元の値を「フィルタに引っかかる値」としてプリセットごとに覚え、
+    次回からは最初の試行の前に置き換えておく。
+    書き換えても失敗するジョブが failure_threshold 回続いたプリセットは cooldown 秒のあいだ
+    API を呼ばずに CircuitOpenError にする（サーキットブレーカー）。
+    cooldown が過ぎると半開状態になり、1ジョブだけを試しに通す（他のジョブは引き続き止める）。
+    試したジョブが成功すればブレーカーを閉じ、失敗すればもう一度 cooldown 秒開く。
+    状態の更新はファイルロックの中で保存済みの状態を読み直してから行うので、
+    同じ path を使う複数のプロセスが互いの記録を上書きしない。
+
+    Parameters:
+    ----------
+    path : str, optional
+        学習結果とブレーカーの状態を保存する JSON ファイル。None の場合は保存しない
+    failure_threshold : int
+        ブレーカーを開くまでの連続失敗ジョブ数
+    cooldown : float
+        ブレーカーを開いておく秒数（過ぎたら1ジョブだけ試す。試したジョブが終わらない場合もこの秒数で次に回す）
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = DEFAULT_STATE_PATH,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        cooldown: float = DEFAULT_COOLDOWN,
+    ):
+        self.path = path
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._state: Dict[str, Dict] = {}
+        self._load()
+
+    @classmethod
+    def from_env(cls) -> "PolicyRetry":
+        """環境変数 POLICY_STATE_PATH / POLICY_FAILURE_THRESHOLD / POLICY_COOLDOWN_MINUTES から作成する"""
+        return cls(
+            os.getenv("POLICY_STATE_PATH", DEFAULT_STATE_PATH),
+            int(os.getenv("POLICY_FAILURE_THRESHOLD", DEFAULT_FAILURE_THRESHOLD)),
+            float(os.getenv("POLICY_COOLDOWN_MINUTES", DEFAULT_COOLDOWN / 60)) * 60,
+        )
+
+    def _load(self) -> None:
+        # 呼び出し側で self._lock を保持していること（__init__ を除く）
+        if self.path and os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._state = json.load(f).get("presets", {})
+
+    def _save(self) -> None:
+        # 呼び出し側で self._lock とファイルロックを保持していること
+        directory = os.path.dirname(self.path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"presets": self._state}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _update(self, preset: str, update: Callable[[Dict, float], bool]) -> None:
+        """
+        プリセットの状態を update(state, now) で書き換えて保存する（update が False を返したら保存しない）
+
+        他のプロセスの記録を消さないよう、ファイルロックの中で保存済みの状態を読み直してから書き換える。
+        """
+        with self._lock:
+            if not self.path:
+                update(self._preset(preset), time.time())
+                return
+            with self._file_lock():
+                self._load()
+                if update(self._preset(preset), time.time()):
+                    self._save()
+
+    def _preset(self, preset: str) -> Dict:
+        state = self._state.setdefault(preset, {})
+        state.setdefault("tripped", {})
+        state.setdefault("failures", 0)
+        state.setdefault("open_until", 0.0)
+        # 半開状態で試しているジョブの期限（0 なら試しているジョブは無い）
+        state.setdefault("probe_until", 0.0)
+        return state
+
+    def _snapshot(self, preset: str) -> Dict:
+        with self._lock:
+            self._load()
+            return dict(self._preset(preset))
+
+    def tripped_values(self, preset: str) -> Dict[str, List[str]]:
+        """プリセットでフィルタに引っかかった属性の値（属性名 → 値のリスト）"""
+        tripped = self._snapshot(preset)["tripped"]
+        return {name: list(values) for name, values in tripped.items()}
+
+    def is_open(self, preset: str) -> bool:
+        """ブレーカーが開いている（半開状態で他のジョブが試している場合を含む）"""
+        state = self._snapshot(preset)
+        now = time.time()
+        return state["open_until"] > now or (state["open_until"] > 0 and state["probe_until"] > now)
+
+    def start(self, preset: str, prompt: str) -> "PolicyRetrySession":
+        """
+        1ジョブ分の書き換えを始める（ブレーカーが開いている場合は CircuitOpenError）
+
+        cooldown が過ぎた半開状態では、最初のジョブだけを試しに通す。
+        """
+        rejected_until = 0.0
+        probe = False
+        tripped: Dict[str, List[str]] = {}
+
+        def admit(state: Dict, now: float) -> bool:
+            nonlocal rejected_until, probe
+            tripped.update((name, list(values)) for name, values in state["tripped"].items())
+            if not state["open_until"]:
+                return False
+            if state["open_until"] > now or state["probe_until"] > now:
+                rejected_until = max(state["open_until"], state["probe_until"])
+                return False
+            probe = True
+            state["probe_until"] = now + self.cooldown
+            return True
+
+        self._update(preset, admit)
+        if rejected_until:
+            get_metrics().inc("policy_circuit_rejections_total")
+            raise CircuitOpenError(
+                f"プリセット {preset} はポリシー違反が続いたため"
+                f" {time.strftime('%H:%M:%S', time.localtime(rejected_until))} まで停止しています。"
+            )
+        if probe:
+            print(f"プリセット {preset} の停止期間が過ぎたため、1ジョブだけ試します。")
+        return PolicyRetrySession(self, preset, prompt, tripped, probe=probe)
+
+    def record_tripped(self, preset: str, name: str, value: str) -> None:
+        def add(state: Dict, now: float) -> bool:
+            values = state["tripped"].setdefault(name, [])
+            if value in values:
+                return False
+            values.append(value)
+            return True
+
+        self._update(preset, add)
+
+    def record_success(self, preset: str) -> None:
+        def close(state: Dict, now: float) -> bool:
+            if not (state["failures"] or state["open_until"] or state["probe_until"]):
+                return False
+            state["failures"], state["open_until"], state["probe_until"] = 0, 0.0, 0.0
+            return True
+
+        self._update(preset, close)
+
+    def record_failure(self, preset: str, probe: bool = False) -> None:
+        """
+        書き換えても失敗したジョブを記録する
+
+        probe（半開状態で試したジョブ）の失敗はすぐにブレーカーを開き直す。
+        ブレーカーが開いている間に終わった他のジョブの失敗は数えない。
+        """
+        def count(state: Dict, now: float) -> bool:
+            if not probe and state["open_until"]:
+                return False
+            state["failures"] += 1
+            if probe:
+                print(f"プリセット {preset} で試したジョブもポリシー違反になったため、{self.cooldown / 60:.0f} 分間停止します。")
+            elif state["failures"] >= self.failure_threshold:
+                print(
+                    f"プリセット {preset} でポリシー違反が {state['failures']} 回続いたため、"
+                    f"{self.cooldown / 60:.0f} 分間停止します。"
+                )
+            else:
+                return True
+            # 開き直した後は失敗の回数を数え直す
+            state["failures"], state["open_until"], state["probe_until"] = 0, now + self.cooldown, 0.0
+            return True
+
+        self._update(preset, count)
+
+
+class PolicyRetrySession:
+    """
+    1ジョブ分のプロンプト書き換えの状態（PolicyRetry.start() で作る）
+
+    prompt が次に送るプロンプト。on_violation() で次の書き換えを進める
+    """
+
+    def __init__(
+        self, policy: PolicyRetry, preset: str, prompt: str, tripped: Dict[str, List[str]], probe: bool = False
+    ):
+        self.policy = policy
+        self.preset = preset
+        # 半開状態のブレーカーが試しに通したジョブ
+        self.probe = probe
+        self.original = extract_attributes(prompt)
+        self.replaced: Dict[str, str] = {}
+        self._last: Optional[str] = None
+        if self.original is not None:
+            # 以前フィルタに引っかかった値は最初から置き換えておく
+            for name, values in tripped.items():
+                if self.original.get(name) in values and name in SAFE_ATTRIBUTE_VALUES:
+                    self.replaced[name] = SAFE_ATTRIBUTE_VALUES[name]
+            if self.replaced:
+                print(f"以前ポリシー違反になった属性を置き換えます: {', '.join(sorted(self.replaced))}")
+        self.prompt = replace_attributes(prompt, self.replaced)
+
+    def on_violation(self) -> Optional[str]:
+        """
+        ポリシー違反だったことを記録し、次に送るプロンプトを返す（書き換える属性が残っていなければ None）
+        """
+        if self.original is None:
+            return None
+        for name in MUTATION_ORDER:
+            if name in self.replaced or self.original.get(name) == SAFE_ATTRIBUTE_VALUES[name]:
+                continue
+            self.replaced[name] = SAFE_ATTRIBUTE_VALUES[name]
+            self._last = name
+            self.prompt = replace_attributes(self.prompt, {name: SAFE_ATTRIBUTE_VALUES[name]})
+            get_metrics().inc("prompt_mutations_total", attribute=name)
+            print(f"属性 {name} を置き換えたプロンプトで再試行します。")
+            return self.prompt
+        return None
+
+    def on_success(self) -> None:
+        if self._last is not None:
+            self.policy.record_tripped(self.preset, self._last, self.original[self._last])
+        self.policy.record_success(self.preset)
+
+    def on_failure(self) -> None:
+        """ポリシー違反のまま再試行を使い切った"""
+        self.policy.record_failure(self.preset, probe=self.probe)
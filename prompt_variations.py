@@ -0,0 +1,209 @@
+import os
+import random
+import hashlib
+import argparse
+import itertools
+from bisect import bisect_right
+from typing import Container, Dict, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Set, Tuple
+
+from generate_prompt import compile_prompt_template
+
+MODE_CARTESIAN = "cartesian"
+MODE_RANDOM = "random"
+MODE_LATIN_HYPERCUBE = "lhs"
+MODES = (MODE_CARTESIAN, MODE_RANDOM, MODE_LATIN_HYPERCUBE)
+
+# random モードで重複が続いたときに打ち切る回数（組み合わせを使い切った場合の無限ループ防止）
+MAX_CONSECUTIVE_DUPLICATES = 1000
+
+
+def variant_hash(prompt: str) -> str:
+    """プロンプト文の重複判定に使うハッシュ"""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:32]
+
+
+class PromptVariant(NamedTuple):
+    prompt: str
+    attributes: Dict[str, str]
+    digest: str
+
+
+class VariationSpace:
+    """
+    属性ごとの候補から作るプロンプトの組み合わせ空間
+
+    テンプレートは作成時に一度だけ解析し、組み合わせはジェネレータで1件ずつ作るので、
+    数万件のバリエーションでも全件をメモリに載せない。
+
+    Parameters:
+    ----------
+    base : Mapping[str, str]
+        候補が指定されていない属性に使う値（プリセットの prompt）
+    variations : Mapping[str, Sequence[Tuple[str, float]]]
+        属性名 → (値, 重み) の候補
+    """
+
+    def __init__(self, base: Mapping[str, str], variations: Mapping[str, Sequence[Tuple[str, float]]]):
+        self.base = dict(base)
+        self.attributes: List[str] = list(variations)
+        self.choices: List[List[str]] = [[value for value, _ in variations[key]] for key in self.attributes]
+        self._cumulative: List[List[float]] = [
+            list(itertools.accumulate(weight for _, weight in variations[key])) for key in self.attributes
+        ]
+        self._render = compile_prompt_template()
+
+    @classmethod
+    def from_preset(cls, preset: Mapping) -> "VariationSpace":
+        """config.get_preset() の戻り値から作成する"""
+        return cls(preset["prompt"], preset.get("variations") or {})
+
+    @property
+    def size(self) -> int:
+        """組み合わせの総数"""
+        total = 1
+        for values in self.choices:
+            total *= len(values)
+        return total
+
+    def render(self, indices: Sequence[int]) -> PromptVariant:
+        attributes = dict(self.base)
+        for key, values, index in zip(self.attributes, self.choices, indices):
+            attributes[key] = values[index]
+        prompt = self._render(attributes)
+        return PromptVariant(prompt, attributes, variant_hash(prompt))
+
+    def _pick(self, position: int, u: float) -> int:
+        # u ∈ [0, 1) を重みの累積分布で候補のインデックスに変換する
+        cumulative = self._cumulative[position]
+        return min(bisect_right(cumulative, u * cumulative[-1]), len(cumulative) - 1)
+
+    def cartesian(self) -> Iterator[Tuple[int, ...]]:
+        """全組み合わせを順に返す（重みは使わない）"""
+        return itertools.product(*(range(len(values)) for values in self.choices))
+
+    def random_sample(self, rng: random.Random) -> Iterator[Tuple[int, ...]]:
+        """重み付きで独立に無作為抽出した組み合わせを無限に返す"""
+        while True:
+            yield tuple(self._pick(position, rng.random()) for position in range(len(self.choices)))
+
+    def latin_hypercube(self, n: int, rng: random.Random) -> Iterator[Tuple[int, ...]]:
+        """
+        ラテン超方格法で n 件の組み合わせを返す
+
+        各属性の [0, 1) を n 等分した区間からちょうど1回ずつ値を取り、属性ごとに区間の順番を
+        ばらばらに並べ替えるので、少ない件数でも各属性の候補が重みに比例して偏りなく出る。
+        """
+        strata = []
+        for _ in self.choices:
+            order = list(range(n))
+            rng.shuffle(order)
+            strata.append(order)
+        for i in range(n):
+            yield tuple(
+                self._pick(position, (strata[position][i] + rng.random()) / n)
+                for position in range(len(self.choices))
+            )
+
+
+def iter_prompts(
+    space: VariationSpace,
+    mode: str = MODE_CARTESIAN,
+    limit: Optional[int] = None,
+    seed: Optional[int] = None,
+    used: Optional[Container[str]] = None,
+) -> Iterator[PromptVariant]:
+    """
+    バリエーションのプロンプトを1件ずつ返すジェネレータ
+
+    同じプロンプト文になる組み合わせは1回だけ返し、used に含まれるハッシュ（過去の実行で
+    使用済みのもの）はスキップする。
+
+    Parameters:
+    ----------
+    space : VariationSpace
+        組み合わせ空間
+    mode : str
+        cartesian（全組み合わせ）, random（重み付き無作為抽出）, lhs（ラテン超方格法）
+    limit : int, optional
+        返す件数の上限。lhs では必須
+    seed : int, optional
+        random / lhs の乱数シード
+    used : Container[str], optional
+        使用済みのプロンプトハッシュ（UsedPromptLog など）
+    """
+    if mode not in MODES:
+        raise ValueError(f"未知のモードです: {mode}（{', '.join(MODES)} のいずれか）")
+    rng = random.Random(seed)
+    if mode == MODE_CARTESIAN:
+        candidates = space.cartesian()
+    elif mode == MODE_RANDOM:
+        candidates = space.random_sample(rng)
+    else:
+        if limit is None:
+            raise ValueError("lhs モードでは limit の指定が必要です")
+        candidates = space.latin_hypercube(limit, rng)
+
+    seen: Set[str] = set()
+    emitted = 0
+    duplicates = 0
+    for indices in candidates:
+        if limit is not None and emitted >= limit:
+            return
+        variant = space.render(indices)
+        if variant.digest in seen or (used is not None and variant.digest in used):
+            duplicates += 1
+            if mode == MODE_RANDOM and duplicates >= MAX_CONSECUTIVE_DUPLICATES:
+                return
+            continue
+        duplicates = 0
+        seen.add(variant.digest)
+        emitted += 1
+        yield variant
+
+
+class UsedPromptLog:
+    """
+    使用済みプロンプトのハッシュを1行1件で追記していくファイル
+
+    iter_prompts の used に渡すと、過去の実行で使ったプロンプトを再び生成しない。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._digests: Set[str] = set()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._digests.update(line.strip() for line in f if line.strip())
+
+    def __contains__(self, digest: object) -> bool:
+        return digest in self._digests
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    def add(self, digest: str) -> None:
+        if digest in self._digests:
+            return
+        self._digests.add(digest)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(digest + "\n")
+
+
+if __name__ == "__main__":
+    from config import get_preset
+
+    parser = argparse.ArgumentParser(description="プリセットの variations からプロンプトのバリエーションを表示する")
+    parser.add_argument("preset", nargs="?", default=os.getenv("PROMPT_PRESET", "default"))
+    parser.add_argument("--mode", choices=MODES, default=MODE_CARTESIAN)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    space = VariationSpace.from_preset(get_preset(args.preset))
+    print(f"組み合わせ数: {space.size}")
+    for variant in iter_prompts(space, args.mode, args.limit, args.seed):
+        print(f"--- {variant.digest}")
+        print(variant.prompt)
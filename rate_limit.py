@@ -0,0 +1,314 @@
+import os
+import re
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, Tuple, TypeVar
+
+from metrics import get_metrics
+
+T = TypeVar("T")
+
+# エンドポイントごとのデフォルト上限（1分あたりのリクエスト数, バースト数）
+# 環境変数 RATE_LIMIT_IMAGES_GENERATE="15/5" のように「分あたり/バースト」で上書きできる
+DEFAULT_LIMITS: Dict[str, Tuple[float, float]] = {
+    "images.generate": (15, 5),
+    "image_download": (120, 20),
+    "media_upload": (25, 10),
+    "create_tweet": (6, 3),
+}
+
+# サーバ指定の待ち時間が長すぎる場合の上限（秒）。Twitter の15分ウィンドウに合わせる
+MAX_SERVER_DELAY = 15 * 60
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class TokenBucket:
+    """
+    スレッドと asyncio タスクの両方から共有できるトークンバケット
+
+    トークンは予約制で、取り出し時に足りなければ残量がマイナスになり、その分の待ち時間を返す。
+    ロックは残量計算の間だけ保持し、待機自体はロックの外で行う。
+
+    Parameters:
+    ----------
+    rate : float
+        1秒あたりに補充するトークン数
+    capacity : float
+        バケットの容量（バースト数）
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """トークンを1つ予約し、利用可能になるまでの待ち時間（秒）を返す"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._blocked_until - now)
+
+    def pause(self, seconds: float) -> None:
+        """サーバから待機を指示されたとき、このバケットの全利用者を seconds 秒止める"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def acquire(self) -> None:
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self) -> None:
+        wait = self.reserve()
+        if wait > 0:
+            import asyncio
+
+            await asyncio.sleep(wait)
+
+
+_limiters: Dict[str, TokenBucket] = {}
+_limiters_lock = threading.Lock()
+
+
+def _limit_for(endpoint: str) -> Tuple[float, float]:
+    env_name = "RATE_LIMIT_" + re.sub(r"\W", "_", endpoint).upper()
+    value = os.getenv(env_name)
+    if not value:
+        return DEFAULT_LIMITS.get(endpoint, (60, 10))
+    per_minute, _, burst = value.partition("/")
+    return float(per_minute), float(burst or per_minute)
+
+
+def get_limiter(endpoint: str) -> TokenBucket:
+    """
+    エンドポイント名に対応するプロセス共通のトークンバケットを返す関数
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(endpoint)
+        if limiter is None:
+            per_minute, burst = _limit_for(endpoint)
+            limiter = TokenBucket(per_minute / 60.0, burst)
+            _limiters[endpoint] = limiter
+        return limiter
+
+
+def reset_limiters() -> None:
+    """全エンドポイントのバケットを破棄する（設定変更時やテスト用）"""
+    with _limiters_lock:
+        _limiters.clear()
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    # OpenAI の x-ratelimit-reset-* は "1s", "6m0s", "20ms" のような形式
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def retry_after_from_headers(headers: Optional[Mapping[str, str]], rate_limited: bool = False) -> Optional[float]:
+    """
+    レスポンスヘッダからサーバが指定する待ち時間（秒）を取り出す関数
+
+    対応ヘッダ:
+    - Retry-After（秒数 or HTTP-date）, retry-after-ms
+    - x-ratelimit-reset-requests / x-ratelimit-reset-tokens（OpenAI。対応する x-ratelimit-remaining-* が 0
+      のとき、または rate_limited（429）のときのみ）
+    - x-rate-limit-reset（Twitter, epoch秒。x-rate-limit-remaining が 0 のときのみ）
+
+    OpenAI / Twitter のリセットヘッダはレート制限と関係のないエラーにも付くので、
+    上限に達していない場合の待ち時間としては使わない。
+
+    Returns:
+    -------
+    Optional[float]
+        待ち時間。ヘッダが無い場合は None
+    """
+    if not headers:
+        return None
+    # requests / httpx のヘッダは大文字小文字を区別しないが、dict が渡されても動くようにする
+    lowered = {str(k).lower(): str(v) for k, v in headers.items()}
+
+    if "retry-after-ms" in lowered:
+        try:
+            return float(lowered["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if "retry-after" in lowered:
+        value = lowered["retry-after"]
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    for kind in ("requests", "tokens"):
+        name = f"x-ratelimit-reset-{kind}"
+        if name in lowered and (rate_limited or lowered.get(f"x-ratelimit-remaining-{kind}") == "0"):
+            delay = _parse_duration(lowered[name])
+            if delay is not None:
+                return delay
+    if lowered.get("x-rate-limit-remaining") == "0" and "x-rate-limit-reset" in lowered:
+        try:
+            return max(0.0, float(lowered["x-rate-limit-reset"]) - time.time())
+        except ValueError:
+            pass
+    return None
+
+
+def retry_after_from_error(error: BaseException) -> Optional[float]:
+    """
+    OpenAI / tweepy / requests / httpx の例外に付いているレスポンスから待ち時間を取り出す関数
+    """
+    response = getattr(error, "response", None)
+    return retry_after_from_headers(getattr(response, "headers", None), _status_code(error) == 429)
+
+
+class Backoff:
+    """
+    リトライ時の待ち時間を決めるクラス
+
+    サーバが待ち時間を指定していればそれに従い（上限 max_delay）、指定がなければ
+    base * factor ** attempt にジッタを加えた指数バックオフにする。
+    """
+
+    def __init__(self, base: float = 5, factor: float = 2, jitter: float = 1, max_delay: float = MAX_SERVER_DELAY):
+        self.base = base
+        self.factor = factor
+        self.jitter = jitter
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        server_delay = retry_after_from_error(error) if error is not None else None
+        if server_delay is not None:
+            return min(server_delay, self.max_delay) + random.uniform(0, self.jitter)
+        return min(self.base * self.factor ** attempt, self.max_delay) + random.uniform(0, self.jitter)
+
+
+def retry_wait(endpoint: str, attempt: int, error: BaseException, backoff: Backoff) -> float:
+    """
+    リトライまでの待ち時間を決めてログを出す関数
+
+    サーバから待ち時間の指定があった場合は、同じエンドポイントを使う他のジョブも待たせる
+    """
+    wait_time = backoff.delay(attempt, error)
+    get_metrics().inc("retries_total", endpoint=endpoint)
+    if retry_after_from_error(error) is not None:
+        get_limiter(endpoint).pause(wait_time)
+    print(f"{endpoint} でエラーが発生しました (リトライ対象): {error}")
+    print(f"{wait_time:.2f}秒待機してリトライします...")
+    return wait_time
+
+
+def call_with_retry(
+    endpoint: str,
+    func: Callable[..., T],
+    *args: Any,
+    is_retryable: Callable[[BaseException], bool],
+    max_retries: int = 3,
+    backoff: Optional[Backoff] = None,
+    **kwargs: Any,
+) -> T:
+    """
+    レート制限とリトライを付けて func を呼び出す関数
+
+    呼び出し前にエンドポイントのトークンバケットを取得し、is_retryable が True を返す例外のみ
+    max_retries 回まで再試行する。最後の例外はそのまま送出する。
+    試行ごとの所要時間は attempt_seconds、リトライ回数は retries_total に記録する。
+    """
+    backoff = backoff or Backoff()
+    limiter = get_limiter(endpoint)
+    for attempt in range(max_retries):
+        limiter.acquire()
+        try:
+            with get_metrics().span("attempt", endpoint=endpoint):
+                return func(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e) or attempt >= max_retries - 1:
+                raise
+            time.sleep(retry_wait(endpoint, attempt, e, backoff))
+    raise RuntimeError("max_retries must be at least 1")
+
+
+async def acall_with_retry(
+    endpoint: str,
+    func: Callable[..., Awaitable[T]],
+    *args: Any,
+    is_retryable: Callable[[BaseException], bool],
+    max_retries: int = 3,
+    backoff: Optional[Backoff] = None,
+    **kwargs: Any,
+) -> T:
+    """call_with_retry の asyncio 版（func はコルーチン関数）"""
+    # asyncio は非同期エンジンを使うときだけ読み込む（同期の実行では起動時間に含めない）
+    import asyncio
+
+    backoff = backoff or Backoff()
+    limiter = get_limiter(endpoint)
+    for attempt in range(max_retries):
+        await limiter.aacquire()
+        try:
+            with get_metrics().span("attempt", endpoint=endpoint):
+                return await func(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e) or attempt >= max_retries - 1:
+                raise
+            await asyncio.sleep(retry_wait(endpoint, attempt, e, backoff))
+    raise RuntimeError("max_retries must be at least 1")
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def is_retryable_http_error(error: BaseException) -> bool:
+    """
+    画像ダウンロード（requests / httpx）の例外がリトライ対象かどうかを判定する関数
+
+    接続エラー・タイムアウトと、429 / 5xx のレスポンスのみリトライする
+    """
+    import requests
+    import httpx
+
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, httpx.TransportError)):
+        return True
+    status = _status_code(error)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def is_retryable_twitter_error(error: BaseException) -> bool:
+    """
+    tweepy の例外がリトライ対象かどうかを判定する関数
+
+    429（TooManyRequests）と 5xx（TwitterServerError）、接続エラーのみリトライする
+    """
+    import requests
+    import tweepy
+
+    if isinstance(error, (tweepy.TooManyRequests, tweepy.TwitterServerError)):
+        return True
+    if isinstance(error, tweepy.HTTPException):
+        return False
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def is_rate_limited_error(error: BaseException) -> bool:
+    """
+    429 のみをリトライ対象にする判定関数
+
+    ツイート投稿のように、サーバ側で処理済みかもしれない 5xx を再送すると二重投稿になる呼び出しに使う
+    """
+    return _status_code(error) == 429
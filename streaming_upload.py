@@ -0,0 +1,213 @@
+import io
+import queue
+import threading
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+from clients import get_http_session
+from metrics import get_metrics
+from rate_limit import get_limiter
+
+# APPEND 1回で送る大きさ（Twitter の上限は 5MB）
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# ダウンロード済みでアップロード待ちのチャンクを何個までためるか（メモリ上限 ≒ チャンク × この数）
+DEFAULT_QUEUE_SIZE = 4
+# (接続, 読み込み) のタイムアウト秒数
+DEFAULT_TIMEOUT: Tuple[float, float] = (5, 30)
+# ダウンロード時に1回で読む大きさ
+READ_SIZE = 64 * 1024
+
+_END = object()
+
+
+def rechunk(chunks: Iterable[bytes], size: int) -> Iterator[bytes]:
+    """任意の大きさのチャンク列を size バイトずつ（最後は端数）に詰め直す"""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+
+class ChunkPipe:
+    """
+    別スレッドでチャンク列を読み進め、上限付きのキューで受け渡すパイプ
+
+    作成した時点で読み込みを始めるので、消費側が INIT などを待っている間もダウンロードが進む。
+    消費側が遅い場合はキューが埋まった時点で読み込みが止まるため、メモリは
+    chunk_size × (queue_size + 1) 程度に収まる。
+
+    Parameters:
+    ----------
+    chunks : Iterable[bytes]
+        読み込むチャンク列（requests の iter_content など）
+    chunk_size : int
+        消費側に渡すチャンクの大きさ
+    queue_size : int
+        キューにためるチャンク数の上限
+    """
+
+    def __init__(self, chunks: Iterable[bytes], chunk_size: int = DEFAULT_CHUNK_SIZE, queue_size: int = DEFAULT_QUEUE_SIZE):
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._produce, args=(chunks, chunk_size), name="chunk-pipe", daemon=True
+        )
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, chunks: Iterable[bytes], chunk_size: int) -> None:
+        try:
+            for chunk in rechunk(chunks, chunk_size):
+                if not self._put(chunk):
+                    return
+            self._put(_END)
+        except BaseException as e:
+            # 読み込み側の例外は消費側で送出する
+            self._put(e)
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """読み込みを打ち切り、スレッドの終了を待つ"""
+        self._stop.set()
+        self._thread.join()
+
+
+def chunked_upload(
+    api_v1,
+    segments: Iterable[bytes],
+    total_bytes: int,
+    media_type: str,
+    media_category: str = "tweet_image",
+    additional_owners: Optional[List[str]] = None,
+):
+    """
+    tweepy の INIT / APPEND / FINALIZE で segments を順にアップロードする関数
+
+    Returns:
+    -------
+    tweepy.models.Media
+        FINALIZE（処理待ちがある場合は STATUS）の結果
+    """
+    media = api_v1.chunked_upload_init(
+        total_bytes, media_type, media_category=media_category, additional_owners=additional_owners
+    )
+    media_id = media.media_id
+    sent = 0
+    for segment_index, segment in enumerate(segments):
+        api_v1.chunked_upload_append(media_id, segment, segment_index)
+        sent += len(segment)
+        get_metrics().inc("bytes_uploaded_total", len(segment))
+    if sent != total_bytes:
+        raise IOError(f"アップロードしたサイズ {sent} バイトが宣言した {total_bytes} バイトと一致しません。")
+    media = api_v1.chunked_upload_finalize(media_id)
+
+    # サーバ側の処理がある場合は完了まで待つ（画像では通常発生しない）
+    info = getattr(media, "processing_info", None)
+    while info and info.get("state") in ("pending", "in_progress"):
+        time.sleep(info.get("check_after_secs", 1))
+        media = api_v1.get_media_upload_status(media_id)
+        info = getattr(media, "processing_info", None)
+    if info and info.get("state") == "failed":
+        raise IOError(f"メディアの処理に失敗しました: {info.get('error')}")
+    return media
+
+
+def _tee(chunks: Iterable[bytes], sink: Callable[[bytes], object]) -> Iterator[bytes]:
+    for chunk in chunks:
+        sink(chunk)
+        yield chunk
+
+
+def _count_downloaded(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    metrics = get_metrics()
+    for chunk in chunks:
+        metrics.inc("bytes_downloaded_total", len(chunk))
+        yield chunk
+
+
+def stream_image_upload(
+    api_v1,
+    image_url: str,
+    *,
+    session=None,
+    timeout: Union[float, Tuple[float, float]] = DEFAULT_TIMEOUT,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    sink: Optional[Callable[[bytes], object]] = None,
+    media_category: str = "tweet_image",
+    additional_owners: Optional[List[str]] = None,
+):
+    """
+    画像URLを少しずつダウンロードしながら Twitter のチャンクアップロードに流し込む関数
+
+    ダウンロードとアップロードが重なり、画像全体をメモリに持たない。
+    Content-Length が無いレスポンスは INIT に総バイト数を渡せないため、全体を読んでから
+    通常のアップロードを行う。
+
+    Parameters:
+    ----------
+    api_v1 : tweepy.API
+        アップロードに使う v1 API
+    image_url : str
+        画像URL
+    session : requests.Session, optional
+        ダウンロードに使うセッション。省略時はプロセス共有のセッション
+    timeout : float or (float, float)
+        ダウンロードの (接続, 読み込み) タイムアウト秒数
+    chunk_size, queue_size : int
+        APPEND 1回の大きさと、アップロード待ちでためるチャンク数の上限
+    sink : Callable[[bytes], object], optional
+        ダウンロードしたチャンクを順に受け取る関数（キャッシュへの書き込みなど）
+
+    Returns:
+    -------
+    tweepy.models.Media
+        アップロード結果（media_id を持つ）
+    """
+    session = session or get_http_session()
+    get_limiter("image_download").acquire()
+    with session.get(image_url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        chunks = _count_downloaded(response.iter_content(chunk_size=READ_SIZE))
+        if sink is not None:
+            chunks = _tee(chunks, sink)
+        media_type = response.headers.get("Content-Type", "image/png").split(";")[0].strip()
+        total_bytes = int(response.headers.get("Content-Length") or 0)
+        if not total_bytes:
+            data = b"".join(chunks)
+            extension = media_type.split("/")[-1] or "png"
+            media = api_v1.media_upload(
+                f"image.{extension}", file=io.BytesIO(data),
+                media_category=media_category, additional_owners=additional_owners,
+            )
+            get_metrics().inc("bytes_uploaded_total", len(data))
+            return media
+
+        pipe = ChunkPipe(chunks, chunk_size, queue_size)
+        try:
+            return chunked_upload(api_v1, pipe, total_bytes, media_type, media_category, additional_owners)
+        finally:
+            pipe.close()
@@ -0,0 +1,64 @@
+import unittest
+
+from bench_e2e import percentile, run_benchmark, sample_latency
+from rate_limit import reset_limiters
+from clients import close_clients
+
+# 遅延なし・小さい画像で、オフラインでパイプライン全体が通ることだけを確かめる
+FAST_PROFILE = {
+    "images": {"latency_ms": None, "errors": {"429": 0.2}},
+    "cdn": {"latency_ms": None, "payload_bytes": 20_000, "bandwidth_mbps": None, "errors": {}},
+    "media_upload": {"latency_ms": None, "errors": {}},
+    "create_tweet": {"latency_ms": None, "errors": {}},
+    "retry_after_ms": 1,
+}
+
+
+class TestBenchmarkHelpers(unittest.TestCase):
+
+    def test_percentile(self):
+        values = [float(v) for v in range(1, 101)]
+        self.assertEqual(percentile(values, 50), 51.0)
+        self.assertEqual(percentile(values, 99), 99.0)
+        self.assertIsNone(percentile([], 50))
+
+    def test_sample_latency(self):
+        import random
+
+        rng = random.Random(0)
+        self.assertEqual(sample_latency({"dist": "fixed", "median": 250}, rng), 0.25)
+        self.assertEqual(sample_latency(None, rng), 0.0)
+        self.assertTrue(0.1 <= sample_latency({"dist": "uniform", "min": 100, "max": 200}, rng) <= 0.2)
+
+
+class TestEndToEndBenchmark(unittest.TestCase):
+
+    def tearDown(self):
+        close_clients()
+        reset_limiters()
+
+    def test_sync_and_async_against_stand_in_servers(self):
+        report = run_benchmark(["sync", "async"], [2], jobs=4, profile=FAST_PROFILE, seed=1)
+        self.assertEqual(len(report["results"]), 2)
+        for result in report["results"]:
+            with self.subTest(mode=result["mode"]):
+                self.assertEqual(result["succeeded"], 4, result["errors"])
+                self.assertEqual(result["requests"]["create_tweet"], {"201": 4})
+                self.assertEqual(
+                    result["retries"]["images"], result["requests"]["images"].get("429", 0)
+                )
+                self.assertIsNotNone(result["latency_ms"]["p99"])
+                self.assertGreater(result["peak_rss_mb"], 0)
+
+    def test_sdk_does_not_retry_behind_the_limiter(self):
+        # SDK 内部のリトライが無効なら、生成リクエストは call_with_retry の試行回数（3回）だけになる
+        profile = {**FAST_PROFILE, "images": {"latency_ms": None, "errors": {"429": 1.0}}}
+        report = run_benchmark(["sync", "async"], [1], jobs=1, profile=profile, seed=1)
+        for result in report["results"]:
+            with self.subTest(mode=result["mode"]):
+                self.assertEqual(result["failed"], 1)
+                self.assertEqual(result["requests"]["images"], {"429": 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import unittest
+from unittest.mock import patch
+
+from clients import ClientRegistry, TwitterAccount, TwitterCredentials
+
+
+class TestClientRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ClientRegistry(pool_size=3)
+
+    def tearDown(self):
+        self.registry.close()
+
+    def test_twitter_clients_shared_per_credentials(self):
+        account_a = TwitterCredentials("key-a", "secret-a", "token-a", "token-secret-a")
+        account_b = TwitterCredentials("key-b", "secret-b", "token-b", "token-secret-b")
+        first = self.registry.twitter(account_a)
+        self.assertIs(self.registry.twitter(account_a), first)
+        self.assertIsNot(self.registry.twitter(account_b), first)
+        adapter = first[0].session.get_adapter("https://upload.twitter.com")
+        self.assertEqual(adapter._pool_maxsize, 3)
+
+    def test_openai_and_session_are_reused(self):
+        self.assertIs(self.registry.openai("sk-test"), self.registry.openai("sk-test"))
+        self.assertIs(self.registry.http_session(), self.registry.http_session())
+
+    def test_close_recreates_on_next_use(self):
+        session = self.registry.http_session()
+        self.registry.close()
+        self.assertIsNot(self.registry.http_session(), session)
+
+
+class TestTwitterAccount(unittest.TestCase):
+
+    def test_credentials_from_prefixed_env_and_user_id_from_token(self):
+        env = {
+            "TWITTER_SILVER_API_KEY": "key",
+            "TWITTER_SILVER_ACCESS_TOKEN": "12345-abcdef",
+            "GOLD_ACCESS_TOKEN": "no-user-id",
+        }
+        with patch.dict(os.environ, env):
+            silver = TwitterAccount.from_config("silver")
+            self.assertEqual(silver.credentials.api_key, "key")
+            self.assertEqual(silver.resolve_user_id(), "12345")
+
+            gold = TwitterAccount.from_config("gold", "GOLD_")
+            self.assertIsNone(gold.resolve_user_id())
+            self.assertEqual(TwitterAccount.from_config("gold", "GOLD_", user_id="999").resolve_user_id(), "999")
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
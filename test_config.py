@@ -0,0 +1,115 @@
+import os
+import tempfile
+import textwrap
+import unittest
+
+from config import ConfigError, get_preset, list_presets, load_config_from_yaml
+from generate_prompt import PROMPT_DEFAULTS
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "prompt_config.yaml")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, text, mtime=None):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(textwrap.dedent(text))
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_preset_inherits_extends_default_and_function_defaults(self):
+        self.write("""
+            default:
+              prompt:
+                eye: "Dark Brown"
+              tweet_text: "default text"
+            _base:
+              prompt:
+                scene: "beach"
+            silver:
+              extends: _base
+              prompt:
+                eye: "Red"
+        """)
+        preset = get_preset("silver", self.path)
+        self.assertEqual(preset["prompt"]["eye"], "Red")
+        self.assertEqual(preset["prompt"]["scene"], "beach")
+        self.assertEqual(preset["prompt"]["gaze"], PROMPT_DEFAULTS["gaze"])
+        self.assertEqual(preset["tweet_text"], "default text")
+        self.assertEqual(list_presets(self.path), ["default", "silver"])
+
+    def test_compiled_presets_are_cached_and_reloaded_on_change(self):
+        self.write('default:\n  tweet_text: "v1"\n', mtime=1_000_000)
+        first = get_preset("default", self.path)
+        self.assertIs(get_preset("default", self.path), first)
+
+        self.write('default:\n  tweet_text: "v2"\n', mtime=2_000_000)
+        self.assertEqual(get_preset("default", self.path)["tweet_text"], "v2")
+
+    def test_invalid_config_fails_fast(self):
+        cases = [
+            'default:\n  tweet_text: "t"\n  promt: {}\n',
+            'default:\n  tweet_text: "t"\n  prompt:\n    eyes: "Red"\n',
+            'default:\n  tweet_text: "t"\nred:\n  extends: missing\n',
+            'a:\n  extends: b\n  tweet_text: "t"\nb:\n  extends: a\n',
+            'default:\n  prompt: {}\n',
+            'default: [unclosed\n',
+            'default:\n  tweet_text: "t"\n  models: []\n',
+            'default:\n  tweet_text: "t"\n  models:\n    - {model: "m", style: "vivid"}\n',
+            'default:\n  tweet_text: "t"\n  accounts: [silver, {name: silver}]\n',
+            'default:\n  tweet_text: "t"\n  accounts:\n    - {name: "a", token: "secret"}\n',
+        ]
+        for i, text in enumerate(cases):
+            self.write(text, mtime=3_000_000 + i)
+            with self.subTest(text=text), self.assertRaises(ConfigError):
+                get_preset("default", self.path)
+
+    def test_models_are_normalized_and_replaced_by_child(self):
+        self.write("""
+            default:
+              tweet_text: "t"
+              models:
+                - dall-e-3
+                - {model: dall-e-2, size: 512x512}
+            small:
+              models: [dall-e-2]
+        """)
+        self.assertEqual(
+            get_preset("default", self.path)["models"],
+            (("dall-e-3", None, None), ("dall-e-2", "512x512", None)),
+        )
+        self.assertEqual(get_preset("small", self.path)["models"], (("dall-e-2", None, None),))
+
+    def test_accounts_are_normalized(self):
+        self.write("""
+            default:
+              tweet_text: "t"
+              accounts:
+                - silver
+                - {name: gold, env_prefix: GOLD_, user_id: "42", tweet_text: "#gold"}
+        """)
+        self.assertEqual(
+            get_preset("default", self.path)["accounts"],
+            (("silver", None, None, None), ("gold", "GOLD_", "42", "#gold")),
+        )
+
+    def test_unknown_preset(self):
+        self.write('default:\n  tweet_text: "t"\n')
+        with self.assertRaises(ConfigError):
+            get_preset("missing", self.path)
+
+    def test_repository_config_is_valid(self):
+        os.environ.pop("PROMPT_CONFIG_PATH", None)
+        for name in ("default", "silver", "gold", "red"):
+            config = load_config_from_yaml(name)
+            self.assertEqual(set(config["prompt"]), set(PROMPT_DEFAULTS))
+            self.assertTrue(config["tweet_text"])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,165 @@
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from daemon import CronSchedule, ImageBuffer, PostingDaemon, ReadyImage
+from policy_retry import CircuitOpenError
+
+
+class TestCronSchedule(unittest.TestCase):
+
+    def test_every_six_hours(self):
+        schedule = CronSchedule("0 */6 * * *")
+        start = datetime(2026, 10, 17, 5, 59, 30, tzinfo=timezone.utc)
+        first = schedule.next_after(start)
+        self.assertEqual(first, datetime(2026, 10, 17, 6, 0, tzinfo=timezone.utc))
+        self.assertEqual(schedule.next_after(first), datetime(2026, 10, 17, 12, 0, tzinfo=timezone.utc))
+
+    def test_weekdays_ranges_and_lists(self):
+        # 2026-10-17 は土曜日
+        schedule = CronSchedule("15,45 9-10 * * 1-5")
+        start = datetime(2026, 10, 17, 12, 0, tzinfo=timezone.utc)
+        self.assertEqual(schedule.next_after(start), datetime(2026, 10, 19, 9, 15, tzinfo=timezone.utc))
+        self.assertEqual(CronSchedule("0 0 * * 7").next_after(start).weekday(), 6)
+
+    def test_invalid_expression(self):
+        for expr in ("0 */6 * *", "60 * * * *", "0 0 * * 8"):
+            with self.subTest(expr=expr), self.assertRaises(ValueError):
+                CronSchedule(expr)
+
+
+class TestImageBuffer(unittest.TestCase):
+
+    def test_persisted_images_survive_restart_in_order(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            buffer = ImageBuffer(2, tmp)
+            buffer.put(ReadyImage("p1", "t1", b"one", 1.0))
+            buffer.put(ReadyImage("p2", "t2", b"two", 2.0))
+            self.assertTrue(buffer.is_full())
+
+            restarted = ImageBuffer(2, tmp)
+            self.assertEqual(len(restarted), 2)
+            with restarted.take() as image:
+                self.assertEqual(image.data, b"one")
+            self.assertEqual(len(ImageBuffer(2, tmp)), 1)
+
+    def test_failed_take_returns_image_to_front(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            buffer = ImageBuffer(2, tmp)
+            buffer.put(ReadyImage("p1", "t1", b"one", 1.0))
+            buffer.put(ReadyImage("p2", "t2", b"two", 2.0))
+            with self.assertRaises(RuntimeError), buffer.take():
+                raise RuntimeError("upload failed")
+            self.assertEqual(len(buffer), 2)
+            # ファイルも残っているので再起動しても失われない
+            with ImageBuffer(2, tmp).take() as image:
+                self.assertEqual(image.data, b"one")
+
+
+    def test_image_being_posted_keeps_its_slot(self):
+        buffer = ImageBuffer(1)
+        buffer.put(ReadyImage("p1", "t1", b"one", 1.0))
+        with self.assertRaises(RuntimeError), buffer.take():
+            # 投稿中は補充しないので、失敗して戻しても容量を超えない
+            self.assertTrue(buffer.is_full())
+            raise RuntimeError("upload failed")
+        self.assertEqual(len(buffer), 1)
+        with buffer.take():
+            pass
+        self.assertFalse(buffer.is_full())
+
+
+class TestPostingDaemon(unittest.TestCase):
+
+    def make_daemon(self, post, generate=None, **kwargs):
+        generated = []
+
+        def default_generate(prompt, preset):
+            generated.append(preset)
+            return f"image-{preset}-{len(generated)}".encode()
+
+        daemon = PostingDaemon(
+            ["silver", "gold"],
+            build_job=lambda preset: (f"prompt {preset}", f"tweet {preset}"),
+            generate=generate or default_generate,
+            post=post,
+            buffer_size=2,
+            buffer_dir=None,
+            generate_interval=0,
+            **kwargs,
+        )
+        return daemon, generated
+
+    def test_refill_balances_presets_and_stops_when_full(self):
+        daemon, generated = self.make_daemon(post=None)
+        while (preset := daemon._next_preset()) is not None:
+            daemon.refill_once(preset)
+        self.assertEqual(generated, ["silver", "gold", "silver", "gold"])
+        self.assertTrue(all(buffer.is_full() for buffer in daemon.buffers.values()))
+
+    def test_paused_or_failing_presets_are_not_refilled(self):
+        def generate(prompt, preset):
+            raise RuntimeError("boom")
+
+        daemon, _ = self.make_daemon(post=None, generate=generate, is_paused=lambda preset: preset == "gold")
+        self.assertEqual(daemon._next_preset(), "silver")
+        self.assertFalse(daemon.refill_once("silver"))
+        self.assertIsNone(daemon._next_preset())
+
+    def test_post_uses_buffer_then_falls_back_to_generation(self):
+        posts = []
+
+        def post(prompt, tweet_text, preset, image_bytes):
+            posts.append((preset, image_bytes))
+            if preset == "gold":
+                raise CircuitOpenError("open")
+            return "tweet-" + preset
+
+        daemon, _ = self.make_daemon(post=post)
+        daemon.refill_once("silver")
+        self.assertEqual(daemon.post_all(), {"silver": "tweet-silver", "gold": None})
+        self.assertEqual(sorted(posts), [("gold", None), ("silver", b"image-silver-1")])
+        self.assertEqual(len(daemon.buffers["silver"]), 0)
+
+    def test_failed_post_keeps_buffered_image_for_next_time(self):
+        posts = []
+
+        def post(prompt, tweet_text, preset, image_bytes):
+            posts.append(image_bytes)
+            if len(posts) == 1:
+                raise RuntimeError("media_upload failed")
+            return "tweet-" + preset
+
+        daemon, generated = self.make_daemon(post=post)
+        daemon.refill_once("silver")
+        self.assertIsNone(daemon.post_one("silver"))
+        self.assertEqual(len(daemon.buffers["silver"]), 1)
+        self.assertEqual(daemon.post_one("silver"), "tweet-silver")
+        self.assertEqual(posts, [b"image-silver-1", b"image-silver-1"])
+        self.assertEqual(generated, ["silver"])
+        self.assertEqual(len(daemon.buffers["silver"]), 0)
+
+    def test_run_posts_at_schedule_and_stops_gracefully(self):
+        posted = threading.Event()
+
+        class Soon:
+            def next_after(self, moment):
+                return moment + timedelta(milliseconds=50)
+
+        def post(prompt, tweet_text, preset, image_bytes):
+            posted.set()
+            daemon.stop()
+            return "tweet"
+
+        daemon, _ = self.make_daemon(post=post, schedule=Soon())
+        runner = threading.Thread(target=daemon.run, kwargs={"install_signal_handlers": False})
+        runner.start()
+        runner.join(timeout=5)
+        self.assertFalse(runner.is_alive())
+        self.assertTrue(posted.is_set())
+        self.assertTrue(daemon.stopping)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import time
+import tempfile
+import unittest
+
+from image_cache import (
+    ImageCache,
+    image_cache_key,
+    POLICY_FRESH,
+    POLICY_REUSE,
+    POLICY_REUSE_UNPOSTED,
+)
+
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = ImageCache(self.tmp.name, max_bytes=1024, max_age=3600)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_key_depends_on_all_parameters(self):
+        base = image_cache_key("a cat", "dall-e-3", "1024x1024", "standard")
+        self.assertEqual(base, image_cache_key("a cat", "dall-e-3", "1024x1024", "standard"))
+        self.assertNotEqual(base, image_cache_key("a cat", "dall-e-3", "1024x1024", "hd"))
+        self.assertNotEqual(base, image_cache_key("a dog", "dall-e-3", "1024x1024", "standard"))
+
+    def test_policies(self):
+        key = image_cache_key("a cat", "dall-e-3", "1024x1024", "standard")
+        self.cache.put(key, b"image")
+        self.assertEqual(self.cache.get(key, POLICY_REUSE_UNPOSTED), b"image")
+        self.assertIsNone(self.cache.get(key, POLICY_FRESH))
+
+        self.cache.mark_posted(key)
+        self.assertIsNone(self.cache.get(key, POLICY_REUSE_UNPOSTED))
+        self.assertEqual(self.cache.get(key, POLICY_REUSE), b"image")
+
+    def test_get_any_returns_first_usable_key(self):
+        self.cache.put("small", b"small")
+        self.cache.put("posted", b"posted")
+        self.cache.mark_posted("posted")
+        self.assertEqual(self.cache.get_any(["missing", "posted", "small"]), ("small", b"small"))
+        self.assertEqual(self.cache.get_any(["missing"], POLICY_REUSE), (None, None))
+
+    def test_writer_commits_only_on_success(self):
+        key = image_cache_key("a cat", "dall-e-3", "1024x1024", "standard")
+        with self.assertRaises(ConnectionError):
+            with self.cache.writer(key) as f:
+                f.write(b"half")
+                raise ConnectionError("reset")
+        self.assertIsNone(self.cache.get(key, POLICY_REUSE))
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+        with self.cache.writer(key) as f:
+            f.write(b"ima")
+            f.write(b"ge")
+        self.assertEqual(self.cache.get(key, POLICY_REUSE), b"image")
+
+    def test_put_leaves_no_temp_files(self):
+        self.cache.put("k", b"image")
+        self.assertEqual(os.listdir(self.tmp.name), ["k.png"])
+
+    def test_evicts_least_recently_used_over_budget(self):
+        now = time.time()
+        for i, key in enumerate(["old", "mid"]):
+            self.cache.put(key, b"x" * 400)
+            os.utime(self.cache.path(key), (now - 100 + i, now - 100 + i))
+        # old を読み出して最近使ったことにする
+        self.assertIsNotNone(self.cache.get("old", POLICY_REUSE))
+        self.cache.put("new", b"x" * 400)
+        self.assertIsNone(self.cache.get("mid", POLICY_REUSE))
+        self.assertIsNotNone(self.cache.get("old", POLICY_REUSE))
+        self.assertIsNotNone(self.cache.get("new", POLICY_REUSE))
+
+    def test_expired_entries_are_ignored(self):
+        self.cache.put("k", b"image")
+        past = time.time() - 7200
+        os.utime(self.cache.path("k"), (past, past))
+        self.assertIsNone(self.cache.get("k", POLICY_REUSE))
+        self.assertFalse(os.path.exists(self.cache.path("k")))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,18 @@
+import unittest
+
+from check_import_time import FORBIDDEN_IMPORTS, heavy_imports, is_script, measure
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_entry_points_do_not_import_heavy_modules(self):
+        for module in FORBIDDEN_IMPORTS:
+            with self.subTest(module=module):
+                _, imported = measure(module)
+                if not is_script(module):
+                    self.assertIn(module, imported)
+                self.assertEqual(heavy_imports(module, imported), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import time
+import tempfile
+import unittest
+
+from job_journal import (
+    JobJournal,
+    STAGE_PENDING,
+    STAGE_DOWNLOADED,
+    STAGE_UPLOADED,
+    STAGE_POSTED,
+    MEDIA_ID_TTL,
+)
+
+
+class TestJobJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.journal = JobJournal(os.path.join(self.tmp.name, "journal.sqlite3"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_open_job_resumes_unfinished_job(self):
+        job = self.journal.open_job("silver", "a cat", "tweet")
+        self.assertEqual(job.stage, STAGE_PENDING)
+        again = self.journal.open_job("silver", "a cat", "tweet")
+        self.assertEqual(again.id, job.id)
+        self.assertEqual(again.attempts, 2)
+        self.assertNotEqual(self.journal.open_job("gold", "a cat", "tweet").id, job.id)
+
+    def test_stage_progression_and_image_lifecycle(self):
+        job = self.journal.open_job("silver", "a cat", "tweet")
+        job = self.journal.record_image(job, b"image")
+        self.assertEqual(job.stage, STAGE_DOWNLOADED)
+        self.assertEqual(self.journal.load_image(job), b"image")
+
+        job = self.journal.record_upload(job, 12345)
+        self.assertEqual(job.stage, STAGE_UPLOADED)
+        self.assertEqual(self.journal.reusable_media_id(job), "12345")
+
+        job = self.journal.record_posted(job, "98765")
+        self.assertEqual(job.stage, STAGE_POSTED)
+        self.assertFalse(os.path.exists(job.image_path))
+        # 完了後の同じプロンプトは新しいジョブになる
+        self.assertNotEqual(self.journal.open_job("silver", "a cat", "tweet").id, job.id)
+
+    def test_expired_media_id_is_not_reused(self):
+        job = self.journal.record_upload(self.journal.open_job("silver", "a cat", "tweet"), 1)
+        expired = job._replace(uploaded_at=time.time() - MEDIA_ID_TTL - 1)
+        self.assertIsNone(self.journal.reusable_media_id(expired))
+
+    def test_error_keeps_stage_and_lists_as_unfinished(self):
+        job = self.journal.record_image(self.journal.open_job("silver", "a cat", "tweet"), b"image")
+        job = self.journal.record_error(job, RuntimeError("upload failed"))
+        self.assertEqual(job.stage, STAGE_DOWNLOADED)
+        self.assertIn("upload failed", job.error)
+        self.assertEqual([j.id for j in self.journal.list_jobs()], [job.id])
+        self.journal.abandon(job.id)
+        self.assertEqual(self.journal.list_jobs(), [])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from local_test import download_image
+
+
+class TestDownloadImage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "image.png")
+
+    def session_with_chunks(self, chunks):
+        response = MagicMock()
+        response.__enter__.return_value = response
+        response.iter_content.return_value = chunks
+        session = MagicMock()
+        session.get.return_value = response
+        return session
+
+    def test_writes_the_image_and_returns_its_hash(self):
+        with patch('local_test.get_http_session', return_value=self.session_with_chunks([b"ab", b"c"])):
+            digest = download_image("http://example.com/image.png", self.path)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"abc")
+        self.assertEqual(digest, "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad")
+        self.assertEqual(os.listdir(self.tmp.name), ["image.png"])
+
+    def test_interrupted_download_leaves_no_part_file(self):
+        def chunks():
+            yield b"partial"
+            raise ConnectionError("connection reset")
+
+        with patch('local_test.get_http_session', return_value=self.session_with_chunks(chunks())):
+            with self.assertRaises(ConnectionError):
+                download_image("http://example.com/image.png", self.path)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
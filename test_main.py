@@ -1,7 +1,19 @@
+import os
+import base64
+import tempfile
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock, call
 
-from main import generate_and_post_image
+from main import generate_and_post_image, agenerate_and_post_image, run_generate_and_post_jobs, fan_out_post_image, \
+    DuplicateGate, MAX_DUPLICATE_RETRIES
+from phash_index import DuplicateImageError
+from rate_limit import reset_limiters
+from job_journal import JobJournal, STAGE_POSTED, STAGE_UPLOADED
+from generate_prompt import generate_image_prompt
+from policy_retry import PolicyRetry, CircuitOpenError
+from model_router import Backend, ModelRouter
+from clients import TwitterAccount, TwitterCredentials
+from image_cache import ImageCache, image_cache_key, POLICY_REUSE
 
 class MockRequestsException(Exception):
     pass
@@ -18,6 +30,7 @@ class MockOpenAIBadRequestError(Exception):
 class TestGenerateAndPostImage(unittest.TestCase):
 
     def setUp(self):
+        reset_limiters()
         self.mock_openai_success_response = MagicMock()
         self.mock_openai_success_response.data[0].url = "http://example.com/fake_image.png"
         self.mock_requests_success_response = MagicMock()
@@ -33,13 +46,14 @@ class TestGenerateAndPostImage(unittest.TestCase):
         self.mock_client_v2.create_tweet.return_value = self.mock_tweet
 
     def test_success_on_first_try(self):
-        with patch('main.OpenAI') as mock_openai_class, \
-             patch('main.requests.get') as mock_requests_get, \
+        with patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.get_http_session') as mock_http_session, \
              patch('main.setup_twitter_clients') as mock_setup_clients, \
              patch('main.os.path.exists', return_value=True) as mock_os_exists, \
              patch('main.os.remove') as mock_os_remove, \
              patch('main.time.sleep') as mock_time_sleep:
             mock_openai_client = mock_openai_class.return_value
+            mock_requests_get = mock_http_session.return_value.get
             mock_openai_client.images.generate.return_value = self.mock_openai_success_response
             mock_requests_get.return_value = self.mock_requests_success_response
             mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
@@ -49,16 +63,189 @@ class TestGenerateAndPostImage(unittest.TestCase):
             mock_time_sleep.assert_not_called()
             mock_os_remove.assert_called_once()
 
+    def test_b64_json_uploads_from_memory_without_download(self):
+        b64_response = MagicMock()
+        b64_response.data[0].b64_json = base64.b64encode(b"fake_image_data").decode()
+        with patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.get_http_session') as mock_http_session, \
+             patch('main.setup_twitter_clients') as mock_setup_clients, \
+             patch('main.open', create=True) as mock_open, \
+             patch('main.time.sleep'):
+            mock_openai_client = mock_openai_class.return_value
+            mock_requests_get = mock_http_session.return_value.get
+            mock_openai_client.images.generate.return_value = b64_response
+            mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
+            result = generate_and_post_image("a cute cat", "test tweet", response_format="b64_json")
+            self.assertEqual(result, "98765")
+            _, kwargs = mock_openai_client.images.generate.call_args
+            self.assertEqual(kwargs['response_format'], "b64_json")
+            mock_requests_get.assert_not_called()
+            mock_open.assert_not_called()
+            _, upload_kwargs = self.mock_api_v1.media_upload.call_args
+            self.assertEqual(upload_kwargs['file'].read(), b"fake_image_data")
+
+    def test_cached_unposted_image_skips_generation(self):
+        cache = MagicMock()
+        cache.get_any.return_value = ("key", b"cached_image_data")
+        with patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.get_http_session') as mock_http_session, \
+             patch('main.setup_twitter_clients') as mock_setup_clients:
+            mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
+            result = generate_and_post_image("a cute cat", "test tweet", cache=cache)
+            self.assertEqual(result, "98765")
+            mock_openai_class.return_value.images.generate.assert_not_called()
+            mock_http_session.return_value.get.assert_not_called()
+            _, upload_kwargs = self.mock_api_v1.media_upload.call_args
+            self.assertEqual(upload_kwargs['file'].read(), b"cached_image_data")
+            cache.mark_posted.assert_called_once()
+
+    def test_cache_is_keyed_by_the_backend_that_generated_the_image(self):
+        small = Backend("dall-e-2", "512x512", "standard")
+        router = ModelRouter(None)
+        b64_response = MagicMock()
+        b64_response.data[0].b64_json = base64.b64encode(b"small_image").decode()
+        with tempfile.TemporaryDirectory() as tmp, \
+             patch.object(router, "backends_for", return_value=[small]), \
+             patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.setup_twitter_clients') as mock_setup_clients:
+            cache = ImageCache(tmp)
+            # 許可されていないモデル・品質で生成済みの画像は再利用しない
+            cache.put(image_cache_key("a cat", "dall-e-3", "1024x1024", "hd"), b"hd_image")
+            mock_openai_class.return_value.images.generate.return_value = b64_response
+            mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
+            for _ in range(2):
+                generate_and_post_image(
+                    "a cat", "test tweet", "b64_json", cache=cache, cache_policy=POLICY_REUSE, router=router
+                )
+                self.assertEqual(self.mock_api_v1.media_upload.call_args.kwargs["file"].getvalue(), b"small_image")
+            # 2回目は dall-e-2 のキーで保存した画像を再利用する
+            mock_openai_class.return_value.images.generate.assert_called_once()
+            self.assertEqual(mock_openai_class.return_value.images.generate.call_args.kwargs["model"], "dall-e-2")
+            self.assertTrue(cache.is_posted(image_cache_key("a cat", *small)))
+
+    def test_duplicate_image_is_regenerated_before_upload(self):
+        first, second = MagicMock(), MagicMock()
+        first.data[0].b64_json = base64.b64encode(b"duplicate_image").decode()
+        second.data[0].b64_json = base64.b64encode(b"fresh_image").decode()
+        dedup_index = MagicMock()
+        dedup_index.hash_image.side_effect = lambda data: len(data)
+        dedup_index.find_similar.side_effect = [[MagicMock(distance=2, label="silver:1")], []]
+        with patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.setup_twitter_clients') as mock_setup_clients:
+            mock_openai_class.return_value.images.generate.side_effect = [first, second]
+            mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
+            result = generate_and_post_image(
+                "a cute cat", "test tweet", response_format="b64_json", dedup_index=dedup_index
+            )
+            self.assertEqual(result, "98765")
+            self.assertEqual(mock_openai_class.return_value.images.generate.call_count, 2)
+            _, upload_kwargs = self.mock_api_v1.media_upload.call_args
+            self.assertEqual(upload_kwargs['file'].read(), b"fresh_image")
+            # 生成した画像は重複していたものも含めて記録し、投稿した画像は投稿済みとして記録する
+            self.assertEqual(dedup_index.add.call_args_list, [
+                call(len(b"duplicate_image"), "generated", label="default"),
+                call(len(b"fresh_image"), "generated", label="default"),
+                call(len(b"fresh_image"), "posted", label="default:98765"),
+            ])
+
+    def test_transcoder_output_is_uploaded_with_its_filename(self):
+        b64_response = MagicMock()
+        b64_response.data[0].b64_json = base64.b64encode(b"fake_image_data").decode()
+        transcoder = MagicMock()
+        transcoder.return_value.data = b"small_jpeg"
+        transcoder.return_value.filename = "image.jpg"
+        with patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.setup_twitter_clients') as mock_setup_clients:
+            mock_openai_class.return_value.images.generate.return_value = b64_response
+            mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
+            generate_and_post_image(
+                "a cute cat", "test tweet", response_format="b64_json", transcoder=transcoder
+            )
+            transcoder.assert_called_once_with(b"fake_image_data")
+            upload_args, upload_kwargs = self.mock_api_v1.media_upload.call_args
+            self.assertEqual(upload_args, ("image.jpg",))
+            self.assertEqual(upload_kwargs['file'].read(), b"small_jpeg")
+
+    def test_stream_upload_pipes_url_into_chunked_upload(self):
+        with patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.get_http_session') as mock_http_session, \
+             patch('main.setup_twitter_clients') as mock_setup_clients, \
+             patch('main.stream_image_upload') as mock_stream_upload:
+            mock_openai_class.return_value.images.generate.return_value.data[0].url = "https://example.com/image.png"
+            mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
+            mock_stream_upload.return_value.media_id = "streamed"
+            result = generate_and_post_image("a cute cat", "test tweet", stream_upload=True)
+            self.assertEqual(result, "98765")
+            mock_stream_upload.assert_called_once_with(self.mock_api_v1, "https://example.com/image.png")
+            mock_http_session.return_value.get.assert_not_called()
+            self.mock_api_v1.media_upload.assert_not_called()
+            _, tweet_kwargs = self.mock_client_v2.create_tweet.call_args
+            self.assertEqual(tweet_kwargs['media_ids'], ["streamed"])
+
+    def test_journal_resumes_after_upload_without_regenerating(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = JobJournal(os.path.join(tmp, "journal.sqlite3"))
+            job = journal.open_job("silver", "a cute cat", "test tweet")
+            job = journal.record_upload(journal.record_image(job, b"fake_image_data"), "12345")
+            with patch('main.get_openai_client') as mock_openai_class, \
+                 patch('main.setup_twitter_clients') as mock_setup_clients:
+                mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
+                result = generate_and_post_image(
+                    "a cute cat", "test tweet", journal=journal, preset="silver"
+                )
+            self.assertEqual(result, "98765")
+            mock_openai_class.return_value.images.generate.assert_not_called()
+            self.mock_api_v1.media_upload.assert_not_called()
+            self.mock_client_v2.create_tweet.assert_called_once_with(text="test tweet", media_ids=["12345"])
+            self.assertEqual(journal.get(job.id).stage, STAGE_POSTED)
+
+    def test_journal_resumes_streamed_upload_without_regenerating(self):
+        # ストリーミング時はジャーナルに画像が残らないので、media_id だけで再開する
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = JobJournal(os.path.join(tmp, "journal.sqlite3"))
+            journal.record_upload(journal.open_job("silver", "a cute cat", "test tweet"), "12345")
+            with patch('main.get_openai_client') as mock_openai_class, \
+                 patch('main.setup_twitter_clients') as mock_setup_clients, \
+                 patch('main.stream_image_upload') as mock_stream_upload:
+                mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
+                result = generate_and_post_image(
+                    "a cute cat", "test tweet", journal=journal, preset="silver", stream_upload=True
+                )
+            self.assertEqual(result, "98765")
+            mock_openai_class.return_value.images.generate.assert_not_called()
+            mock_stream_upload.assert_not_called()
+            self.mock_client_v2.create_tweet.assert_called_once_with(text="test tweet", media_ids=["12345"])
+
+    def test_journal_records_error_stage(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = JobJournal(os.path.join(tmp, "journal.sqlite3"))
+            self.mock_client_v2.create_tweet.side_effect = RuntimeError("tweet failed")
+            b64_response = MagicMock()
+            b64_response.data[0].b64_json = base64.b64encode(b"fake_image_data").decode()
+            with patch('main.get_openai_client') as mock_openai_class, \
+                 patch('main.setup_twitter_clients') as mock_setup_clients:
+                mock_openai_class.return_value.images.generate.return_value = b64_response
+                mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
+                with self.assertRaises(RuntimeError):
+                    generate_and_post_image(
+                        "a cute cat", "test tweet", "b64_json", journal=journal, preset="silver"
+                    )
+            [job] = journal.list_jobs()
+            self.assertEqual(job.stage, STAGE_UPLOADED)
+            self.assertEqual(job.media_id, "12345")
+            self.assertIn("tweet failed", job.error)
+
     def test_retry_on_content_policy_and_succeed(self):
         with patch('main.APIError', new=MockOpenAIAPIError), \
              patch('main.BadRequestError', new=MockOpenAIBadRequestError), \
-             patch('main.OpenAI') as mock_openai_class, \
-             patch('main.requests.get') as mock_requests_get, \
+             patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.get_http_session') as mock_http_session, \
              patch('main.setup_twitter_clients') as mock_setup_clients, \
              patch('main.os.path.exists') as mock_os_exists, \
              patch('main.os.remove') as mock_os_remove, \
              patch('main.time.sleep') as mock_time_sleep:
             mock_openai_client = mock_openai_class.return_value
+            mock_requests_get = mock_http_session.return_value.get
             mock_openai_client.images.generate.side_effect = [
                 MockOpenAIBadRequestError("Blocked by content filter.", code='content_policy_violation'),
                 self.mock_openai_success_response
@@ -71,16 +258,168 @@ class TestGenerateAndPostImage(unittest.TestCase):
             mock_time_sleep.assert_called_once()
             self.mock_client_v2.create_tweet.assert_called_once()
 
+    def test_pregenerated_image_is_posted_without_generation(self):
+        with patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.get_http_session') as mock_http_session, \
+             patch('main.setup_twitter_clients') as mock_setup_clients:
+            mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
+            result = generate_and_post_image("a cat", "test tweet", image_bytes=b"buffered")
+            self.assertEqual(result, "98765")
+            mock_openai_class.return_value.images.generate.assert_not_called()
+            mock_http_session.return_value.get.assert_not_called()
+            upload_file = self.mock_api_v1.media_upload.call_args.kwargs["file"]
+            self.assertEqual(upload_file.getvalue(), b"buffered")
+
+    def test_pregenerated_image_wins_over_other_journaled_image(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = JobJournal(os.path.join(tmp, "journal.sqlite3"))
+            job = journal.open_job("silver", "a cat", "test tweet")
+            journal.record_upload(journal.record_image(job, b"journaled"), "stale")
+            with patch('main.get_openai_client') as mock_openai_class, \
+                 patch('main.setup_twitter_clients') as mock_setup_clients:
+                mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
+                result = generate_and_post_image(
+                    "a cat", "test tweet", journal=journal, preset="silver", image_bytes=b"buffered"
+                )
+            self.assertEqual(result, "98765")
+            mock_openai_class.return_value.images.generate.assert_not_called()
+            upload_file = self.mock_api_v1.media_upload.call_args.kwargs["file"]
+            self.assertEqual(upload_file.getvalue(), b"buffered")
+            self.mock_client_v2.create_tweet.assert_called_once_with(text="test tweet", media_ids=["12345"])
+            self.assertEqual(journal.get(job.id).stage, STAGE_POSTED)
+
+    def test_policy_retry_rewrites_prompt_without_waiting(self):
+        with tempfile.TemporaryDirectory() as tmp, \
+             patch('main.APIError', new=MockOpenAIAPIError), \
+             patch('main.BadRequestError', new=MockOpenAIBadRequestError), \
+             patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.get_http_session') as mock_http_session, \
+             patch('main.setup_twitter_clients') as mock_setup_clients, \
+             patch('main.time.sleep') as mock_time_sleep:
+            policy = PolicyRetry(os.path.join(tmp, "policy.json"), failure_threshold=1)
+            mock_openai_client = mock_openai_class.return_value
+            mock_openai_client.images.generate.side_effect = [
+                MockOpenAIBadRequestError("Blocked by content filter.", code='content_policy_violation'),
+                self.mock_openai_success_response,
+            ]
+            mock_http_session.return_value.get.return_value = self.mock_requests_success_response
+            mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
+            prompt = generate_image_prompt(clothing="A black bikini")
+            result = generate_and_post_image(prompt, "test tweet", preset="silver", policy=policy)
+
+            self.assertEqual(result, "98765")
+            mock_time_sleep.assert_not_called()
+            prompts = [c.kwargs["prompt"] for c in mock_openai_client.images.generate.call_args_list]
+            self.assertEqual(prompts[0], prompt)
+            self.assertNotIn("A black bikini", prompts[1])
+            self.assertEqual(policy.tripped_values("silver"), {"clothing": ["A black bikini"]})
+
+            # 書き換えても通らないジョブが続いたプリセットは API を呼ばずに止める
+            mock_openai_client.images.generate.reset_mock()
+            mock_openai_client.images.generate.side_effect = [
+                MockOpenAIBadRequestError("Blocked.", code='content_policy_violation')
+            ] * 3
+            with self.assertRaises(MockOpenAIBadRequestError):
+                generate_and_post_image(prompt, "test tweet", preset="silver", policy=policy)
+            with self.assertRaises(CircuitOpenError):
+                generate_and_post_image(prompt, "test tweet", preset="silver", policy=policy)
+            self.assertEqual(mock_openai_client.images.generate.call_count, 3)
+
+    def test_router_moves_to_another_model_after_server_error(self):
+        router = ModelRouter(None)
+        backends = [Backend("dall-e-3", "1024x1024", "standard"), Backend("dall-e-2", "512x512", "standard")]
+        with patch('main.APIError', new=MockOpenAIAPIError), \
+             patch('main.BadRequestError', new=MockOpenAIBadRequestError), \
+             patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.get_http_session') as mock_http_session, \
+             patch('main.setup_twitter_clients') as mock_setup_clients, \
+             patch('main.time.sleep'), \
+             patch.object(router, 'backends_for', return_value=backends):
+            mock_openai_client = mock_openai_class.return_value
+            mock_openai_client.images.generate.side_effect = [
+                MockOpenAIAPIError("Server error"),
+                self.mock_openai_success_response,
+            ]
+            mock_http_session.return_value.get.return_value = self.mock_requests_success_response
+            mock_setup_clients.return_value = (self.mock_api_v1, self.mock_client_v2)
+            result = generate_and_post_image("a cute cat", "test tweet", preset="small", router=router)
+
+            self.assertEqual(result, "98765")
+            calls = mock_openai_client.images.generate.call_args_list
+            self.assertEqual([(c.kwargs["model"], c.kwargs["size"]) for c in calls],
+                             [("dall-e-3", "1024x1024"), ("dall-e-2", "512x512")])
+
+    def test_fan_out_uploads_once_and_isolates_tweet_failures(self):
+        accounts = [
+            TwitterAccount(name, TwitterCredentials(name, "secret", f"{user_id}-token", "token-secret"))
+            for name, user_id in (("silver", 111), ("gold", 222), ("red", 333))
+        ]
+        twitter = {name: (MagicMock(), MagicMock()) for name in ("silver", "gold", "red")}
+        for index, (_, client_v2) in enumerate(twitter.values()):
+            client_v2.create_tweet.return_value.data = {'id': str(index)}
+        twitter["gold"][1].create_tweet.side_effect = RuntimeError("suspended")
+        twitter["silver"][0].media_upload.return_value = self.mock_media
+        image = base64.b64encode(b"fake_image_data").decode()
+        with patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.setup_twitter_clients', side_effect=lambda credentials: twitter[credentials.api_key]):
+            mock_openai_class.return_value.images.generate.return_value.data[0].b64_json = image
+            results = fan_out_post_image("a cute cat", "test tweet", accounts, "b64_json", preset="silver")
+
+            mock_openai_class.return_value.images.generate.assert_called_once()
+            twitter["silver"][0].media_upload.assert_called_once()
+            self.assertEqual(
+                twitter["silver"][0].media_upload.call_args.kwargs["additional_owners"], ["222", "333"]
+            )
+            twitter["gold"][0].media_upload.assert_not_called()
+            for name in ("silver", "red"):
+                twitter[name][1].create_tweet.assert_called_once_with(text="test tweet", media_ids=["12345"])
+            self.assertEqual(results["silver"], "0")
+            self.assertEqual(results["red"], "2")
+            self.assertIsInstance(results["gold"], RuntimeError)
+
+    def test_fan_out_regenerates_duplicates_before_the_single_upload(self):
+        accounts = [
+            TwitterAccount(name, TwitterCredentials(name, "secret", f"{user_id}-token", "token-secret"))
+            for name, user_id in (("silver", 111), ("gold", 222))
+        ]
+        twitter = {name: (MagicMock(), MagicMock()) for name in ("silver", "gold")}
+        for index, (_, client_v2) in enumerate(twitter.values()):
+            client_v2.create_tweet.return_value.data = {'id': str(index)}
+        twitter["silver"][0].media_upload.return_value = self.mock_media
+        first, second = MagicMock(), MagicMock()
+        first.data[0].b64_json = base64.b64encode(b"duplicate_image").decode()
+        second.data[0].b64_json = base64.b64encode(b"fresh_image").decode()
+        dedup_index = MagicMock()
+        dedup_index.hash_image.side_effect = lambda data: len(data)
+        dedup_index.find_similar.side_effect = [[MagicMock(distance=2, label="gold:1")], []]
+        with patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.setup_twitter_clients', side_effect=lambda credentials: twitter[credentials.api_key]):
+            mock_openai_class.return_value.images.generate.side_effect = [first, second]
+            results = fan_out_post_image(
+                "a cute cat", "test tweet", accounts, "b64_json", preset="silver", dedup_index=dedup_index
+            )
+
+        self.assertEqual(results, {"silver": "0", "gold": "1"})
+        twitter["silver"][0].media_upload.assert_called_once()
+        self.assertEqual(twitter["silver"][0].media_upload.call_args.kwargs["file"].getvalue(), b"fresh_image")
+        self.assertEqual(dedup_index.add.call_args_list, [
+            call(len(b"duplicate_image"), "generated", label="silver"),
+            call(len(b"fresh_image"), "generated", label="silver"),
+            call(len(b"fresh_image"), "posted", label="silver:0"),
+            call(len(b"fresh_image"), "posted", label="silver:1"),
+        ])
+
     def test_failure_after_max_retries(self):
         with patch('main.APIError', new=MockOpenAIAPIError), \
              patch('main.BadRequestError', new=MockOpenAIBadRequestError), \
-             patch('main.OpenAI') as mock_openai_class, \
-             patch('main.requests.get') as mock_requests_get, \
+             patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.get_http_session') as mock_http_session, \
              patch('main.setup_twitter_clients') as mock_setup_clients, \
              patch('main.os.path.exists') as mock_os_exists, \
              patch('main.os.remove') as mock_os_remove, \
              patch('main.time.sleep') as mock_time_sleep:
             mock_openai_client = mock_openai_class.return_value
+            mock_requests_get = mock_http_session.return_value.get
             mock_openai_client.images.generate.side_effect = [MockOpenAIAPIError("Server error")] * 3
             with self.assertRaises(MockOpenAIAPIError):
                 generate_and_post_image("a server-breaking cat", "test tweet")
@@ -92,13 +431,14 @@ class TestGenerateAndPostImage(unittest.TestCase):
     def test_failure_on_non_retryable_error(self):
         with patch('main.APIError', new=MockOpenAIAPIError), \
              patch('main.BadRequestError', new=MockOpenAIBadRequestError), \
-             patch('main.OpenAI') as mock_openai_class, \
-             patch('main.requests.get') as mock_requests_get, \
+             patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.get_http_session') as mock_http_session, \
              patch('main.setup_twitter_clients') as mock_setup_clients, \
              patch('main.os.path.exists') as mock_os_exists, \
              patch('main.os.remove') as mock_os_remove, \
              patch('main.time.sleep') as mock_time_sleep:
             mock_openai_client = mock_openai_class.return_value
+            mock_requests_get = mock_http_session.return_value.get
             mock_openai_client.images.generate.side_effect = [
                 MockOpenAIBadRequestError("Invalid prompt.", code='invalid_request_error')
             ]
@@ -112,14 +452,15 @@ class TestGenerateAndPostImage(unittest.TestCase):
         """.code属性を持たないBadRequestErrorで即座に失敗するケース"""
         with patch('main.APIError', new=MockOpenAIAPIError), \
              patch('main.BadRequestError', new=MockOpenAIBadRequestError), \
-             patch('main.OpenAI') as mock_openai_class, \
-             patch('main.requests.get') as mock_requests_get, \
+             patch('main.get_openai_client') as mock_openai_class, \
+             patch('main.get_http_session') as mock_http_session, \
              patch('main.setup_twitter_clients') as mock_setup_clients, \
              patch('main.os.path.exists') as mock_os_exists, \
              patch('main.os.remove') as mock_os_remove, \
              patch('main.time.sleep') as mock_time_sleep:
 
             mock_openai_client = mock_openai_class.return_value
+            mock_requests_get = mock_http_session.return_value.get
             # .code を持たないエラーを発生させる
             mock_openai_client.images.generate.side_effect = [
                 MockOpenAIBadRequestError("Generic bad request.")
@@ -132,5 +473,125 @@ class TestGenerateAndPostImage(unittest.TestCase):
             mock_time_sleep.assert_not_called()
 
 
+class TestAsyncGenerateAndPostImage(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        reset_limiters()
+        self.mock_openai_success_response = MagicMock()
+        self.mock_openai_success_response.data[0].url = "http://example.com/fake_image.png"
+        self.mock_http_response = MagicMock()
+        self.mock_http_response.content = b"fake_image_data"
+        self.mock_http_client = MagicMock()
+        self.mock_http_client.get = AsyncMock(return_value=self.mock_http_response)
+        self.mock_openai_client = MagicMock()
+        self.mock_openai_client.images.generate = AsyncMock()
+        self.mock_api_v1 = MagicMock()
+        self.mock_api_v1.media_upload.return_value.media_id = "12345"
+        self.mock_client_v2 = MagicMock()
+        self.mock_client_v2.create_tweet.return_value.data = {'id': "98765"}
+
+    async def _run(self, prompt):
+        return await agenerate_and_post_image(
+            prompt,
+            "test tweet",
+            client=self.mock_openai_client,
+            http_client=self.mock_http_client,
+            twitter_clients=(self.mock_api_v1, self.mock_client_v2),
+        )
+
+    async def test_success_uploads_from_memory(self):
+        self.mock_openai_client.images.generate.return_value = self.mock_openai_success_response
+        with patch('main.asyncio.sleep', new_callable=AsyncMock) as mock_sleep:
+            result = await self._run("a cute cat")
+        self.assertEqual(result, "98765")
+        mock_sleep.assert_not_called()
+        _, kwargs = self.mock_api_v1.media_upload.call_args
+        self.assertEqual(kwargs['file'].read(), b"fake_image_data")
+        self.mock_client_v2.create_tweet.assert_called_once_with(text="test tweet", media_ids=["12345"])
+
+    async def test_generated_and_posted_images_are_recorded_in_dedup_index(self):
+        self.mock_openai_client.images.generate.return_value = self.mock_openai_success_response
+        dedup_index = MagicMock()
+        dedup_index.hash_image.return_value = 42
+        dedup_index.find_similar.return_value = []
+        result = await agenerate_and_post_image(
+            "a cute cat", "test tweet", preset="silver",
+            client=self.mock_openai_client,
+            http_client=self.mock_http_client,
+            twitter_clients=(self.mock_api_v1, self.mock_client_v2),
+            dedup_index=dedup_index,
+        )
+        self.assertEqual(result, "98765")
+        self.assertEqual(dedup_index.add.call_args_list, [
+            call(42, "generated", label="silver"),
+            call(42, "posted", label="silver:98765"),
+        ])
+
+    async def test_retry_on_content_policy_and_succeed(self):
+        with patch('main.APIError', new=MockOpenAIAPIError), \
+             patch('main.BadRequestError', new=MockOpenAIBadRequestError), \
+             patch('main.asyncio.sleep', new_callable=AsyncMock) as mock_sleep:
+            self.mock_openai_client.images.generate.side_effect = [
+                MockOpenAIBadRequestError("Blocked by content filter.", code='content_policy_violation'),
+                self.mock_openai_success_response
+            ]
+            result = await self._run("a dangerous cat")
+        self.assertEqual(result, "98765")
+        self.assertEqual(self.mock_openai_client.images.generate.call_count, 2)
+        mock_sleep.assert_awaited_once()
+
+    async def test_failure_on_non_retryable_error(self):
+        with patch('main.APIError', new=MockOpenAIAPIError), \
+             patch('main.BadRequestError', new=MockOpenAIBadRequestError), \
+             patch('main.asyncio.sleep', new_callable=AsyncMock) as mock_sleep:
+            self.mock_openai_client.images.generate.side_effect = [
+                MockOpenAIBadRequestError("Invalid prompt.", code='invalid_request_error')
+            ]
+            with self.assertRaises(MockOpenAIBadRequestError):
+                await self._run("a very invalid cat")
+        self.mock_openai_client.images.generate.assert_called_once()
+        mock_sleep.assert_not_called()
+        self.mock_api_v1.media_upload.assert_not_called()
+
+    async def test_runner_isolates_failures(self):
+        async def fake_job(prompt, tweet_text, **kwargs):
+            if prompt == "bad":
+                raise RuntimeError("boom")
+            return f"id-{prompt}"
+
+        with patch('main.setup_twitter_clients', return_value=(MagicMock(), MagicMock())), \
+             patch('main.AsyncOpenAI'), \
+             patch('main.agenerate_and_post_image', side_effect=fake_job):
+            results = await run_generate_and_post_jobs(
+                [("a", "t"), ("bad", "t"), ("c", "t")], max_concurrency=2
+            )
+        self.assertEqual(results[0], "id-a")
+        self.assertIsInstance(results[1], RuntimeError)
+        self.assertEqual(results[2], "id-c")
+
+
+class TestDuplicateGate(unittest.TestCase):
+
+    def test_gives_up_after_max_retries_and_records_every_generated_image(self):
+        dedup_index = MagicMock()
+        dedup_index.hash_image.return_value = 7
+        dedup_index.find_similar.return_value = [MagicMock(distance=1, label="gold:1")]
+        gate = DuplicateGate(dedup_index, "silver")
+        for _ in range(MAX_DUPLICATE_RETRIES):
+            self.assertFalse(gate.check(b"image", generated=True))
+        with self.assertRaises(DuplicateImageError):
+            gate.check(b"image", generated=True)
+        self.assertEqual(dedup_index.add.call_count, MAX_DUPLICATE_RETRIES + 1)
+
+    def test_reused_image_is_not_recorded_as_generated(self):
+        dedup_index = MagicMock()
+        dedup_index.hash_image.return_value = 7
+        dedup_index.find_similar.return_value = []
+        gate = DuplicateGate(dedup_index, "silver")
+        self.assertTrue(gate.check(b"image", generated=False))
+        gate.record_posted("123")
+        dedup_index.add.assert_called_once_with(7, "posted", label="silver:123")
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,139 @@
+import os
+import json
+import asyncio
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from metrics import Metrics, NullMetrics, bind_labels, get_metrics, set_metrics, track_job
+from rate_limit import reset_limiters
+
+
+def find(series, name, **labels):
+    return [s for s in series if s["name"] == name and all(s["labels"].get(k) == v for k, v in labels.items())]
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_span_records_outcome_and_bound_labels(self):
+        registry = Metrics()
+        with bind_labels(preset="night"):
+            with registry.stage("generate"):
+                pass
+            with self.assertRaises(ValueError):
+                with registry.stage("generate"):
+                    raise ValueError("boom")
+        registry.inc("retries_total", endpoint="images.generate")
+        registry.inc("retries_total", endpoint="images.generate")
+
+        snapshot = registry.snapshot()
+        ok = find(snapshot["histograms"], "stage_seconds", stage="generate", preset="night", outcome="ok")
+        error = find(snapshot["histograms"], "stage_seconds", stage="generate", preset="night", outcome="error")
+        self.assertEqual((ok[0]["count"], error[0]["count"]), (1, 1))
+        retries = find(snapshot["counters"], "retries_total", endpoint="images.generate")
+        self.assertEqual(retries[0]["value"], 2)
+        # with ブロックを抜けたらラベルは外れる
+        registry.inc("jobs")
+        self.assertEqual(find(registry.snapshot()["counters"], "jobs")[0]["labels"], {})
+
+    def test_prometheus_histogram_is_cumulative(self):
+        registry = Metrics(buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            registry.observe("stage_seconds", value, stage="upload", preset='a"b')
+        text = registry.to_prometheus()
+        self.assertIn("# TYPE echo_stage_seconds histogram", text)
+        self.assertIn('echo_stage_seconds_bucket{preset="a\\"b",stage="upload",le="0.1"} 1', text)
+        self.assertIn('echo_stage_seconds_bucket{preset="a\\"b",stage="upload",le="1"} 2', text)
+        self.assertIn('echo_stage_seconds_bucket{preset="a\\"b",stage="upload",le="+Inf"} 3', text)
+        self.assertIn('echo_stage_seconds_count{preset="a\\"b",stage="upload"} 3', text)
+
+    def test_write_chooses_format_by_extension(self):
+        registry = Metrics()
+        registry.inc("bytes_uploaded_total", 10, preset="default")
+        with tempfile.TemporaryDirectory() as tmp:
+            registry.write(os.path.join(tmp, "metrics.json"))
+            registry.write(os.path.join(tmp, "metrics.prom"))
+            with open(os.path.join(tmp, "metrics.json"), encoding="utf-8") as f:
+                self.assertEqual(json.load(f)["counters"][0]["value"], 10)
+            with open(os.path.join(tmp, "metrics.prom"), encoding="utf-8") as f:
+                self.assertIn('echo_bytes_uploaded_total{preset="default"} 10', f.read())
+            self.assertEqual(sorted(os.listdir(tmp)), ["metrics.json", "metrics.prom"])
+
+    def test_null_metrics_records_nothing(self):
+        registry = NullMetrics()
+        with registry.stage("generate"), registry.span("job"):
+            registry.inc("retries_total")
+        snapshot = registry.snapshot()
+        self.assertEqual((snapshot["counters"], snapshot["histograms"]), ([], []))
+
+    def test_track_job_labels_async_jobs_by_preset(self):
+        registry = Metrics()
+        previous = set_metrics(registry)
+        self.addCleanup(set_metrics, previous)
+
+        @track_job
+        async def job(prompt, preset="default"):
+            await asyncio.to_thread(get_metrics().inc, "bytes_downloaded_total", 5)
+
+        async def run():
+            await asyncio.gather(job("a", preset="cat"), job("b"))
+
+        asyncio.run(run())
+        snapshot = registry.snapshot()
+        self.assertEqual(find(snapshot["counters"], "bytes_downloaded_total", preset="cat")[0]["value"], 5)
+        self.assertEqual(find(snapshot["counters"], "bytes_downloaded_total", preset="default")[0]["value"], 5)
+        self.assertEqual(len(find(snapshot["histograms"], "job_seconds")), 2)
+
+
+class MockBadRequestError(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class TestPipelineMetrics(unittest.TestCase):
+
+    def setUp(self):
+        reset_limiters()
+        self.registry = Metrics()
+        previous = set_metrics(self.registry)
+        self.addCleanup(set_metrics, previous)
+
+    def test_generate_and_post_image_reports_stages_and_counters(self):
+        from main import generate_and_post_image
+
+        generated = MagicMock()
+        generated.data[0].url = "http://example.com/fake_image.png"
+        downloaded = MagicMock()
+        downloaded.content = b"fake_image_data"
+        api_v1, client_v2 = MagicMock(), MagicMock()
+        api_v1.media_upload.return_value.media_id = "12345"
+        client_v2.create_tweet.return_value.data = {"id": "98765"}
+
+        with patch("main.APIError", new=MockBadRequestError), \
+             patch("main.BadRequestError", new=MockBadRequestError), \
+             patch("main.get_openai_client") as mock_openai, \
+             patch("main.get_http_session") as mock_session, \
+             patch("main.setup_twitter_clients", return_value=(api_v1, client_v2)), \
+             patch("main.time.sleep"):
+            mock_openai.return_value.images.generate.side_effect = [
+                MockBadRequestError("blocked", code="content_policy_violation"), generated,
+            ]
+            mock_session.return_value.get.return_value = downloaded
+            self.assertEqual(generate_and_post_image("a cat", "tweet", preset="cat"), "98765")
+
+        snapshot = self.registry.snapshot()
+        counters = {s["name"]: s for s in snapshot["counters"]}
+        self.assertEqual(counters["policy_violations_total"]["labels"], {"preset": "cat"})
+        self.assertEqual(counters["retries_total"]["labels"], {"endpoint": "images.generate", "preset": "cat"})
+        self.assertEqual(counters["bytes_downloaded_total"]["value"], len(b"fake_image_data"))
+        self.assertEqual(counters["bytes_uploaded_total"]["value"], len(b"fake_image_data"))
+        stages = {s["labels"]["stage"] for s in find(snapshot["histograms"], "stage_seconds", preset="cat")}
+        self.assertEqual(stages, {"generate", "download", "upload", "tweet"})
+        attempts = find(snapshot["histograms"], "attempt_seconds", endpoint="images.generate")
+        self.assertEqual({s["labels"]["outcome"]: s["count"] for s in attempts}, {"ok": 1, "error": 1})
+        self.assertEqual(find(snapshot["histograms"], "job_seconds", preset="cat", outcome="ok")[0]["count"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+import os
+import time
+import asyncio
+import contextvars
+import tempfile
+import textwrap
+import threading
+import unittest
+from unittest.mock import patch
+
+from model_router import Backend, ModelRouter
+
+FAST = Backend("fast", "1024x1024", "standard")
+SLOW = Backend("slow", "1024x1024", "standard")
+
+
+class TestModelRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "model_stats.json")
+
+    def warm_up(self, router, backend, latency, n=5):
+        for _ in range(n):
+            router.record(backend, latency, True)
+
+    def test_ranks_by_latency_and_persists_stats(self):
+        router = ModelRouter(self.path)
+        self.warm_up(router, SLOW, 2.0)
+        self.warm_up(router, FAST, 0.5)
+        self.assertEqual(router.rank([SLOW, FAST]), [FAST, SLOW])
+        self.assertEqual(router.rank([SLOW, FAST], exclude=[FAST]), [SLOW, FAST])
+        # 統計の無いバックエンドは速さを測るため先に試す
+        self.assertEqual(router.rank([FAST, Backend("new", "1024x1024", "standard")])[0].model, "new")
+
+        # 保存は save_interval 秒に1回までにまとめ、残りは flush() で書き出す
+        self.assertIsNone(ModelRouter(self.path).latency_quantile(FAST, 0.5))
+        router.flush()
+        restarted = ModelRouter(self.path)
+        self.assertEqual(restarted.latency_quantile(FAST, 0.5), 0.5)
+        self.assertEqual(restarted.rank([SLOW, FAST]), [FAST, SLOW])
+
+    def test_consecutive_errors_mark_backend_unhealthy_until_cooldown(self):
+        router = ModelRouter(None, max_consecutive_errors=2, cooldown=60)
+        self.warm_up(router, FAST, 0.5)
+        with patch("model_router.time.time", return_value=1000.0):
+            router.record(FAST, 0.1, False)
+            router.record(FAST, 0.1, False)
+            self.assertFalse(router.is_healthy(FAST))
+            self.assertEqual(router.rank([FAST, SLOW]), [SLOW, FAST])
+        with patch("model_router.time.time", return_value=1061.0):
+            self.assertTrue(router.is_healthy(FAST))
+
+    def test_errors_not_attributed_to_backend_are_not_recorded(self):
+        router = ModelRouter(None, max_consecutive_errors=1)
+
+        def fail(backend):
+            raise ValueError("policy")
+
+        with self.assertRaises(ValueError):
+            router.call([FAST], fail, is_backend_error=lambda e: False)
+        self.assertTrue(router.is_healthy(FAST))
+
+    def test_sync_hedge_returns_first_success(self):
+        router = ModelRouter(None, hedge_quantile=0.5, hedge_budget=1.0)
+        self.warm_up(router, FAST, 0.01)
+        self.warm_up(router, SLOW, 0.02)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def request(backend):
+            if backend == FAST:
+                release.wait(5)
+                return "primary"
+            return "hedge"
+
+        self.assertEqual(router.call([FAST, SLOW], request), "hedge")
+
+    def test_sync_hedge_keeps_context_and_caps_running_losers(self):
+        label = contextvars.ContextVar("label", default=None)
+        router = ModelRouter(None, hedge_quantile=0.5, hedge_budget=1.0, max_abandoned=1)
+        self.warm_up(router, FAST, 0.01)
+        self.warm_up(router, SLOW, 0.01)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        seen, calls = [], []
+
+        def request(backend):
+            seen.append(label.get())
+            calls.append(backend)
+            if len(calls) == 1:
+                release.wait(5)
+                return "slow primary"
+            time.sleep(0.05)
+            return "done"
+
+        label.set("silver")
+        self.assertEqual(router.call([FAST, SLOW], request), "done")
+        self.assertEqual(len(calls), 2)
+        # 1本目はまだ実行中なので、上限に達している間はヘッジしない
+        self.assertEqual(router.call([FAST, SLOW], request), "done")
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(seen, ["silver"] * 3)
+
+    def test_sync_hedging_does_not_cap_caller_concurrency(self):
+        router = ModelRouter(None, hedge_quantile=0.5, hedge_budget=1.0)
+        self.warm_up(router, FAST, 10.0)
+        barrier = threading.Barrier(12, timeout=5)
+        results = []
+
+        def call():
+            results.append(router.call([FAST], lambda backend: barrier.wait()))
+
+        threads = [threading.Thread(target=call) for _ in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 12件すべてが同時に実行されないとバリアを抜けられない
+        self.assertEqual(len(results), 12)
+
+    def test_concurrent_hedges_share_one_budget(self):
+        router = ModelRouter(None, hedge_quantile=0.5, hedge_budget=0.25, max_abandoned=100)
+        self.warm_up(router, FAST, 0.001)
+        calls = []
+        lock = threading.Lock()
+
+        def request(backend):
+            with lock:
+                calls.append(backend)
+            time.sleep(0.05)
+            return "ok"
+
+        threads = [threading.Thread(target=router.call, args=([FAST], request)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 8件のうちヘッジできるのは 25% の2件まで
+        self.assertLessEqual(len(calls), 10)
+
+    def test_async_hedge_cancels_loser(self):
+        router = ModelRouter(None, hedge_quantile=0.5, hedge_budget=1.0)
+        self.warm_up(router, FAST, 0.01)
+        cancelled = []
+
+        async def request(backend):
+            if not cancelled:
+                cancelled.append(False)
+                try:
+                    await asyncio.sleep(5)
+                except asyncio.CancelledError:
+                    cancelled[0] = True
+                    raise
+            return "hedge"
+
+        start = time.monotonic()
+        # バックエンドが1つしか無い場合は同じものにヘッジする
+        self.assertEqual(asyncio.run(router.acall([FAST], request)), "hedge")
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(cancelled, [True])
+
+    def test_hedges_stay_within_budget(self):
+        router = ModelRouter(None, hedge_quantile=0.5, hedge_budget=0.0)
+        self.warm_up(router, FAST, 0.001)
+        calls = []
+
+        def request(backend):
+            calls.append(backend)
+            time.sleep(0.02)
+            return "ok"
+
+        self.assertEqual(router.call([FAST], request), "ok")
+        self.assertEqual(calls, [FAST])
+
+    def test_backends_for_preset(self):
+        config_path = os.path.join(self.tmp.name, "prompt_config.yaml")
+        with open(config_path, "w", encoding="utf-8") as f:
+            f.write(textwrap.dedent("""
+                default:
+                  tweet_text: "t"
+                small:
+                  models:
+                    - dall-e-2
+                    - {model: dall-e-3, quality: hd}
+            """))
+        default = Backend("dall-e-3", "1024x1024", "standard")
+        router = ModelRouter(None)
+        with patch.dict(os.environ, {"PROMPT_CONFIG_PATH": config_path}):
+            self.assertEqual(
+                router.backends_for("small", default),
+                [Backend("dall-e-2", "1024x1024", "standard"), Backend("dall-e-3", "1024x1024", "hd")],
+            )
+            self.assertEqual(router.backends_for("default", default), [default])
+            self.assertEqual(router.backends_for("missing", default), [default])
+
+
+if __name__ == "__main__":
+    unittest.main()
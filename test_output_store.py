@@ -0,0 +1,78 @@
+import io
+import os
+import csv
+import json
+import hashlib
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from output_store import OutputStore, SHARD_WIDTH
+from job_journal import prompt_hash
+
+
+class TestOutputStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = OutputStore(self.tmp.name)
+
+    def test_put_is_content_addressed_and_sharded(self):
+        output = self.store.put(b"image", "silver", "a cat", model="dall-e-3", generate_seconds=1.5)
+        digest = hashlib.sha256(b"image").hexdigest()
+        self.assertEqual(output.sha256, digest)
+        self.assertEqual(output.path, os.path.join(self.tmp.name, digest[:SHARD_WIDTH], digest + ".png"))
+        with open(output.path, "rb") as f:
+            self.assertEqual(f.read(), b"image")
+
+        # 同じ内容は1ファイルだけ保存し、manifest には毎回追記する
+        again = self.store.put(b"image", "gold", "a dog", suffix=".png", source="cache")
+        self.assertEqual(again.path, output.path)
+        self.assertEqual(len(self.store.find(sha256=digest)), 2)
+        self.assertEqual(os.listdir(os.path.join(self.tmp.name, ".tmp")), [])
+
+    def test_add_file_moves_streamed_download(self):
+        tmp_path = self.store.temp_path()
+        with open(tmp_path, "wb") as f:
+            f.write(b"streamed")
+        output = self.store.add_file(tmp_path, "silver", "a cat", download_seconds=0.2)
+        self.assertFalse(os.path.exists(tmp_path))
+        self.assertEqual(output.sha256, hashlib.sha256(b"streamed").hexdigest())
+        self.assertEqual(output.bytes, len(b"streamed"))
+        self.assertEqual(output.download_seconds, 0.2)
+
+    def test_find_filters_and_orders_newest_first(self):
+        with patch("output_store.time.time", side_effect=[100.0, 200.0, 300.0]):
+            self.store.put(b"1", "silver", "a cat", model="dall-e-3")
+            self.store.put(b"2", "gold", "a cat", model="dall-e-2")
+            self.store.put(b"3", "silver", "a dog", model="dall-e-3")
+
+        self.assertEqual([o.prompt for o in self.store.find(preset="silver")], ["a dog", "a cat"])
+        self.assertEqual([o.preset for o in self.store.find(prompt="a cat")], ["gold", "silver"])
+        self.assertEqual(len(self.store.find(prompt_hash=prompt_hash("a cat"), model="dall-e-3")), 1)
+        self.assertEqual([o.created_at for o in self.store.find(since=150, until=300)], [200.0])
+        self.assertEqual(len(self.store.find(limit=1)), 1)
+
+        # 別プロセスから開き直しても同じ manifest を読む
+        self.assertEqual(len(OutputStore(self.tmp.name).find()), 3)
+
+    def test_export_jsonl_and_csv(self):
+        self.store.put(b"1", "silver", "a cat", model="dall-e-3")
+        self.store.put(b"2", "gold", "a dog")
+
+        out = io.StringIO()
+        self.assertEqual(self.store.export(out, "jsonl", preset="silver"), 1)
+        self.assertEqual(json.loads(out.getvalue())["model"], "dall-e-3")
+
+        out = io.StringIO()
+        self.assertEqual(self.store.export(out, "csv"), 2)
+        rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+        self.assertEqual(sorted(row["preset"] for row in rows), ["gold", "silver"])
+
+        with self.assertRaises(ValueError):
+            self.store.export(io.StringIO(), "xml")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import io
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from phash_index import BKTree, PerceptualHashIndex, KIND_GENERATED, KIND_POSTED, dhash, hamming, phash
+
+
+def make_image(seed: int, tint=(0, 0, 0)) -> bytes:
+    # 滑らかなグラデーションに乱数の円を重ねた画像（tint で色だけを変える）
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:128, 0:128]
+    gray = np.zeros((128, 128))
+    for cx, cy, r in rng.integers(10, 118, size=(6, 3)):
+        gray += ((x - cx) ** 2 + (y - cy) ** 2 < r ** 2) * rng.uniform(40, 120)
+    rgb = np.stack([np.clip(gray + t, 0, 255) for t in tint], axis=-1).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(rgb).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class TestHashes(unittest.TestCase):
+
+    def test_similar_images_are_close_and_different_images_are_far(self):
+        for hash_func in (dhash, phash):
+            with self.subTest(hash_func=hash_func.__name__):
+                base = hash_func(make_image(1))
+                tinted = hash_func(make_image(1, tint=(30, 20, 0)))
+                other = hash_func(make_image(2))
+                self.assertLessEqual(hamming(base, tinted), 6)
+                self.assertGreater(hamming(base, other), 10)
+
+
+class TestBKTree(unittest.TestCase):
+
+    def test_search_matches_linear_scan(self):
+        rng = random.Random(0)
+        hashes = [rng.getrandbits(64) for _ in range(500)]
+        tree = BKTree()
+        for i, h in enumerate(hashes):
+            tree.add(h, i)
+        query = hashes[42] ^ 0b1011
+        expected = sorted((hamming(query, h), i) for i, h in enumerate(hashes) if hamming(query, h) <= 12)
+        found = sorted((distance, value) for distance, _, value in tree.search(query, 12))
+        self.assertEqual(found, expected)
+        self.assertEqual(len(tree), 500)
+
+
+class TestPerceptualHashIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "index.jsonl")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_only_posted_images_count_as_duplicates(self):
+        index = PerceptualHashIndex(self.path)
+        image = make_image(1)
+        index.add(index.hash_image(image), KIND_GENERATED)
+        self.assertIsNone(index.find_duplicate(image))
+
+        index.add(index.hash_image(image), KIND_POSTED, label="silver:1")
+        match = index.find_duplicate(make_image(1, tint=(30, 20, 0)))
+        self.assertEqual(match.label, "silver:1")
+        self.assertIsNone(index.find_duplicate(make_image(2)))
+
+    def test_persists_across_instances(self):
+        index = PerceptualHashIndex(self.path)
+        index.add(index.hash_image(make_image(3)), label="gold:2")
+        reloaded = PerceptualHashIndex(self.path)
+        self.assertEqual(len(reloaded), 1)
+        self.assertEqual(reloaded.find_duplicate(make_image(3)).label, "gold:2")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from generate_prompt import generate_image_prompt
+from policy_retry import (
+    CircuitOpenError,
+    PolicyRetry,
+    SAFE_ATTRIBUTE_VALUES,
+    extract_attributes,
+    replace_attributes,
+)
+
+
+class TestPromptAttributes(unittest.TestCase):
+
+    def test_extract_and_replace_round_trip(self):
+        prompt = generate_image_prompt(clothing="A black bikini", scene="A sunny beach")
+        attributes = extract_attributes(prompt)
+        self.assertEqual(attributes["clothing"], "A black bikini")
+        self.assertEqual(attributes["scene"], "A sunny beach")
+
+        replaced = replace_attributes(prompt, {"scene": "A park", "clothing": "A coat"})
+        self.assertEqual(replaced, generate_image_prompt(clothing="A coat", scene="A park"))
+
+    def test_free_form_prompt_is_left_alone(self):
+        self.assertIsNone(extract_attributes("a cute cat"))
+        self.assertEqual(replace_attributes("a cute cat", {"clothing": "A coat"}), "a cute cat")
+
+
+class TestPolicyRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "policy_state.json")
+        self.prompt = generate_image_prompt(clothing="A black bikini")
+
+    def test_violations_mutate_attributes_one_at_a_time(self):
+        session = PolicyRetry(self.path).start("silver", self.prompt)
+        self.assertEqual(session.prompt, self.prompt)
+
+        first = session.on_violation()
+        self.assertEqual(extract_attributes(first)["clothing"], SAFE_ATTRIBUTE_VALUES["clothing"])
+        second = session.on_violation()
+        self.assertEqual(extract_attributes(second)["clothing"], SAFE_ATTRIBUTE_VALUES["clothing"])
+        self.assertEqual(extract_attributes(second)["pose"], SAFE_ATTRIBUTE_VALUES["pose"])
+
+    def test_tripped_value_is_remembered_per_preset(self):
+        session = PolicyRetry(self.path).start("silver", self.prompt)
+        session.on_violation()
+        session.on_success()
+
+        # 別プロセスで読み直しても、最初の試行から置き換わっている
+        policy = PolicyRetry(self.path)
+        self.assertEqual(policy.tripped_values("silver"), {"clothing": ["A black bikini"]})
+        remembered = policy.start("silver", self.prompt)
+        self.assertEqual(extract_attributes(remembered.prompt)["clothing"], SAFE_ATTRIBUTE_VALUES["clothing"])
+        self.assertEqual(policy.start("gold", self.prompt).prompt, self.prompt)
+
+    def test_circuit_opens_after_repeated_failures_and_closes_on_success(self):
+        policy = PolicyRetry(self.path, failure_threshold=2, cooldown=60)
+        with patch("policy_retry.time.time", return_value=1000.0):
+            policy.start("silver", self.prompt).on_failure()
+            policy.start("silver", self.prompt).on_failure()
+            with self.assertRaises(CircuitOpenError):
+                policy.start("silver", self.prompt)
+            policy.start("gold", self.prompt)
+            self.assertTrue(PolicyRetry(self.path).is_open("silver"))
+
+        # クールダウン後は1ジョブ試し、成功すればブレーカーを閉じる
+        with patch("policy_retry.time.time", return_value=1061.0):
+            policy.start("silver", self.prompt).on_success()
+            policy.start("silver", self.prompt).on_failure()
+            self.assertFalse(policy.is_open("silver"))
+
+    def test_half_open_admits_a_single_probe(self):
+        policy = PolicyRetry(self.path, failure_threshold=2, cooldown=60)
+        with patch("policy_retry.time.time", return_value=1000.0):
+            policy.start("silver", self.prompt).on_failure()
+            policy.start("silver", self.prompt).on_failure()
+        with patch("policy_retry.time.time", return_value=1061.0):
+            probe = policy.start("silver", self.prompt)
+            self.assertTrue(probe.probe)
+            # 試しているジョブが終わるまで他のジョブは通さない
+            with self.assertRaises(CircuitOpenError):
+                policy.start("silver", self.prompt)
+            self.assertTrue(policy.is_open("silver"))
+            # 試したジョブが失敗したらすぐに開き直す
+            probe.on_failure()
+            with self.assertRaises(CircuitOpenError):
+                policy.start("silver", self.prompt)
+        with patch("policy_retry.time.time", return_value=1122.0):
+            self.assertFalse(policy.is_open("silver"))
+            policy.start("silver", self.prompt).on_success()
+            # 開き直したときに失敗の回数を数え直しているので、1回の失敗では開かない
+            policy.start("silver", self.prompt).on_failure()
+            self.assertFalse(policy.is_open("silver"))
+
+    def test_failures_from_other_processes_are_merged(self):
+        first = PolicyRetry(self.path, failure_threshold=2, cooldown=60)
+        second = PolicyRetry(self.path, failure_threshold=2, cooldown=60)
+        first.start("silver", self.prompt).on_failure()
+        second.start("silver", self.prompt).on_failure()
+        self.assertTrue(first.is_open("silver"))
+        self.assertTrue(PolicyRetry(self.path).is_open("silver"))
+
+
+if __name__ == "__main__":
+    unittest.main()
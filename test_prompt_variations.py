@@ -0,0 +1,58 @@
+import os
+import random
+import itertools
+import tempfile
+import unittest
+from collections import Counter
+
+from generate_prompt import PROMPT_DEFAULTS, compile_prompt_template, generate_image_prompt
+from prompt_variations import UsedPromptLog, VariationSpace, iter_prompts
+
+
+class TestPromptVariations(unittest.TestCase):
+
+    def setUp(self):
+        self.space = VariationSpace(PROMPT_DEFAULTS, {
+            "eye": [("Red", 1.0), ("Blue", 1.0), ("Green", 2.0)],
+            "scene": [("beach", 1.0), ("forest", 1.0)],
+        })
+
+    def test_compiled_template_matches_generate_image_prompt(self):
+        attributes = dict(PROMPT_DEFAULTS, eye="Violet", scene="library")
+        self.assertEqual(compile_prompt_template()(attributes), generate_image_prompt(**attributes))
+
+    def test_cartesian_yields_every_combination_once(self):
+        variants = list(iter_prompts(self.space))
+        self.assertEqual(len(variants), self.space.size)
+        self.assertEqual(len({v.digest for v in variants}), 6)
+        self.assertEqual(len(list(iter_prompts(self.space, limit=4))), 4)
+
+    def test_duplicate_candidates_are_deduped(self):
+        space = VariationSpace(PROMPT_DEFAULTS, {"eye": [("Red", 1.0), ("Red", 1.0)]})
+        self.assertEqual(len(list(iter_prompts(space))), 1)
+
+    def test_used_prompts_are_skipped_across_runs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "used.txt")
+            log = UsedPromptLog(path)
+            for variant in iter_prompts(self.space, limit=4):
+                log.add(variant.digest)
+            remaining = list(iter_prompts(self.space, used=UsedPromptLog(path)))
+            self.assertEqual(len(remaining), 2)
+
+    def test_random_sampling_respects_weights_and_stops_when_exhausted(self):
+        samples = itertools.islice(self.space.random_sample(random.Random(0)), 4000)
+        picks = Counter(self.space.choices[0][indices[0]] for indices in samples)
+        self.assertGreater(picks["Green"], picks["Red"] * 1.5)
+        self.assertEqual(len(list(iter_prompts(self.space, "random", seed=0))), 6)
+
+    def test_latin_hypercube_is_stratified(self):
+        indices = list(self.space.latin_hypercube(8, random.Random(1)))
+        eyes = Counter(self.space.choices[0][i[0]] for i in indices)
+        scenes = Counter(self.space.choices[1][i[1]] for i in indices)
+        self.assertEqual(eyes, Counter({"Green": 4, "Red": 2, "Blue": 2}))
+        self.assertEqual(scenes, Counter({"beach": 4, "forest": 4}))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,107 @@
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+
+from rate_limit import (
+    Backoff,
+    TokenBucket,
+    call_with_retry,
+    get_limiter,
+    reset_limiters,
+    retry_after_from_headers,
+)
+
+
+class MockRateLimitError(Exception):
+    def __init__(self, headers, status_code=429):
+        super().__init__("rate limited")
+        self.response = MagicMock()
+        self.response.status_code = status_code
+        self.response.headers = headers
+
+
+class TestRetryAfterFromHeaders(unittest.TestCase):
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(retry_after_from_headers({"Retry-After": "7"}), 7.0)
+
+    def test_retry_after_ms(self):
+        self.assertAlmostEqual(retry_after_from_headers({"retry-after-ms": "250"}), 0.25)
+
+    def test_openai_reset_duration(self):
+        self.assertAlmostEqual(retry_after_from_headers({"x-ratelimit-reset-requests": "1m30.5s"}, True), 90.5)
+        self.assertAlmostEqual(retry_after_from_headers({"x-ratelimit-reset-requests": "20ms"}, True), 0.02)
+
+    def test_openai_reset_only_when_exhausted_or_rate_limited(self):
+        headers = {"x-ratelimit-remaining-requests": "4", "x-ratelimit-reset-requests": "6m0s",
+                   "x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "2s"}
+        self.assertAlmostEqual(retry_after_from_headers(headers), 2.0)
+        headers["x-ratelimit-remaining-tokens"] = "100"
+        self.assertIsNone(retry_after_from_headers(headers))
+
+    def test_twitter_reset_only_when_exhausted(self):
+        reset = str(int(time.time()) + 60)
+        self.assertIsNone(retry_after_from_headers({"x-rate-limit-remaining": "3", "x-rate-limit-reset": reset}))
+        delay = retry_after_from_headers({"x-rate-limit-remaining": "0", "x-rate-limit-reset": reset})
+        self.assertTrue(55 <= delay <= 60)
+
+    def test_no_headers(self):
+        self.assertIsNone(retry_after_from_headers(None))
+        self.assertIsNone(retry_after_from_headers({"content-type": "image/png"}))
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_wait(self):
+        bucket = TokenBucket(rate=1.0, capacity=2)
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertAlmostEqual(bucket.reserve(), 1.0, places=1)
+
+    def test_pause_blocks_all_callers(self):
+        bucket = TokenBucket(rate=100.0, capacity=10)
+        bucket.pause(5)
+        self.assertGreater(bucket.reserve(), 4.9)
+
+
+class TestCallWithRetry(unittest.TestCase):
+
+    def setUp(self):
+        reset_limiters()
+
+    def test_server_delay_overrides_backoff_and_pauses_endpoint(self):
+        func = MagicMock(side_effect=[MockRateLimitError({"Retry-After": "2"}), "ok"])
+        with patch('rate_limit.time.sleep') as mock_sleep, \
+             patch('rate_limit.random.uniform', return_value=0):
+            result = call_with_retry(
+                "create_tweet", func, is_retryable=lambda e: True, backoff=Backoff(base=30)
+            )
+        self.assertEqual(result, "ok")
+        # sleep をモックしているので時間は進まず、再取得時にも一時停止が残っている
+        self.assertEqual(mock_sleep.call_args_list[0].args, (2.0,))
+        self.assertGreater(get_limiter("create_tweet").reserve(), 0)
+
+    def test_server_error_with_reset_headers_uses_backoff(self):
+        headers = {"x-ratelimit-remaining-requests": "4", "x-ratelimit-reset-requests": "6m0s"}
+        func = MagicMock(side_effect=[MockRateLimitError(headers, status_code=500), "ok"])
+        with patch('rate_limit.time.sleep') as mock_sleep, \
+             patch('rate_limit.random.uniform', return_value=0):
+            result = call_with_retry(
+                "images.generate", func, is_retryable=lambda e: True, backoff=Backoff(base=3)
+            )
+        self.assertEqual(result, "ok")
+        self.assertEqual(mock_sleep.call_args_list[-1].args, (3.0,))
+        # 他の呼び出し元は止めない
+        self.assertEqual(get_limiter("images.generate").reserve(), 0.0)
+
+    def test_non_retryable_raises_immediately(self):
+        func = MagicMock(side_effect=ValueError("bad"))
+        with patch('rate_limit.time.sleep') as mock_sleep:
+            with self.assertRaises(ValueError):
+                call_with_retry("media_upload", func, is_retryable=lambda e: False)
+        func.assert_called_once()
+        mock_sleep.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
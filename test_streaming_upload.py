@@ -0,0 +1,103 @@
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from rate_limit import reset_limiters
+from streaming_upload import ChunkPipe, chunked_upload, rechunk, stream_image_upload
+
+
+class FakeAPI:
+    """INIT / APPEND / FINALIZE の呼び出しを記録する tweepy.API の代わり"""
+
+    def __init__(self):
+        self.calls = []
+        self.segments = []
+
+    def chunked_upload_init(self, total_bytes, media_type, **kwargs):
+        self.calls.append(("INIT", total_bytes, media_type))
+        return MagicMock(media_id=123)
+
+    def chunked_upload_append(self, media_id, media, segment_index):
+        self.calls.append(("APPEND", segment_index))
+        self.segments.append(media)
+
+    def chunked_upload_finalize(self, media_id):
+        self.calls.append(("FINALIZE", media_id))
+        return MagicMock(media_id=media_id, processing_info=None)
+
+
+class TestChunkPipe(unittest.TestCase):
+
+    def test_rechunk(self):
+        self.assertEqual(list(rechunk([b"ab", b"cde", b"f"], 4)), [b"abcd", b"ef"])
+
+    def test_producer_is_bounded_by_queue(self):
+        produced = []
+
+        def source():
+            for i in range(20):
+                produced.append(i)
+                yield b"x"
+
+        pipe = ChunkPipe(source(), chunk_size=1, queue_size=2)
+        # 消費しない間は queue_size 程度しか読み進めない
+        time.sleep(0.2)
+        self.assertLessEqual(len(produced), 4)
+        self.assertEqual(b"".join(pipe), b"x" * 20)
+
+    def test_producer_error_is_raised_in_consumer(self):
+        def source():
+            yield b"abc"
+            raise ConnectionError("reset")
+
+        with self.assertRaises(ConnectionError):
+            list(ChunkPipe(source(), chunk_size=2))
+
+
+class TestStreamImageUpload(unittest.TestCase):
+
+    def setUp(self):
+        reset_limiters()
+
+    def make_session(self, body: bytes, headers):
+        session = MagicMock()
+        response = session.get.return_value.__enter__.return_value
+        response.headers = headers
+        response.iter_content.side_effect = lambda chunk_size: (
+            body[i:i + 3] for i in range(0, len(body), 3)
+        )
+        return session
+
+    def test_chunks_are_appended_in_order(self):
+        body = b"0123456789"
+        api = FakeAPI()
+        received = []
+        session = self.make_session(body, {"Content-Length": "10", "Content-Type": "image/png"})
+        media = stream_image_upload(api, "https://example.com/a.png", session=session, chunk_size=4, sink=received.append)
+        self.assertEqual(media.media_id, 123)
+        self.assertEqual(api.calls[0], ("INIT", 10, "image/png"))
+        self.assertEqual([c[0] for c in api.calls], ["INIT", "APPEND", "APPEND", "APPEND", "FINALIZE"])
+        self.assertEqual(api.segments, [b"0123", b"4567", b"89"])
+        self.assertEqual(b"".join(received), body)
+        _, kwargs = session.get.call_args
+        self.assertTrue(kwargs["stream"])
+        self.assertIsNotNone(kwargs["timeout"])
+
+    def test_size_mismatch_is_not_finalized(self):
+        api = FakeAPI()
+        with self.assertRaises(IOError):
+            chunked_upload(api, [b"abc"], 10, "image/png")
+        self.assertNotIn("FINALIZE", [c[0] for c in api.calls])
+
+    def test_without_content_length_falls_back_to_simple_upload(self):
+        api = MagicMock()
+        session = self.make_session(b"abcdef", {"Content-Type": "image/png"})
+        stream_image_upload(api, "https://example.com/a.png", session=session)
+        api.chunked_upload_init.assert_not_called()
+        args, kwargs = api.media_upload.call_args
+        self.assertEqual(args, ("image.png",))
+        self.assertEqual(kwargs["file"].read(), b"abcdef")
+
+
+if __name__ == '__main__':
+    unittest.main()
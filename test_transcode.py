@@ -0,0 +1,64 @@
+import io
+import asyncio
+import unittest
+
+import numpy as np
+from PIL import Image, PngImagePlugin
+
+from transcode import Transcoder, transcode_image, FORMAT_JPEG, FORMAT_ORIGINAL, FORMAT_PNG, FORMAT_WEBP
+
+
+def make_png(size: int = 256, text: str = "") -> bytes:
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:size, 0:size]
+    pixels = np.stack([x % 256, y % 256, (x + y) % 256], axis=-1) + rng.normal(0, 10, (size, size, 3))
+    info = PngImagePlugin.PngInfo()
+    if text:
+        info.add_text("parameters", text)
+    buf = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buf, format="PNG", pnginfo=info)
+    return buf.getvalue()
+
+
+class TestTranscodeImage(unittest.TestCase):
+
+    def test_lossy_formats_fit_budget(self):
+        data = make_png()
+        budget = len(data) // 8
+        for image_format, expected in ((FORMAT_JPEG, "JPEG"), (FORMAT_WEBP, "WEBP")):
+            with self.subTest(image_format=image_format):
+                result = transcode_image(data, image_format, max_bytes=budget, min_quality=10)
+                self.assertEqual(result.format, expected)
+                self.assertLessEqual(len(result.data), budget)
+                self.assertEqual(result.original_size, len(data))
+                with Image.open(io.BytesIO(result.data)) as image:
+                    self.assertEqual(image.size, (256, 256))
+
+    def test_metadata_is_stripped(self):
+        data = make_png(text="secret prompt")
+        result = transcode_image(data, FORMAT_PNG, max_bytes=len(data) * 2)
+        self.assertNotIn(b"secret prompt", result.data)
+
+    def test_keeps_original_when_transcoding_does_not_help(self):
+        buf = io.BytesIO()
+        Image.new("RGB", (64, 64), (10, 20, 30)).save(buf, format="PNG")
+        data = buf.getvalue()
+        result = transcode_image(data, FORMAT_WEBP, max_bytes=len(data) * 10, quality=100)
+        self.assertLessEqual(len(result.data), len(data))
+        self.assertEqual(transcode_image(data, FORMAT_ORIGINAL).data, data)
+        self.assertEqual(transcode_image(data, FORMAT_ORIGINAL).filename, "image.png")
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            Transcoder("tiff")
+
+
+class TestTranscoder(unittest.TestCase):
+
+    def test_async_runs_in_thread_pool(self):
+        result = asyncio.run(Transcoder(FORMAT_JPEG).arun(make_png()))
+        self.assertEqual(result.filename, "image.jpg")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stderr
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+from local_test import generate_and_save_image
+from output_store import OutputStore
+import work_queue
+from work_queue import WorkQueue, main, run_worker, STATE_DONE, STATE_FAILED, STATE_LEASED, STATE_QUEUED
+
+
+class TestWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.queue = WorkQueue(os.path.join(self.tmp.name, "queue.sqlite3"), lease_seconds=60, max_attempts=2)
+
+    def test_enqueue_is_idempotent_per_sweep(self):
+        tasks = [("silver", "a cat"), ("silver", "a dog"), ("silver", "a cat")]
+        self.assertEqual(self.queue.enqueue("s1", tasks), 2)
+        self.assertEqual(self.queue.enqueue("s1", tasks), 0)
+        self.assertEqual(self.queue.enqueue("s2", tasks), 2)
+        self.assertEqual(self.queue.counts("s1")[STATE_QUEUED], 2)
+
+    def test_enqueue_consumes_tasks_in_batches(self):
+        def tasks():
+            for i in range(5):
+                yield "silver", f"prompt {i}"
+
+        with patch.object(work_queue, "ENQUEUE_BATCH_SIZE", 2), \
+             patch.object(self.queue, "_transaction", wraps=self.queue._transaction) as transaction:
+            self.assertEqual(self.queue.enqueue("s", tasks()), 5)
+        self.assertEqual(transaction.call_count, 3)
+        self.assertEqual(self.queue.counts("s")[STATE_QUEUED], 5)
+
+    def test_enqueue_cli_validates_mode_and_count(self):
+        for argv in (["enqueue", "--sweep", "s", "--presets", "silver", "--mode", "grid"],
+                     ["enqueue", "--sweep", "s", "--presets", "silver", "--mode", "random"],
+                     ["enqueue", "--sweep", "s", "--presets", "silver", "--mode", "lhs"]):
+            with self.subTest(argv=argv), redirect_stderr(StringIO()), self.assertRaises(SystemExit):
+                main(["--queue", self.queue.path, *argv])
+        self.assertEqual(sum(self.queue.counts().values()), 0)
+
+    def test_reads_do_not_wait_for_the_write_lock(self):
+        self.queue.enqueue("s", [("silver", "a cat")])
+        reader = WorkQueue(self.queue.path)
+        with self.queue._transaction():
+            # 他のプロセスが書き込み中でも進捗は読める
+            connect = sqlite3.connect
+            with patch("work_queue.sqlite3.connect", lambda *args, **kwargs: connect(*args, **{**kwargs, "timeout": 0.1})):
+                self.assertEqual(reader.counts()[STATE_QUEUED], 1)
+                self.assertEqual(reader.max_concurrency(), 4)
+                self.assertEqual(reader.failed_jobs(), [])
+
+    def test_claim_respects_global_concurrency_limit(self):
+        self.queue.enqueue("s", [("silver", f"prompt {i}") for i in range(3)])
+        self.queue.set_max_concurrency(2)
+        # 別プロセスから開いても同じ上限を使う
+        other = WorkQueue(self.queue.path)
+        first = self.queue.claim("a")
+        second = other.claim("b")
+        self.assertNotEqual(first.id, second.id)
+        self.assertIsNone(self.queue.claim("c"))
+
+        self.assertTrue(self.queue.complete(first, "out.png"))
+        third = other.claim("c")
+        self.assertEqual(third.prompt, "prompt 2")
+        self.assertEqual(self.queue.counts(), {STATE_QUEUED: 0, STATE_LEASED: 2, STATE_DONE: 1, STATE_FAILED: 0})
+
+    def test_expired_lease_is_reclaimed_and_stale_worker_cannot_complete(self):
+        self.queue.enqueue("s", [("silver", "a cat")])
+        with patch("work_queue.time.time", return_value=1000.0):
+            stale = self.queue.claim("a")
+        self.assertEqual(stale.attempts, 1)
+
+        with patch("work_queue.time.time", return_value=1061.0):
+            fresh = self.queue.claim("b")
+        self.assertEqual((fresh.id, fresh.worker, fresh.attempts), (stale.id, "b", 2))
+        self.assertFalse(self.queue.heartbeat(stale))
+        self.assertFalse(self.queue.complete(stale, "stale.png"))
+        self.assertTrue(self.queue.heartbeat(fresh))
+        self.assertTrue(self.queue.complete(fresh, "fresh.png"))
+
+    def test_failures_are_retried_until_max_attempts(self):
+        self.queue.enqueue("s", [("silver", "a cat")])
+        self.assertTrue(self.queue.fail(self.queue.claim("a"), "boom"))
+        self.assertEqual(self.queue.counts()[STATE_QUEUED], 1)
+        self.assertTrue(self.queue.fail(self.queue.claim("a"), "boom"))
+        self.assertEqual(self.queue.counts()[STATE_FAILED], 1)
+        self.assertIsNone(self.queue.claim("a"))
+        self.assertEqual([job.error for job in self.queue.failed_jobs()], ["boom"])
+
+        self.assertEqual(self.queue.requeue_failed(), 1)
+        self.assertEqual(self.queue.claim("a").attempts, 1)
+
+    def test_worker_records_the_generation_error(self):
+        store = OutputStore(os.path.join(self.tmp.name, "images"))
+        self.queue.enqueue("s", [("silver", "a cat")])
+        client = MagicMock()
+        client.images.generate.side_effect = RuntimeError("content_policy_violation")
+
+        def process(job):
+            return generate_and_save_image(job.prompt, client=client, preset=job.preset, store=store, job_key=job.key)
+
+        self.assertEqual(run_worker(self.queue, process, "w", 30, 0.01, True), 0)
+        self.assertEqual([job.error for job in self.queue.failed_jobs()], ["content_policy_violation"])
+        self.assertEqual(client.images.generate.call_count, 2)
+
+    def test_workers_share_sweep_and_store_records_each_job_once(self):
+        store = OutputStore(os.path.join(self.tmp.name, "images"))
+        self.queue.enqueue("s", [("silver", f"prompt {i}") for i in range(6)])
+        self.queue.set_max_concurrency(2)
+        calls = []
+        lock = threading.Lock()
+
+        def process(job):
+            with lock:
+                calls.append(job.id)
+            if job.prompt == "prompt 3" and calls.count(job.id) == 1:
+                raise RuntimeError("一時的なエラー")
+            return store.put(job.prompt.encode(), job.preset, job.prompt, job_key=job.key).path
+
+        threads = [
+            threading.Thread(target=run_worker, args=(self.queue, process, f"w{i}", 30, 0.01, True))
+            for i in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual(self.queue.counts()[STATE_DONE], 6)
+        self.assertEqual(len(calls), 7)
+        self.assertEqual(len(store.find()), 6)
+
+        # 同じジョブの結果を別のワーカーが保存しても manifest には1行だけ残る
+        first = store.find(prompt="prompt 0")[0]
+        again = store.put(b"other", "silver", "prompt 0", job_key=first.job_key)
+        self.assertEqual(again.path, first.path)
+        self.assertEqual(len(store.find(prompt="prompt 0")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,254 @@
+import io
+import os
+import glob
+import time
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+
+# アップロード用の変換形式
+FORMAT_ORIGINAL = "original"   # 変換しない
+FORMAT_PNG = "png"             # PNG のまま最適化（予算を超える場合は256色に減色）
+FORMAT_JPEG = "jpeg"
+FORMAT_WEBP = "webp"
+
+# Twitter の画像アップロード上限は 5MB。余裕を見て既定の予算は 1MB にする
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_QUALITY = 92
+DEFAULT_MIN_QUALITY = 70
+
+_EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp", "GIF": ".gif"}
+
+
+class TranscodeResult(NamedTuple):
+    data: bytes
+    format: str
+    filename: str          # tweepy が MIME 判定に使うファイル名
+    original_size: int
+    elapsed: float         # 変換にかかった秒数
+
+
+def _filename(image_format: str) -> str:
+    return "image" + _EXTENSIONS.get(image_format.upper(), ".png")
+
+
+def _encode(image: Image.Image, image_format: str, **params) -> bytes:
+    # 画素だけを書き出すので、元画像の EXIF / テキストチャンクなどのメタデータは引き継がれない
+    buf = io.BytesIO()
+    image.save(buf, format=image_format, **params)
+    return buf.getvalue()
+
+
+def _encode_within_budget(
+    image: Image.Image, image_format: str, max_bytes: int, quality: int, min_quality: int, **params
+) -> bytes:
+    """
+    予算内に収まる最も高い品質を二分探索で探して符号化する
+
+    最高品質で収まればそれを、最低品質でも収まらなければ最低品質の結果を返す
+    """
+    best = _encode(image, image_format, quality=quality, **params)
+    if len(best) <= max_bytes:
+        return best
+    smallest = _encode(image, image_format, quality=min_quality, **params)
+    if len(smallest) > max_bytes:
+        print(f"警告: 品質 {min_quality} でも {max_bytes} バイトに収まりません（{len(smallest)} バイト）。")
+        return smallest
+    low, high = min_quality, quality - 1
+    best = smallest
+    while low < high:
+        mid = (low + high + 1) // 2
+        data = _encode(image, image_format, quality=mid, **params)
+        if len(data) <= max_bytes:
+            best, low = data, mid
+        else:
+            high = mid - 1
+    return best
+
+
+def _to_rgb(image: Image.Image) -> Image.Image:
+    # JPEG は透過を持てないので白背景に合成する
+    if image.mode in ("RGBA", "LA", "P"):
+        rgba = image.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        return background
+    return image.convert("RGB") if image.mode != "RGB" else image
+
+
+def encode_jpeg(image: Image.Image, max_bytes: int, quality: int, min_quality: int) -> Tuple[bytes, str]:
+    data = _encode_within_budget(
+        _to_rgb(image), "JPEG", max_bytes, quality, min_quality, optimize=True, progressive=True
+    )
+    return data, "JPEG"
+
+
+def encode_webp(image: Image.Image, max_bytes: int, quality: int, min_quality: int) -> Tuple[bytes, str]:
+    return _encode_within_budget(image, "WEBP", max_bytes, quality, min_quality, method=4), "WEBP"
+
+
+def encode_png(image: Image.Image, max_bytes: int, quality: int, min_quality: int) -> Tuple[bytes, str]:
+    data = _encode(image, "PNG", optimize=True)
+    if len(data) > max_bytes:
+        data = _encode(image.convert("RGB").quantize(256, method=Image.Quantize.FASTOCTREE), "PNG", optimize=True)
+    return data, "PNG"
+
+
+# 形式名 → 変換関数。register_transcoder() で追加できる
+TRANSCODERS: Dict[str, Callable[[Image.Image, int, int, int], Tuple[bytes, str]]] = {
+    FORMAT_PNG: encode_png,
+    FORMAT_JPEG: encode_jpeg,
+    FORMAT_WEBP: encode_webp,
+}
+
+
+def register_transcoder(name: str, encoder: Callable[[Image.Image, int, int, int], Tuple[bytes, str]]) -> None:
+    """
+    変換形式を追加する関数
+
+    encoder は (画像, 予算バイト数, 品質, 最低品質) を受け取り (データ, Pillow の形式名) を返す
+    """
+    TRANSCODERS[name] = encoder
+
+
+def transcode_image(
+    data: bytes,
+    image_format: str = FORMAT_JPEG,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+    quality: int = DEFAULT_QUALITY,
+    min_quality: int = DEFAULT_MIN_QUALITY,
+) -> TranscodeResult:
+    """
+    画像をアップロード向けに変換する関数
+
+    変換後の方が大きくなり、かつ元の画像が予算内に収まる場合は元の画像をそのまま返す。
+
+    Parameters:
+    ----------
+    data : bytes
+        元の画像データ
+    image_format : str
+        original, png, jpeg, webp または register_transcoder() で追加した形式
+    max_bytes : int
+        変換後のサイズの目標（バイト）
+    quality, min_quality : int
+        jpeg / webp で試す品質の上限と下限
+    """
+    start = time.perf_counter()
+    with Image.open(io.BytesIO(data)) as image:
+        original_format = image.format or "PNG"
+        if image_format == FORMAT_ORIGINAL:
+            encoded, encoded_format = data, original_format
+        else:
+            try:
+                encoder = TRANSCODERS[image_format]
+            except KeyError:
+                raise ValueError(f"未知の変換形式です: {image_format}（{', '.join(TRANSCODERS)} のいずれか）") from None
+            image.load()
+            encoded, encoded_format = encoder(image, max_bytes, quality, min_quality)
+            if len(encoded) >= len(data) and len(data) <= max_bytes:
+                encoded, encoded_format = data, original_format
+    return TranscodeResult(
+        encoded, encoded_format, _filename(encoded_format), len(data), time.perf_counter() - start
+    )
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_transcode_executor() -> ThreadPoolExecutor:
+    """
+    変換用のスレッドプール（プロセス内で共有）を返す関数
+
+    Pillow は符号化中に GIL を解放するので、あるジョブの変換中も他のジョブの通信が進む
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = int(os.getenv("TRANSCODE_WORKERS", min(4, os.cpu_count() or 1)))
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcode")
+        return _executor
+
+
+class Transcoder:
+    """
+    download と media_upload の間に挟む変換ステージ
+
+    Parameters:
+    ----------
+    image_format : str
+        変換形式（transcode_image を参照）
+    max_bytes : int
+        変換後のサイズの目標（バイト）
+    """
+
+    def __init__(self, image_format: str = FORMAT_JPEG, max_bytes: int = DEFAULT_MAX_BYTES):
+        if image_format != FORMAT_ORIGINAL and image_format not in TRANSCODERS:
+            raise ValueError(f"未知の変換形式です: {image_format}")
+        self.image_format = image_format
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_env(cls) -> "Transcoder":
+        """環境変数 IMAGE_UPLOAD_FORMAT / IMAGE_UPLOAD_MAX_KB から作成する"""
+        return cls(
+            os.getenv("IMAGE_UPLOAD_FORMAT", FORMAT_JPEG),
+            int(float(os.getenv("IMAGE_UPLOAD_MAX_KB", DEFAULT_MAX_BYTES / 1024)) * 1024),
+        )
+
+    def __call__(self, data: bytes) -> TranscodeResult:
+        result = transcode_image(data, self.image_format, self.max_bytes)
+        print(
+            f"画像を変換しました: {result.format} {result.original_size} → {len(result.data)} バイト"
+            f"（{result.elapsed * 1000:.0f} ms）"
+        )
+        return result
+
+    def submit(self, data: bytes):
+        """共有スレッドプールで変換する（concurrent.futures.Future を返す）"""
+        return get_transcode_executor().submit(self, data)
+
+    async def arun(self, data: bytes) -> TranscodeResult:
+        """イベントループを塞がないよう共有スレッドプールで変換する"""
+        return await asyncio.get_running_loop().run_in_executor(get_transcode_executor(), self, data)
+
+
+def benchmark(paths: List[str], formats: List[str], max_bytes: int, repeat: int = 3) -> None:
+    """
+    画像ごと・形式ごとに変換後のサイズと変換時間（repeat 回の中央値）を表示する
+    """
+    print(f"{'file':<32} {'format':<8} {'bytes':>10} {'ratio':>7} {'ms':>8}")
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        name = os.path.basename(path)[-32:]
+        print(f"{name:<32} {'(input)':<8} {len(data):>10} {1:>7.2f} {0:>8.1f}")
+        for image_format in formats:
+            timings = []
+            for _ in range(repeat):
+                result = transcode_image(data, image_format, max_bytes)
+                timings.append(result.elapsed)
+            elapsed = sorted(timings)[len(timings) // 2]
+            print(
+                f"{name:<32} {image_format:<8} {len(result.data):>10} "
+                f"{len(result.data) / len(data):>7.2f} {elapsed * 1000:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="アップロード用の画像変換のサイズと時間を比較する")
+    parser.add_argument("paths", nargs="*", help="省略時は generated_images 以下の *.png")
+    parser.add_argument("--formats", default="png,jpeg,webp", help="カンマ区切りの変換形式")
+    parser.add_argument("--max-kb", type=float, default=DEFAULT_MAX_BYTES / 1024)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob("generated_images/**/*.png", recursive=True))
+    if not paths:
+        parser.error("画像が見つかりません。ファイルを指定してください。")
+    benchmark(paths, [f.strip() for f in args.formats.split(",") if f.strip()], int(args.max_kb * 1024), args.repeat)
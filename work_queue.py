@@ -0,0 +1,507 @@
+import os
+import sys
+import time
+import uuid
+import socket
+import sqlite3
+import argparse
+import itertools
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from job_journal import prompt_hash
+from metrics import get_metrics, bind_labels
+
+# ジョブの状態
+STATE_QUEUED = "queued"    # 未着手（リース切れ・再試行待ちを含む）
+STATE_LEASED = "leased"    # ワーカーが処理中
+STATE_DONE = "done"        # 出力ストアに保存済み
+STATE_FAILED = "failed"    # max_attempts 回失敗した
+STATES = (STATE_QUEUED, STATE_LEASED, STATE_DONE, STATE_FAILED)
+
+DEFAULT_QUEUE_PATH = ".jobs/queue.sqlite3"
+# リースの期限。ワーカーは heartbeat_interval ごとに延長し、止まったワーカーのジョブは期限後に他へ回る
+DEFAULT_LEASE_SECONDS = 120
+DEFAULT_HEARTBEAT_INTERVAL = 30
+DEFAULT_MAX_ATTEMPTS = 3
+# 全ワーカー合計で同時に処理してよいジョブ数（API の同時実行の上限）
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_POLL_INTERVAL = 5
+# enqueue で1回のトランザクションに登録する件数（大きなスイープでもメモリに全件を持たない）
+ENQUEUE_BATCH_SIZE = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sweep TEXT NOT NULL,
+    preset TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_token TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result_path TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+-- 同じスイープに同じプリセット・プロンプトは1件だけ登録する（enqueue を繰り返しても増えない）
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_unique ON jobs (sweep, preset, prompt_hash);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class QueueJob(NamedTuple):
+    id: int
+    sweep: str
+    preset: str
+    prompt_hash: str
+    prompt: str
+    state: str
+    worker: Optional[str]
+    lease_token: Optional[str]
+    lease_expires: Optional[float]
+    attempts: int
+    result_path: Optional[str]
+    error: Optional[str]
+    created_at: float
+    updated_at: float
+
+    @property
+    def key(self) -> str:
+        """出力ストアに渡す job_key（同じジョブの結果は1回だけ記録される）"""
+        return f"{self.sweep}:{self.preset}:{self.prompt_hash}"
+
+
+class WorkQueue:
+    """
+    複数のプロセス・ホストで共有する画像生成ジョブのキュー（SQLite）
+
+    ワーカーは claim() でジョブをリースし、処理中は heartbeat() でリースを延長する。
+    ハートビートが途絶えたジョブは期限後の claim() で未着手に戻して他のワーカーに回す。
+    処理中のジョブ数が全ワーカー合計で max_concurrency に達している間は claim() は何も返さない。
+    リースを失ったワーカーの complete() は失敗するので、結果は最後にリースを持っていた
+    ワーカーの分だけが記録される（出力ストアへの保存は job_key で1回に絞る）。
+    claim() などの更新はデータベースのロック（BEGIN IMMEDIATE）の中で行うので、
+    別ホストから使う場合はファイルロックが正しく動く共有ファイルシステムに置くこと。
+
+    Parameters:
+    ----------
+    path : str
+        SQLite データベースのパス
+    lease_seconds : float
+        リースの期限（秒）
+    max_attempts : int
+        失敗・リース切れを含めてジョブを試す回数の上限
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_QUEUE_PATH,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+
+    @classmethod
+    def from_env(cls) -> "WorkQueue":
+        """環境変数 WORK_QUEUE_PATH / WORK_QUEUE_LEASE_SECONDS / WORK_QUEUE_MAX_ATTEMPTS から作成する"""
+        return cls(
+            os.getenv("WORK_QUEUE_PATH", DEFAULT_QUEUE_PATH),
+            float(os.getenv("WORK_QUEUE_LEASE_SECONDS", DEFAULT_LEASE_SECONDS)),
+            int(os.getenv("WORK_QUEUE_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)),
+        )
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # 読み取りから更新までを他のプロセスに割り込まれないよう、最初に書き込みロックを取る
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _read(self) -> Iterator[sqlite3.Connection]:
+        # 読み取りだけなら書き込みロックは取らない（status --watch がワーカーの claim / heartbeat を待たせない）。
+        # WAL なので読み取り中も他のプロセスは書き込める
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("BEGIN DEFERRED")
+            try:
+                yield conn
+            finally:
+                conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def enqueue(self, sweep: str, tasks: Iterable[Tuple[str, str]]) -> int:
+        """
+        (preset, prompt) のジョブを登録し、新しく登録した件数を返す（登録済みのものは無視する）
+
+        tasks は ENQUEUE_BATCH_SIZE 件ずつ取り出して登録するので、登録中もワーカーはジョブを取り出せる。
+        """
+        tasks = iter(tasks)
+        added = 0
+        while True:
+            batch = list(itertools.islice(tasks, ENQUEUE_BATCH_SIZE))
+            if not batch:
+                return added
+            now = time.time()
+            with self._transaction() as conn:
+                before = conn.total_changes
+                conn.executemany(
+                    "INSERT OR IGNORE INTO jobs (sweep, preset, prompt_hash, prompt, state, created_at, updated_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(sweep, preset, prompt_hash(prompt), prompt, STATE_QUEUED, now, now) for preset, prompt in batch],
+                )
+                added += conn.total_changes - before
+
+    def set_max_concurrency(self, limit: int) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES ('max_concurrency', ?)", (str(limit),)
+            )
+
+    def max_concurrency(self) -> int:
+        with self._read() as conn:
+            return self._max_concurrency(conn)
+
+    @staticmethod
+    def _max_concurrency(conn: sqlite3.Connection) -> int:
+        row = conn.execute("SELECT value FROM settings WHERE key = 'max_concurrency'").fetchone()
+        return int(row["value"]) if row else DEFAULT_MAX_CONCURRENCY
+
+    def _expire_leases(self, conn: sqlite3.Connection, now: float) -> None:
+        # 期限切れのリースは未着手に戻す（試行回数を使い切ったものは失敗にする）
+        conn.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END,"
+            " worker = NULL, lease_token = NULL, lease_expires = NULL,"
+            " error = 'リースの期限が切れました', updated_at = ?"
+            " WHERE state = ? AND lease_expires < ?",
+            (self.max_attempts, STATE_FAILED, STATE_QUEUED, now, STATE_LEASED, now),
+        )
+
+    def claim(self, worker: str) -> Optional[QueueJob]:
+        """
+        未着手のジョブを1件リースして返す（無い場合・同時実行数の上限に達している場合は None）
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            self._expire_leases(conn, now)
+            leased = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (STATE_LEASED,)).fetchone()[0]
+            if leased >= self._max_concurrency(conn):
+                return None
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE state = ? ORDER BY id LIMIT 1", (STATE_QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET state = ?, worker = ?, lease_token = ?, lease_expires = ?,"
+                " attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (STATE_LEASED, worker, uuid.uuid4().hex, now + self.lease_seconds, now, row["id"]),
+            )
+            job = conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+        return QueueJob(**dict(job))
+
+    def _update_leased(self, job: QueueJob, assignments: str, params: Tuple) -> bool:
+        # リースを持っている場合だけ更新する
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ? AND lease_token = ? AND state = ?",
+                (*params, time.time(), job.id, job.lease_token, STATE_LEASED),
+            )
+            return cursor.rowcount > 0
+
+    def heartbeat(self, job: QueueJob) -> bool:
+        """リースを延長する（他のワーカーに回っていた場合は False）"""
+        return self._update_leased(job, "lease_expires = ?", (time.time() + self.lease_seconds,))
+
+    def complete(self, job: QueueJob, result_path: str) -> bool:
+        """処理の完了を記録する（リースを失っていた場合は False）"""
+        return self._update_leased(
+            job, "state = ?, result_path = ?, lease_token = NULL, lease_expires = NULL, error = NULL",
+            (STATE_DONE, result_path),
+        )
+
+    def fail(self, job: QueueJob, error: str) -> bool:
+        """失敗を記録し、試行回数が残っていれば未着手に戻す（リースを失っていた場合は False）"""
+        state = STATE_FAILED if job.attempts >= self.max_attempts else STATE_QUEUED
+        return self._update_leased(
+            job, "state = ?, worker = NULL, lease_token = NULL, lease_expires = NULL, error = ?", (state, error)
+        )
+
+    def requeue_failed(self, sweep: Optional[str] = None) -> int:
+        """失敗したジョブを試行回数を戻して未着手に戻し、件数を返す"""
+        query = "UPDATE jobs SET state = ?, attempts = 0, error = NULL, updated_at = ? WHERE state = ?"
+        params: Tuple = (STATE_QUEUED, time.time(), STATE_FAILED)
+        if sweep is not None:
+            query += " AND sweep = ?"
+            params += (sweep,)
+        with self._transaction() as conn:
+            return conn.execute(query, params).rowcount
+
+    def counts(self, sweep: Optional[str] = None) -> Dict[str, int]:
+        """状態ごとのジョブ数"""
+        query = "SELECT state, COUNT(*) AS n FROM jobs"
+        params: Tuple = ()
+        if sweep is not None:
+            query += " WHERE sweep = ?"
+            params = (sweep,)
+        with self._read() as conn:
+            rows = conn.execute(query + " GROUP BY state", params).fetchall()
+        counts = dict.fromkeys(STATES, 0)
+        counts.update({row["state"]: row["n"] for row in rows})
+        return counts
+
+    def failed_jobs(self, sweep: Optional[str] = None, limit: int = 10) -> List[QueueJob]:
+        query = "SELECT * FROM jobs WHERE state = ?"
+        params: Tuple = (STATE_FAILED,)
+        if sweep is not None:
+            query += " AND sweep = ?"
+            params += (sweep,)
+        with self._read() as conn:
+            rows = conn.execute(query + " ORDER BY id LIMIT ?", (*params, limit)).fetchall()
+        return [QueueJob(**dict(row)) for row in rows]
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def run_worker(
+    queue: WorkQueue,
+    process: Callable[[QueueJob], Optional[str]],
+    worker_id: Optional[str] = None,
+    heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    exit_when_empty: bool = False,
+    stop: Optional[threading.Event] = None,
+) -> int:
+    """
+    キューからジョブを取り出して process(job) を呼び続けるワーカー
+
+    process は保存先のパスを返す（None か例外なら失敗として記録し、試行回数が残っていれば再試行する）。
+    例外の場合はそのメッセージをジョブの error に記録する。
+    処理中はスレッドで heartbeat_interval ごとにリースを延長する。
+    exit_when_empty の場合は未着手・処理中のジョブが無くなったら終了する。stop をセットしても終了する。
+
+    Returns:
+    -------
+    int
+        完了を記録できたジョブ数
+    """
+    worker_id = worker_id or default_worker_id()
+    stop = stop or threading.Event()
+    metrics = get_metrics()
+    completed = 0
+    while not stop.is_set():
+        job = queue.claim(worker_id)
+        if job is None:
+            if exit_when_empty:
+                counts = queue.counts()
+                if counts[STATE_QUEUED] == 0 and counts[STATE_LEASED] == 0:
+                    break
+            stop.wait(poll_interval)
+            continue
+
+        finished = threading.Event()
+        lost = threading.Event()
+
+        def keep_alive(job: QueueJob = job) -> None:
+            while not finished.wait(heartbeat_interval):
+                if not queue.heartbeat(job):
+                    lost.set()
+                    return
+
+        heartbeat = threading.Thread(target=keep_alive, name=f"heartbeat-{job.id}", daemon=True)
+        heartbeat.start()
+        try:
+            with bind_labels(preset=job.preset), metrics.span("job"):
+                result_path = process(job)
+            error = None if result_path is not None else "画像を保存できませんでした"
+        except Exception as e:
+            result_path, error = None, str(e) or type(e).__name__
+        finally:
+            finished.set()
+            heartbeat.join()
+
+        if error is None and queue.complete(job, result_path):
+            completed += 1
+            print(f"[{worker_id}] #{job.id} {job.preset}: {result_path}")
+            continue
+        if error is None or lost.is_set():
+            # 保存は job_key で1回に絞られるので、他のワーカーの結果と重複はしない
+            print(f"[{worker_id}] #{job.id} はリースを失っていたため結果を記録しませんでした。")
+            continue
+        metrics.inc("job_failures_total", preset=job.preset)
+        queue.fail(job, error)
+        print(f"[{worker_id}] #{job.id} {job.preset}: 失敗しました: {error}")
+    return completed
+
+
+def sweep_tasks(presets: List[str], mode: str, count: Optional[int], seed: Optional[int] = None) -> Iterator[Tuple[str, str]]:
+    """プリセットの variations から (preset, prompt) のスイープを作る（local_test.py と同じ組み合わせ方）"""
+    from config import get_preset
+    from prompt_variations import VariationSpace, iter_prompts
+
+    for preset in presets:
+        space = VariationSpace.from_preset(get_preset(preset))
+        for variant in iter_prompts(space, mode, count, seed=seed):
+            yield preset, variant.prompt
+
+
+def format_progress(counts: Dict[str, int]) -> str:
+    total = sum(counts.values())
+    finished = counts[STATE_DONE] + counts[STATE_FAILED]
+    percent = finished / total * 100 if total else 100.0
+    return (
+        f"{finished}/{total} ({percent:.1f}%) "
+        + " ".join(f"{state}={counts[state]}" for state in STATES)
+    )
+
+
+def _work(queue: WorkQueue, args: argparse.Namespace) -> int:
+    from clients import get_openai_client
+    from image_cache import POLICY_FRESH
+    from local_test import generate_and_save_image
+    from metrics import configure_from_env, write_from_env
+    from model_router import DEFAULT_BACKEND, ModelRouter
+    from output_store import OutputStore
+
+    configure_from_env()
+    store = OutputStore.from_env()
+    router = ModelRouter.from_env()
+    client = get_openai_client()
+
+    def process(job: QueueJob) -> Optional[str]:
+        return generate_and_save_image(
+            job.prompt, store.root, client, None, POLICY_FRESH, None,
+            router, router.backends_for(job.preset, DEFAULT_BACKEND), job.preset, store, job.key,
+        )
+
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=run_worker,
+            args=(queue, process, f"{args.worker_id or default_worker_id()}/{i}",
+                  args.heartbeat_interval, args.poll_interval, args.exit_when_empty, stop),
+            name=f"worker-{i}",
+        )
+        for i in range(args.threads)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1)
+    except KeyboardInterrupt:
+        # 処理中のジョブは終わるまで待つ（中断するとリース切れまで他のワーカーに回らない）
+        print("中断されました。処理中のジョブが終わったら終了します。")
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        write_from_env()
+    print(format_progress(queue.counts()))
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from prompt_variations import MODES, MODE_CARTESIAN, MODE_RANDOM, MODE_LATIN_HYPERCUBE
+
+    parser = argparse.ArgumentParser(description="複数のプロセス・ホストで画像生成ジョブを分担するキュー")
+    parser.add_argument("--queue", default=os.getenv("WORK_QUEUE_PATH", DEFAULT_QUEUE_PATH))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="プリセットの variations からスイープを登録する")
+    enqueue_parser.add_argument("--sweep", required=True, help="スイープ名（同じ名前で再登録しても重複しない）")
+    enqueue_parser.add_argument("--presets", required=True, help="カンマ区切りのプリセット名")
+    enqueue_parser.add_argument("--mode", choices=MODES, default=MODE_CARTESIAN)
+    enqueue_parser.add_argument("--count", type=int, help="プリセットごとの件数（random / lhs では必須）")
+    enqueue_parser.add_argument("--seed", type=int)
+
+    limit_parser = subparsers.add_parser("limit", help="全ワーカー合計の同時実行数を設定する")
+    limit_parser.add_argument("max_concurrency", type=int)
+
+    work_parser = subparsers.add_parser("work", help="ワーカーとしてジョブを処理する")
+    work_parser.add_argument("--threads", type=int, default=1, help="このプロセスで同時に処理するジョブ数")
+    work_parser.add_argument("--worker-id", help="省略時は ホスト名:PID:スレッド")
+    work_parser.add_argument("--heartbeat-interval", type=float, default=DEFAULT_HEARTBEAT_INTERVAL)
+    work_parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL)
+    work_parser.add_argument("--exit-when-empty", action="store_true", help="ジョブが無くなったら終了する")
+
+    status_parser = subparsers.add_parser("status", help="進捗を表示する")
+    status_parser.add_argument("--sweep")
+    status_parser.add_argument("--watch", type=float, help="この秒数ごとに表示し、全ジョブが終わったら終了する")
+
+    retry_parser = subparsers.add_parser("retry-failed", help="失敗したジョブを未着手に戻す")
+    retry_parser.add_argument("--sweep")
+
+    args = parser.parse_args(argv)
+    if args.command == "enqueue" and args.mode in (MODE_RANDOM, MODE_LATIN_HYPERCUBE) and args.count is None:
+        parser.error(f"--mode {args.mode} には --count が必要です")
+    queue = WorkQueue(
+        args.queue,
+        float(os.getenv("WORK_QUEUE_LEASE_SECONDS", DEFAULT_LEASE_SECONDS)),
+        int(os.getenv("WORK_QUEUE_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)),
+    )
+
+    if args.command == "enqueue":
+        presets = [p.strip() for p in args.presets.split(",") if p.strip()]
+        added = queue.enqueue(args.sweep, sweep_tasks(presets, args.mode, args.count, args.seed))
+        print(f"{added} 件を登録しました。{format_progress(queue.counts(args.sweep))}")
+        return 0
+
+    if args.command == "limit":
+        queue.set_max_concurrency(args.max_concurrency)
+        print(f"同時実行数の上限を {args.max_concurrency} にしました。")
+        return 0
+
+    if args.command == "work":
+        return _work(queue, args)
+
+    if args.command == "retry-failed":
+        print(f"{queue.requeue_failed(args.sweep)} 件を未着手に戻しました。")
+        return 0
+
+    while True:
+        counts = queue.counts(args.sweep)
+        print(format_progress(counts), flush=True)
+        if args.watch is None or counts[STATE_QUEUED] + counts[STATE_LEASED] == 0:
+            break
+        time.sleep(args.watch)
+    for job in queue.failed_jobs(args.sweep):
+        print(f"    #{job.id} {job.preset}: {job.error}")
+    return 1 if counts[STATE_FAILED] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())